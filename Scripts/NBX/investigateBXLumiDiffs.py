@@ -1,6 +1,10 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-import os, sys, csv
+import os, sys, itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from brilcalcCache import streamBrilcalc
+from bunchData import BunchData, NBX
 
 # This script is a companion to getNBX.py which will further investigate in detail discrepancies in the
 # per-luminometer bunch data. Run it with one or more fills as arguments and it'll give you some more
@@ -8,6 +12,10 @@ import os, sys, csv
 
 luminometerList = ["hfet", "pltzero"]  # for 2017-18; use hfoc instead of hfet for 2015-16
 
+# The threshold for the per-bunch data. If this is the same as the one getNBX.py used for the fill, the data that
+# it read is reused from the brilcalc cache rather than running brilcalc again.
+bunchThreshold = 0.1
+
 # If we see a difference between the two patterns, we can try shifting the second so it matches the first.
 # This is pretty slow so turn this on only if you want to use it.
 findShift = False
@@ -35,7 +43,7 @@ def print_truncated_list(l):
         return str(l[0:10])+"..."
 
 if len(sys.argv) < 2:
-    print "Usage: "+sys.argv[0]+" [fills]"
+    print("Usage: "+sys.argv[0]+" [fills]")
     sys.exit(0)
 
 fillList = [int(a) for a in sys.argv[1:]]
@@ -51,83 +59,62 @@ for fill in fillList:
     filledBunchesRef = set()
 
     for luminometer in luminometerList:
-        dataFileName = "bxdata_"+str(fill)+"_"+luminometer+".csv"
-
         applyShift = 0
         if luminometer in knownShifts and str(fill) in knownShifts[luminometer]:
             applyShift = knownShifts[luminometer][str(fill)]
-            print "Note: shifting data for",luminometer,"by",applyShift,"BX"
+            print("Note: shifting data for",luminometer,"by",applyShift,"BX")
         
-        with open(dataFileName) as dataFile:
-            reader = csv.reader(dataFile, delimiter=',')
-            for linenum, row in enumerate(reader):
-                if row[0][0] == '#':
-                    continue
-
-                # To save time and annoyance, just consider the first 25 lines of the file, since presumably
-                # any differences in the rest of the file are due to either (a) specific luminometer issues
-                # (which we don't really care about for this purpose) or (b) a bunch decaying faster than its
-                # companions (which can happen but we can't really account for that in our simple total so
-                # let's not worry about it).
-
-                # Note: if you're investigating shifts you should comment this out since often those start at
-                # a particular time mid-fill.
-
-                if linenum > 25:
-                    break
-
-                # Next, split up the individual BX data. Use the slice to drop the initial and final brackets.
-                thisNBunch = 0
-                if (row[9][0:2] == '[]'):
-                    bxFields = []
-                else:
-                    bxFields = row[9][1:-1].split(' ')
-                avgLumi = 0
-
-                # Get the list of filled bunches.
-                thisFilledBunches = set()
-                for i in range(0, len(bxFields), 3):
-                    thisBX = int(bxFields[i])
-                    thisBX += applyShift
-                    if thisBX > 3564:
-                        thisBX -= 3564
-                    if thisBX < 1:
-                        thisBX += 3564
-                    thisFilledBunches.add(thisBX)
-
-                # Store this if this is the first (non-empty) pattern we've seen.
-                if (nBunchLumi == -1 and len(thisFilledBunches) > 0):
-                    nBunchLumi = len(thisFilledBunches)
-                    filledBunchesRef = thisFilledBunches
-                # Otherwise, see if we match.
-                else:
-                    if (thisFilledBunches != filledBunchesRef):
-                        # There's a difference. Figure out what it is.
-                        extraBunches = thisFilledBunches - filledBunchesRef
-                        missingBunches = filledBunchesRef - thisFilledBunches
-                        if nBunchLumi != len(thisFilledBunches):
-                            print "Mismatch in numBX "+luminometer+" run:fill "+row[0]+" ls "+row[1]+": expected",nBunchLumi,"got",len(thisFilledBunches)
-                        else:
-                            print "Bunches are shifted in "+luminometer+" run:fill "+row[0]+" ls "+row[1]
-                        if len(missingBunches) > 0:
-                            print "Bunches missing:", print_truncated_list(sorted(missingBunches))
-                        if len(extraBunches) > 0:
-                            print "Extra bunches:", print_truncated_list(sorted(extraBunches))
-                        if findShift:
-                            for tryShift in range(1,3564):
-                                newBunchSet = set()
-                                for bx in thisFilledBunches:
-                                    newBunch = bx + tryShift
-                                    if newBunch > 3564:
-                                        newBunch -= 3564
-                                    newBunchSet.add(newBunch)
-                                sumDiff = len(filledBunchesRef-newBunchSet) + len(newBunchSet-filledBunchesRef)
-                                if sumDiff < 25:
-                                    print "Reasonably good match with shift",tryShift,"mismatch is",sumDiff
-                    # else:
-                    #     print "Match for "+luminometer+" run:fill "+row[0]+" ls "+row[1]
-            # end of loop over rows
-        # end of file read
+        # To save time and annoyance, just consider the first 24 lumisections, since presumably
+        # any differences in the rest of the file are due to either (a) specific luminometer issues
+        # (which we don't really care about for this purpose) or (b) a bunch decaying faster than its
+        # companions (which can happen but we can't really account for that in our simple total so
+        # let's not worry about it).
+
+        # Note: if you're investigating shifts you should read the whole fill instead (remove the islice)
+        # since often those start at a particular time mid-fill.
+        rows = list(itertools.islice(streamBrilcalc(["lumi", "--xing", "-b", "STABLE BEAMS", "-u", "hz/ub", "-f", str(fill),
+                                                     "--type", luminometer, "--xingTr", str(bunchThreshold)]), 24))
+
+        # Split up the individual BX data for all of the rows at once (see bunchData.py) and apply the shift.
+        bunches = BunchData.fromStrings(row[9] for row in rows)
+        shiftedBX = (bunches.bx.astype(int) + applyShift - 1) % NBX + 1
+
+        for i, row in enumerate(rows):
+            # Get the list of filled bunches.
+            thisFilledBunches = set(shiftedBX[bunches.offsets[i]:bunches.offsets[i+1]].tolist())
+
+            # Store this if this is the first (non-empty) pattern we've seen.
+            if (nBunchLumi == -1 and len(thisFilledBunches) > 0):
+                nBunchLumi = len(thisFilledBunches)
+                filledBunchesRef = thisFilledBunches
+            # Otherwise, see if we match.
+            else:
+                if (thisFilledBunches != filledBunchesRef):
+                    # There's a difference. Figure out what it is.
+                    extraBunches = thisFilledBunches - filledBunchesRef
+                    missingBunches = filledBunchesRef - thisFilledBunches
+                    if nBunchLumi != len(thisFilledBunches):
+                        print("Mismatch in numBX "+luminometer+" run:fill "+row[0]+" ls "+row[1]+": expected",nBunchLumi,"got",len(thisFilledBunches))
+                    else:
+                        print("Bunches are shifted in "+luminometer+" run:fill "+row[0]+" ls "+row[1])
+                    if len(missingBunches) > 0:
+                        print("Bunches missing:", print_truncated_list(sorted(missingBunches)))
+                    if len(extraBunches) > 0:
+                        print("Extra bunches:", print_truncated_list(sorted(extraBunches)))
+                    if findShift:
+                        for tryShift in range(1,3564):
+                            newBunchSet = set()
+                            for bx in thisFilledBunches:
+                                newBunch = bx + tryShift
+                                if newBunch > 3564:
+                                    newBunch -= 3564
+                                newBunchSet.add(newBunch)
+                            sumDiff = len(filledBunchesRef-newBunchSet) + len(newBunchSet-filledBunchesRef)
+                            if sumDiff < 25:
+                                print("Reasonably good match with shift",tryShift,"mismatch is",sumDiff)
+                # else:
+                #     print "Match for "+luminometer+" run:fill "+row[0]+" ls "+row[1]
+        # end of loop over rows
     
     # end of loop over luminometers
-    print "Found",nBunchLumi,"bunches from luminometer data"
+    print("Found",nBunchLumi,"bunches from luminometer data")
@@ -1,6 +1,10 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-import os, sys, csv
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from brilcalcCache import runBrilcalc, streamBrilcalc
+from bunchData import BunchData
 
 # This script is a companion to getNBX.py. If you run it and see that there's a discrepancy between the beam
 # data and the luminometer data, run this script to do some more detailed investigation.
@@ -10,8 +14,12 @@ beamIntensityThreshold = 2e9
 
 luminometerList = ["hfet", "pltzero"] # for 2017-18; use hfoc instead of hfet for 2016
 
+# The threshold for the per-bunch luminosity data. If this is the same as the one getNBX.py used for the fill,
+# the data that it read is reused from the brilcalc cache rather than running brilcalc again.
+bunchThreshold = 0.1
+
 if len(sys.argv) < 2:
-    print "Usage: "+sys.argv[0]+" [fills]"
+    print("Usage: "+sys.argv[0]+" [fills]")
     sys.exit(0)
 
 fillList = [int(a) for a in sys.argv[1:]]
@@ -28,88 +36,65 @@ for fill in fillList:
     # We should still loop over luminometers in case the first luminometer doesn't have any data for some
     # reason.
     for luminometer in luminometerList:
-        dataFileName = "bxdata_"+str(fill)+"_"+luminometer+".csv"
-        
-        with open(dataFileName) as dataFile:
-            reader = csv.reader(dataFile, delimiter=',')
-            for row in reader:
-                if row[0][0] == '#':
-                    continue
-
-                # Split up the individual BX data. Use the slice to drop the initial and final brackets.
-                if (row[9][0:2] == '[]'):
-                    bxFields = []
-                else:
-                    bxFields = row[9][1:-1].split(' ')
-
-                # Get the list of filled bunches.
-                for i in range(0, len(bxFields), 3):
-                    filledBunchesLumi.add(int(bxFields[i]))
-
-                nBunchLumi = len(filledBunchesLumi)
-                
-                # Now we successfully have the data, no point to keep going through the file at this point
-                break
-            # end of loop over rows
-        # end of file read
+        for row in streamBrilcalc(["lumi", "--xing", "-b", "STABLE BEAMS", "-u", "hz/ub", "-f", str(fill),
+                                   "--type", luminometer, "--xingTr", str(bunchThreshold)]):
+            # Get the list of filled bunches (see bunchData.py for the parsing).
+            filledBunchesLumi.update(BunchData.fromStrings([row[9]]).bx.tolist())
+
+            nBunchLumi = len(filledBunchesLumi)
+            
+            # Now we successfully have the data, no point to keep going through the fill at this point
+            break
+        # end of loop over rows
     
         # If we successfully got data from this luminometer, don't bother with the other one(s). Otherwise
         # keep going.
         if (nBunchLumi != -1):
             break
     # end of loop over luminometers
-    print "Found",nBunchLumi,"bunches from luminometer data"
+    print("Found",nBunchLumi,"bunches from luminometer data")
 
     # Next let's take a look at the per-BX beam data and investigate any disagreements. Unlike above, let's go
-    # through the whole file just to make sure there aren't any discrepancies within the file.
+    # through the whole fill just to make sure there aren't any discrepancies within the fill. This goes through
+    # the brilcalc cache, so it's only fetched once.
 
-    beamFileName = "bxdata_"+str(fill)+"_beam.csv"
-    if not os.path.exists(beamFileName):
-        os.system("brilcalc beam --xing -f "+str(fill)+" -o "+beamFileName)
+    beamOutput = runBrilcalc(["beam", "--xing", "-f", str(fill)])
     
     filledBunchesBeam = set()
     nBunchBeam = -1
 
-    with open(beamFileName) as beamFile:
-        reader = csv.reader(beamFile, delimiter=',')
-        for row in reader:
-            if row[0][0] == '#':
-                continue
-
-            # Split up the individual BX data. Use the slice to drop the initial and final brackets.
-            if (row[4][0:2] == '[]'):
-                bxFields = []
-            else:
-                bxFields = row[4][1:-1].split(' ')
-
-            # Get the list of filled bunches. Note: for these purposes, we only care if both beam 1 and beam 2
-            # are filled over the threshold above.
-            thisFilledBunches = set()
-            for i in range(0, len(bxFields), 3):
-                if (float(bxFields[i+1]) > beamIntensityThreshold and float(bxFields[i+2]) > beamIntensityThreshold):
-                    thisFilledBunches.add(int(bxFields[i]))
-
-            if (nBunchBeam == -1):
-                nBunchBeam = len(thisFilledBunches)
-                filledBunchesBeam = thisFilledBunches
-            # Note: sometimes you'll have beam data after beam dump so we can cheerfully ignore those.
-            elif (nBunchBeam != len(thisFilledBunches)) and len(thisFilledBunches) != 0:
-                print "Warning: mismatch in number of colliding bunches in "+row[1]+":"+row[2]+" -- expected",nBunchBeam,"got",len(thisFilledBunches)
-                if len(thisFilledBunches - filledBunchesBeam) > 0:
-                    print "Extra bunches:",sorted(thisFilledBunches - filledBunchesBeam)
-                if len(filledBunchesBeam - thisFilledBunches) > 0:
-                    print "Missing bunches:",sorted(filledBunchesBeam - thisFilledBunches)
+    # The individual BX data for all of the rows at once (see bunchData.py). For the beam data, the triplets are
+    # the BX and the beam 1 and beam 2 intensities. For these purposes, we only care if both beam 1 and beam 2
+    # are filled over the threshold above.
+    rows = list(zip(beamOutput.strings(0), beamOutput.strings(1), beamOutput.strings(2))) if beamOutput is not None else []
+    beamBunches = beamOutput.bunches(4) if beamOutput is not None else BunchData.fromStrings([])
+    aboveThreshold = (beamBunches.delivered > beamIntensityThreshold) & (beamBunches.recorded > beamIntensityThreshold)
+    for i, row in enumerate(rows):
+        # Get the list of filled bunches.
+        first, last = beamBunches.offsets[i], beamBunches.offsets[i+1]
+        thisFilledBunches = set(beamBunches.bx[first:last][aboveThreshold[first:last]].tolist())
+
+        if (nBunchBeam == -1):
+            nBunchBeam = len(thisFilledBunches)
+            filledBunchesBeam = thisFilledBunches
+        # Note: sometimes you'll have beam data after beam dump so we can cheerfully ignore those.
+        elif (nBunchBeam != len(thisFilledBunches)) and len(thisFilledBunches) != 0:
+            print("Warning: mismatch in number of colliding bunches in "+row[1]+":"+row[2]+" -- expected",nBunchBeam,"got",len(thisFilledBunches))
+            if len(thisFilledBunches - filledBunchesBeam) > 0:
+                print("Extra bunches:",sorted(thisFilledBunches - filledBunchesBeam))
+            if len(filledBunchesBeam - thisFilledBunches) > 0:
+                print("Missing bunches:",sorted(filledBunchesBeam - thisFilledBunches))
 
     if (nBunchBeam == -1):
-        print "Error: failed to find number of bunches in beam data for fill",fill
+        print("Error: failed to find number of bunches in beam data for fill",fill)
     else:
-        print "Found",nBunchBeam,"colliding bunches in beam data for fill",fill
+        print("Found",nBunchBeam,"colliding bunches in beam data for fill",fill)
         if (filledBunchesBeam != filledBunchesLumi):
             extraBunchesBeam = filledBunchesBeam - filledBunchesLumi
             extraBunchesLumi = filledBunchesLumi - filledBunchesBeam
             if len(extraBunchesBeam) > 0:
-                print "Bunches in beam but not in lumi:",sorted(extraBunchesBeam)
+                print("Bunches in beam but not in lumi:",sorted(extraBunchesBeam))
             if len(extraBunchesLumi) > 0:
-                print "Bunches in lumi but not in beam:",sorted(extraBunchesLumi)
-            # print "All bunches in beam:", sorted(filledBunchesBeam)
-            # print "All bunches in lumi:", sorted(filledBunchesLumi)
+                print("Bunches in lumi but not in beam:",sorted(extraBunchesLumi))
+            # print("All bunches in beam:", sorted(filledBunchesBeam))
+            # print("All bunches in lumi:", sorted(filledBunchesLumi))
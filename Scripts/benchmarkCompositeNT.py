@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# benchmarkCompositeNT.py
+#
+# Times building a composite normtag (as done by makeCompositeNT.py) with the old per-lumisection
+# algorithm (expand every range into a list and call list.remove for each covered LS, rescanning the
+# whole composite for every input line) against the range sweep in normtag.py, using real normtag files,
+# and checks that both give the same lumisections and iovtags. Since the old algorithm is quadratic,
+# the default run range is one year (2018); use --minrun/--maxrun to change it.
+#
+# Example (from the top-level directory):
+# python3 Scripts/benchmarkCompositeNT.py -n normtag_hfet.json,normtag_pltzero.json,normtag_bcm1f.json,normtag_hfoc.json,normtag_dt.json
+
+import os
+import sys
+import time
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from normtag import Normtag, composite
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--normtaglist", default="normtag_hfet.json,normtag_pltzero.json,normtag_bcm1f.json,normtag_hfoc.json,normtag_dt.json",
+                    help="Comma-separated list of normtags in priority order")
+parser.add_argument("--minrun", default=314472, type=int, help="minimum run number to consider (default: 314472)")
+parser.add_argument("--maxrun", default=327561, type=int, help="maximum run number to consider (default: 327561)")
+parser.add_argument("--skip-old", action="store_true", help="only time the new algorithm")
+args = parser.parse_args()
+
+# This is the RemoveLSs from the old version of makeCompositeNT.py.
+def RemoveLSs(baseList,listToRM):
+    expandedBaseList=[]
+    for lsRange in baseList:
+        for iLS in range(lsRange[0],lsRange[1]+1):
+            expandedBaseList.append(iLS)
+    for lsRange in listToRM:
+        for iLS in range(lsRange[0],lsRange[1]+1):
+            if iLS in expandedBaseList:
+                expandedBaseList.remove(iLS)
+    condensedList=[]
+    lastLS=0
+    for iLS in expandedBaseList:
+        if iLS==expandedBaseList[0]:
+            condensedList.append([iLS,-1])
+        elif iLS-lastLS>1:
+            condensedList[-1][1]=lastLS
+            condensedList.append([iLS,-1])
+        if iLS==expandedBaseList[-1]:
+            condensedList[-1][1]=iLS
+        lastLS=iLS
+    return condensedList
+
+# And this is the main loop from the old version of makeCompositeNT.py.
+def oldComposite(parsedNormtags):
+    compositeNT=[]
+    filledRuns=[]
+    for parsed in parsedNormtags:
+        for line in parsed:
+            run=list(line[1].keys())[0]
+            lsRanges=line[1][run]
+            if int(run) > args.maxrun or int(run) < args.minrun:
+                continue
+            if not compositeNT:
+                compositeNT.append(line)
+            else:
+                iLine=0
+                for item in compositeNT:
+                    comRun=list(item[1].keys())[0]
+                    if comRun==run:
+                        lsRanges=RemoveLSs(lsRanges,item[1][run])
+                        if not lsRanges:
+                            break
+                    elif comRun>run:
+                        break
+                    iLine=iLine+1
+                if run not in filledRuns:
+                    compositeNT.insert(iLine,line)
+                elif lsRanges:
+                    for thisRange in reversed(lsRanges):
+                        compositeNT.insert(iLine,[line[0],{run:[thisRange]}])
+            filledRuns.append(run)
+    return compositeNT
+
+normtagslist = args.normtaglist.split(",")
+parsedNormtags = []
+for normtagfilename in normtagslist:
+    with open(normtagfilename) as f:
+        parsedNormtags.append(json.load(f))
+
+start = time.time()
+newNT = composite([Normtag.fromRecords(p, args.minrun, args.maxrun) for p in parsedNormtags])
+newTime = time.time() - start
+print("New (range sweep): %.3f s, %d records, %d lumisections" % (newTime, len(newNT.toRecords()), newNT.nLumiSections()))
+
+if not args.skip_old:
+    start = time.time()
+    oldNT = Normtag.fromRecords(oldComposite(parsedNormtags))
+    oldTime = time.time() - start
+    print("Old (per-LS lists): %.3f s, %d lumisections" % (oldTime, oldNT.nLumiSections()))
+    print("Speedup: %.0fx" % (oldTime/newTime))
+    if oldNT == newNT:
+        print("Both algorithms give identical results.")
+    else:
+        print("WARNING: the two algorithms give different results!")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# combineNormtags.py
+#
+# Evaluates a set expression over normtags and certification JSON files and writes out the result, for example:
+#
+# python3 Scripts/combineNormtags.py "(golden.json & normtag_hfet.json & normtag_pltzero.json) - normtag_dt.json" -o out.json
+#
+# The operators are & (intersection), | (union), and - (difference), with the same precedence as for Python sets
+# (- before & before |), and parentheses can be used for grouping. Since - can also appear in file names, it has
+# to have spaces around it to be treated as an operator. Remember to quote the expression so that the shell
+# doesn't interpret the &, |, and parentheses.
+#
+# The output is a certification JSON file by default, or a normtag with --normtag. In the normtag, each
+# lumisection gets the iovtag from the first normtag in the expression which covers it (not counting ones which
+# are only subtracted), so for example "golden.json & normtag_BRIL.json" gives the part of normtag_BRIL.json in
+# the golden JSON.
+#
+# The whole expression is evaluated in a single sweep over the LS ranges of all of the files (see combine in
+# normtag.py), so this replaces running intersectJSONNormtag.py several times with temporary files in between.
+
+import os
+import re
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from normtag import Normtag, CERT_IOVTAG, combine, writeNormtag, writeCertJSON
+
+parser = argparse.ArgumentParser()
+parser.add_argument("expression", nargs="+", help="Set expression to evaluate (in quotes)")
+parser.add_argument("-o", "--output", help="Output file (default: print to stdout)")
+parser.add_argument("-n", "--normtag", action="store_true", help="Write a normtag rather than a JSON file")
+args = parser.parse_args()
+
+# Parse the expression into a tree of ('file', index) and (operator, left, right) nodes. The files are numbered in
+# the order they first appear in the expression.
+class ExpressionParser:
+    def __init__(self, expression):
+        self.tokens = re.sub(r'([()&|])', r' \1 ', expression).split()
+        self.pos = 0
+        self.fileNames = []
+        self.tree = self.parseUnion()
+        if self.pos < len(self.tokens):
+            raise ValueError("unexpected '%s'" % self.tokens[self.pos])
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def parseBinary(self, operator, parseOperand):
+        tree = parseOperand()
+        while self.peek() == operator:
+            self.pos += 1
+            tree = (operator, tree, parseOperand())
+        return tree
+
+    def parseUnion(self):
+        return self.parseBinary('|', self.parseIntersection)
+
+    def parseIntersection(self):
+        return self.parseBinary('&', self.parseDifference)
+
+    def parseDifference(self):
+        return self.parseBinary('-', self.parseOperand)
+
+    def parseOperand(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("unexpected end of expression")
+        self.pos += 1
+        if token == '(':
+            tree = self.parseUnion()
+            if self.peek() != ')':
+                raise ValueError("missing ')'")
+            self.pos += 1
+            return tree
+        if token in [')', '&', '|', '-']:
+            raise ValueError("unexpected '%s'" % token)
+        if token not in self.fileNames:
+            self.fileNames.append(token)
+        return ('file', self.fileNames.index(token))
+
+# Whether the result covers an interval, given which files cover it.
+def evaluate(tree, covered):
+    if tree[0] == 'file':
+        return covered[tree[1]]
+    if tree[0] == '&':
+        return evaluate(tree[1], covered) and evaluate(tree[2], covered)
+    if tree[0] == '|':
+        return evaluate(tree[1], covered) or evaluate(tree[2], covered)
+    return evaluate(tree[1], covered) and not evaluate(tree[2], covered)
+
+# The files which can give their iovtag to the result, i.e. the ones which aren't only subtracted, in order.
+def tagSources(tree, positive=True):
+    if tree[0] == 'file':
+        return [tree[1]] if positive else []
+    return tagSources(tree[1], positive) + tagSources(tree[2], positive and tree[0] != '-')
+
+try:
+    expression = ExpressionParser(" ".join(args.expression))
+except ValueError as ex:
+    print("Error in expression:", ex.args[0])
+    sys.exit(1)
+
+normtags = [Normtag.fromFile(f) for f in expression.fileNames]
+sources = []
+for i in tagSources(expression.tree):
+    if i not in sources:
+        sources.append(i)
+result = combine(normtags, lambda covered: evaluate(expression.tree, covered), sources)
+
+if args.normtag and CERT_IOVTAG in result.iovtags():
+    print("Some of the lumisections in the result only come from JSON files, so they don't have an iovtag.")
+    print("Intersect the expression with a normtag, or leave out --normtag to write a JSON file.")
+    sys.exit(1)
+
+output = open(args.output, "w") if args.output else sys.stdout
+if args.normtag:
+    writeNormtag(result, output)
+else:
+    writeCertJSON(result.toCertJSON(), output)
+if args.output:
+    output.close()
+    print("Wrote %s: %d runs, %d lumisections" % (args.output, len(result), result.nLumiSections()))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# compactNormtag.py
+#
+# Compacts one or more normtag files. Contiguous ranges with the same iovtag are merged, all of the ranges with
+# the same iovtag in a run are put in a single record, and the records are sorted by run and first LS. This
+# does not change which iovtag is used for any lumisection, and the output is still one record per line, so it
+# can be used with brilcalc as before and diffs well in git. Files with overlapping ranges are not changed, since
+# which iovtag applies there depends on the order; these ranges are listed instead. (Duplicated ranges with the
+# same iovtag are fine and are simply merged, and reversed ranges, which don't cover anything, are dropped with a
+# warning.)
+#
+# By default the files are rewritten in place (or written to the file given with -o, if there is only one
+# input). With --check, nothing is written; the script just reports how much each file would shrink, and exits
+# with status 1 if any file is not already compact (e.g. for use in a pre-commit hook). Note that the size can
+# also go up slightly if the file wasn't written in the standard format (as writeFormattedJSON in
+# doFillValidation.py does) before.
+#
+# Note: doFillValidation.py appends one record per range, so normtag_BRIL.json and the individual luminometer
+# normtags will grow uncompacted ranges again after new fills are validated.
+
+import io
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from normtag import compactNormtag, writeNormtag
+
+parser = argparse.ArgumentParser()
+parser.add_argument("files", nargs="+", help="Normtag file(s) to compact")
+parser.add_argument("-o", "--output", help="Output file (only with a single input file; default: rewrite the input)")
+parser.add_argument("-c", "--check", action="store_true", help="Only report how much the files would shrink; don't write anything")
+args = parser.parse_args()
+
+if args.output and len(args.files) > 1:
+    print("-o can only be used with a single input file.")
+    sys.exit(1)
+
+status = 0
+for fileName in args.files:
+    with open(fileName) as jsonFile:
+        contents = jsonFile.read()
+    try:
+        records = json.loads(contents)
+        warnings = []
+        compacted = compactNormtag(records, warnings)
+    except ValueError as ex:
+        print("%s: can't compact:" % fileName)
+        print(str(ex))
+        status = 1
+        continue
+    for warning in warnings:
+        print("%s: warning: %s" % (fileName, warning))
+    output = io.StringIO()
+    writeNormtag(compacted, output)
+    newContents = output.getvalue()
+
+    if args.check:
+        if newContents == contents:
+            print("%s: already compact (%d records)" % (fileName, len(records)))
+        else:
+            print("%s: %d -> %d records, %d -> %d bytes (%+.1f%%)" %
+                  (fileName, len(records), len(compacted), len(contents), len(newContents),
+                   100.0*(len(newContents)-len(contents))/len(contents)))
+            status = 1
+        continue
+
+    outputFileName = args.output if args.output else fileName
+    if newContents == contents and outputFileName == fileName:
+        print("%s: already compact" % fileName)
+        continue
+    with open(outputFileName, 'w') as outputFile:
+        outputFile.write(newContents)
+    print("Wrote %s: %d -> %d records" % (outputFileName, len(records), len(compacted)))
+
+sys.exit(status)
@@ -1,14 +1,17 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import os, sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from brilcalcCache import runBrilcalc
+
 # This script compares the pattern of filled bunches in HF and PLT to see if either has shifted
 # from the expected pattern. By default, it will run over all 2017 fills, so you probably want
 # to direct the output to a file. You can also run over a subset of fills by specifying them
 # on the command line.
 
-# By default, this will save the output file after you're done, in case you need to do further
-# investigation. You can change this by uncommenting the last line.
+# The brilcalc output is kept in the brilcalc cache (see brilcalcCache.py), in case you need to do
+# further investigation, so running it again for the same fills doesn't need to run brilcalc again.
 
 # Luminometers to compare. The first one in this list will determine the reference pattern
 # and the others will be compared to it. Use hfet for 2017-18 and hfoc for 2015-16
@@ -80,35 +83,25 @@ for fill in fills:
 
     for luminometer in luminometerOrder:
         printedBunchPattern = False
-        print "Getting bunch data for "+luminometer+" fill "+fill+"...please wait..."
-        dataFile = "bxdata_"+fill+"_"+luminometer+".csv"
-
-        if not os.path.exists(dataFile):
-            os.system('brilcalc lumi --xing -b "STABLE BEAMS" -u hz/ub -f '+fill+' --type '+luminometer+' --xingTr '+str(bxThresh)+' -o '+dataFile)
-
-        print "Checking bunch data for "+luminometer+"..."
+        print("Getting bunch data for "+luminometer+" fill "+fill+"...please wait...")
+        output = runBrilcalc(["lumi", "--xing", "-b", "STABLE BEAMS", "-u", "hz/ub", "-f", fill, "--type", luminometer,
+                              "--xingTr", str(bxThresh)])
+        if output is None:
+            print("Failed to get bunch data for "+luminometer+" fill "+fill)
+            continue
+
+        print("Checking bunch data for "+luminometer+"...")
         
-        infile = open(dataFile, 'r')
-        for line in infile:
-            fields = line.split(',')
-            if (fields[0][0] == '#'):
-                continue # skip headers
-            
-            # Next, split up the individual BX data. Use the slice
-            # to drop the initial and final brackets.
-            filledBX = []
-            if (fields[9][0:2] == '[]'):
-                bxFields = []
-            else:
-                bxFields = fields[9][1:-1].split(' ')
-            avgLumi = 0
+        # The individual BX data for all of the lumisections at once (see bunchData.py).
+        bunches = output.bunches(9)
+
+        for i, fields in enumerate(zip(output.strings(0), output.strings(1))):
             # Find the filled BXes and the luminosity in them.
-            for i in range(0, len(bxFields), 3):
-                filledBX.append(int(bxFields[i]))
-                avgLumi += float(bxFields[i+1])
-            
+            bx, delivered, recorded = bunches.row(i)
+            filledBX = bx.tolist()
+            avgLumi = 0
             if len(filledBX) > 0:
-                avgLumi /= len(filledBX)
+                avgLumi = float(delivered.sum(dtype='float64')) / len(filledBX)
                 
             # If this is the first LS we've examined, store this as the reference BX pattern.
                 
@@ -117,13 +110,13 @@ for fill in fills:
                 shiftedTemplate = list(filledBXTemplate)
                 firstAvgLumi = avgLumi
                 if len(filledBX) > 0:
-                    print "Found",len(filledBX),"filled bunch crossings."
+                    print("Found",len(filledBX),"filled bunch crossings.")
 
             # Print out the full bunch pattern. This is really only useful when debugging fills
             # with small numbers of filled bunches, not so useful for 2200 bunch fills. Hence
             # the reason it's off by default.
             if False and not printedBunchPattern and len(filledBX) > 0:
-                print "Bunch pattern:",
+                print("Bunch pattern:", end=" ")
                 lastBunch = -9 # number of last filled bunches
                 trainCount = 0 # number of bunches in current train
                 for i in filledBX:
@@ -131,8 +124,8 @@ for fill in fills:
                         # Isolated/leading bunch
                         # Print out end of previous train, if we were in one
                         if (trainCount > 0):
-                            print "T"+str(trainCount),
-                        print str(i),
+                            print("T"+str(trainCount), end=" ")
+                        print(str(i), end=" ")
                         trainCount = 1
                     else:
                         # Train bunch
@@ -140,8 +133,8 @@ for fill in fills:
                     lastBunch = i
                 # Don't forget to finish the train we were working on at the end
                 if (trainCount > 0):
-                    print "T"+str(trainCount),
-                print
+                    print("T"+str(trainCount), end=" ")
+                print()
                 printedBunchPattern = True
 
             # Otherwise, see if this matches the reference BX pattern.
@@ -152,12 +145,12 @@ for fill in fills:
                     # to see if it decreased a lot. If so, a mismatch is pretty
                     # harmless.
                     if (avgLumi < firstAvgLumi*0.1):
-                        print "Probably harmless mismatch in "+luminometer+ " (much lower lumi) in run:fill "+fields[0]+" ls "+fields[1]
+                        print("Probably harmless mismatch in "+luminometer+ " (much lower lumi) in run:fill "+fields[0]+" ls "+fields[1])
                     else:
                         # Try to narrow down the cause a bit. Is it that the number of bunches has changed,
                         # or is there a shift present?
                         if (len(filledBXTemplate) != len(filledBX)):
-                            print "Mismatch in numBX "+luminometer+" run:fill "+fields[0]+" ls "+fields[1]+": expected "+str(len(filledBXTemplate))+" got "+str(len(filledBX))
+                            print("Mismatch in numBX "+luminometer+" run:fill "+fields[0]+" ls "+fields[1]+": expected "+str(len(filledBXTemplate))+" got "+str(len(filledBX)))
                         else:
                             # The number of bunches found is the same, but the individual bunches don't match up.
                             # Probably there is a shift. Let's see if we can find it.
@@ -180,11 +173,8 @@ for fill in fills:
                             # Now print out the shift if we found it.
                             if (foundShift == 0):
                                 # We can't recover the proper bunch pattern just by shifting it. Something more complex is going on...
-                                print "Non-simple shift in "+luminometer+ " run:fill "+fields[0]+" ls "+fields[1]
+                                print("Non-simple shift in "+luminometer+ " run:fill "+fields[0]+" ls "+fields[1])
                             else:
-                                print luminometer+ " appears to be shifted by "+str(foundShift)+" in run:fill "+fields[0]+" ls "+fields[1]
+                                print(luminometer+ " appears to be shifted by "+str(foundShift)+" in run:fill "+fields[0]+" ls "+fields[1])
 
-        # Finished processing this file
-        infile.close()
-        # Clean up the raw data file.
-        # os.remove(dataFile)
+        # Finished processing this luminometer
@@ -1,5 +1,7 @@
-import sys
+import os, sys
 import ROOT
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from lumiTable import readByLS, joinByLS
 ROOT.gROOT.SetBatch(ROOT.kTRUE)
 
 ##example calls to brilcalc
@@ -12,17 +14,13 @@ ROOT.gROOT.SetBatch(ROOT.kTRUE)
 
 
 
-def dictFromCSVFile(file):
-    lines=file.readlines()
-    dict={}
-    for line in lines:
-        try:
-            items=line.replace(':',',').split(",")
-            dict[(int(items[1]),int(items[0]),int(items[2]))]=[int(items[4]),float(items[8])]
-        except:
-            pass
-    print "read", file
-    return dict
+# Read a brilcalc --byls --tssec CSV file: the run and ls (packed into one key, see lumiTable.py), the fill, the
+# time, and the recorded luminosity of each lumisection.
+def readCSVFile(fileName):
+    with open(fileName) as file:
+        data=readByLS(file.read(), ["time", "recorded"])
+    print("read", fileName)
+    return data
 
 filename1=sys.argv[1]
 filename2=sys.argv[2]
@@ -38,7 +36,7 @@ for line in nbxfile.readlines():
         NBX=int(items[1])
         NBXPerFill[fill]=NBX
     except:
-        print "Problem with line",line
+        print("Problem with line",line)
 
 nbxfile.close()
 
@@ -46,11 +44,8 @@ nBX=1
 
 time0=0
 
-file1=open(filename1)
-file2=open(filename2)
-
-dict1=dictFromCSVFile(file1)
-dict2=dictFromCSVFile(file2)
+data1=readCSVFile(filename1)
+data2=readCSVFile(filename2)
 
 total1=0
 total2=0
@@ -58,10 +53,11 @@ total2=0
 total1PerFill={}
 total2PerFill={}
 
-overtlapKeys=list(set(dict1).intersection(dict2))
-overtlapKeys.sort()
+# Line up the lumisections which are in both files, in order of run and ls.
+overlap=joinByLS({"fill": (data1["key"], data1["fill"]), "time": (data1["key"], data1["time"]),
+                  "lumi1": (data1["key"], data1["recorded"]), "lumi2": (data2["key"], data2["recorded"])}, how="inner")
 
-#print len(dict1),len(dict2),len(overtlapKeys)
+#print(len(data1["key"]),len(data2["key"]),len(overlap))
 
 label=filename2.split("_")[0]+"/"+filename1.split("_")[0]
 combineNLS=15
@@ -104,45 +100,45 @@ ratioFill=ROOT.TGraphErrors()
 ratioRun.SetTitle(label+";Run;Ratio")
 ratioFill.SetTitle(label+";Fill;Ratio")
 
-for key in overtlapKeys:
+for key in zip(overlap["fill"].astype(int), overlap["run"], overlap["ls"], overlap["time"], overlap["lumi1"], overlap["lumi2"]):
     try:
-        if not total1PerFill.has_key(key[0]):
-            print "setting total to 0 for fill", key[0]
+        if key[0] not in total1PerFill:
+            print("setting total to 0 for fill", key[0])
             total1PerFill[key[0]]=0
             total2PerFill[key[0]]=0
         if iCount==1:
-            time0=dict1[key][0]
+            time0=key[3]
             currentFill=key[0]
             currentRun=key[1]
-        if abs(dict1[key][1]/dict2[key][1]-1)>.2:
+        if abs(key[4]/key[5]-1)>.2:
             newKey=(key[0],key[1])
             newKey=key[0]
-            if not ratioVsInst_perFill.has_key(newKey):
+            if newKey not in ratioVsInst_perFill:
                 ratioVsInst_perFill[newKey]=ROOT.TGraph()
                 iRatio=0
             if newKey not in baddies:
                 baddies[newKey]=1
             else:
                 baddies[newKey]=baddies[newKey]+1
-        if abs(dict1[key][1]/dict2[key][1]-1)>.5:
-            if not veryOffLS.has_key(key[1]):
+        if abs(key[4]/key[5]-1)>.5:
+            if key[1] not in veryOffLS:
                 veryOffLS[key[1]]=[]
-            veryOffLS[key[1]].append(key[2])]
-            print "50 % off",key, dict1[key][1], dict2[key][1]
+            veryOffLS[key[1]].append(key[2])
+            print("50 % off",key, key[4], key[5])
             continue
-        num=num+dict2[key][1]
-        den=den+dict1[key][1]
-        total2=total2+dict2[key][1]
-        total1=total1+dict1[key][1]
-        total1PerFill[key[0]]=total1PerFill[key[0]]+dict1[key][1]
-        total2PerFill[key[0]]=total2PerFill[key[0]]+dict2[key][1]
+        num=num+key[5]
+        den=den+key[4]
+        total2=total2+key[5]
+        total1=total1+key[4]
+        total1PerFill[key[0]]=total1PerFill[key[0]]+key[4]
+        total2PerFill[key[0]]=total2PerFill[key[0]]+key[5]
 
         if iCount%combineNLS==0:
             ratio.Fill(num/den)
             ratioNarrow.Fill(num/den)
             ratioNarrowRun.Fill(num/den)
             ratioNarrowFill.Fill(num/den)
-            ratioVsTime.SetPoint(iBin,dict1[key][0]-time0,num/den)
+            ratioVsTime.SetPoint(iBin,key[3]-time0,num/den)
             ratioVsInst.SetPoint(iBin,den/NBXPerFill[key[0]]/combineNLS,num/den)
             ratioVsInstProfile.Fill(den/NBXPerFill[key[0]]/combineNLS,num/den)
             ratioVsInst_perFill[newKey].SetPoint(iRatio, den/NBXPerFill[key[0]]/combineNLS,num/den)
@@ -154,19 +150,19 @@ for key in overtlapKeys:
             if currentRun != key[1]:
                 ratioRun.SetPoint(binRun,currentRun,ratioNarrowRun.GetMean())
                 if ratioNarrowRun.GetMean()>1.03 or ratioNarrowRun.GetMean()<0.97:
-                    print currentRun
+                    print(currentRun)
                 currentRun = key[1]
                 binRun = binRun + 1
                 if abs(1-ratioNarrowRun.GetMean()) >0.2:
-                    print "fill ",currentRun,"ratio is",ratioNarrowRun.GetMean()
+                    print("fill ",currentRun,"ratio is",ratioNarrowRun.GetMean())
                 ratioNarrowRun.Reset()
             if currentFill != key[0]:
-                print currentFill,total1PerFill[currentFill],total2PerFill[currentFill]
+                print(currentFill,total1PerFill[currentFill],total2PerFill[currentFill])
                 ratioFill.SetPoint(binFill,currentFill,ratioNarrowFill.GetMean())
                 currentFill = key[0]
                 binFill=binFill+1
                 if abs(1-ratioNarrowFill.GetMean()) >0.2:
-                    print "fill ",currentFill,"ratio is",ratioNarrowFill.GetMean()
+                    print("fill ",currentFill,"ratio is",ratioNarrowFill.GetMean())
                 ratioNarrowFill.Reset()
 
         iCount=iCount+1
@@ -175,11 +171,10 @@ for key in overtlapKeys:
         pass
 
 
-offRuns=veryOffLS.keys()
-offRuns.sort()
+offRuns=sorted(veryOffLS.keys())
 for run in offRuns:
     veryOffLS[run].sort()
-    print run,veryOffLS[run]
+    print(run,veryOffLS[run])
 
 
 ratioVsInst.GetYaxis().SetRangeUser(0.95,1.05)
@@ -201,7 +196,7 @@ fout.WriteTObject(can,filelabel+"_vsInstLumiPro.png")
 ratio.Draw()
 can.Update()
 ratioNarrow.Draw()
-print "binned ratio RMS",ratioNarrow.GetRMS()
+print("binned ratio RMS",ratioNarrow.GetRMS())
 can.Update()
 can.SaveAs(filelabel+"_binnedRatio.png")
 fout.WriteTObject(can,filelabel+"_binnedRatio.png")
@@ -234,7 +229,7 @@ for key_fill in ratioVsInst_perFill.keys():
         ip+=1
         line_Plot.GetXaxis().SetTitle("Fill Number")
     except:
-        print "give up"
+        print("give up")
 
 can.Update
 can.SetTickx()
@@ -255,7 +250,7 @@ ratioFill.Draw("APE")
 can.SaveAs(filelabel+"_ratioPerFill.png")
 
 line_hist_weighted.Draw("hist")
-print "mean slope, rms",line_hist_weighted.GetMean(),line_hist_weighted.GetRMS()
+print("mean slope, rms",line_hist_weighted.GetMean(),line_hist_weighted.GetRMS())
 can.SaveAs(filelabel+"_binnedLinearity.png")
 
 fout.WriteTObject(line_Plot,"line_Plot")
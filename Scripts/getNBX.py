@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
 import os, sys, csv, re
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from brilcalcCache import runBrilcalc, streamBrilcalc
+from bunchData import BunchData
 
 # This script gets the number of colliding bunches per fill. It gets this information from three separate
 # sources:
@@ -14,15 +19,18 @@ import os, sys, csv, re
 #
 # Ideally all of these will agree. The script will alert you if that is not the case.
 #
-# In a well-behaved world, you would just need to run this script once and it can automatically delete the
-# brilcalc output once it's done with it (deleteAfterProcessing flag below). However in practice I would
-# recommend keeping the brilcalc data (leave deleteAfterProcessing to false) because often it will take
-# several iterations to deal with more troublesome fills. So you can run it once, keep the data (warning: this
-# will take about 20G), and then go back and look at specific fills where the luminometer data has problems
-# (in most cases, you can fix these problems by raising the threshold below). Note that if you specify one or
-# more fills after the first argument on the command line, it will just look at those fills rather than all of
-# the fills in your csv. Once you've fixed all the issues in individual fills, you can run it again for all
-# the data to get a (hopefully relatively clean) final output (just grep for the lines with commas and use those).
+# Often it will take several iterations to deal with more troublesome fills. So you can run it once, and then go
+# back and look at specific fills where the luminometer data has problems (in most cases, you can fix these
+# problems by raising the threshold below). Note that if you specify one or more fills after the first argument
+# on the command line, it will just look at those fills rather than all of the fills in your csv. Once you've
+# fixed all the issues in individual fills, you can run it again for all the data to get a (hopefully
+# relatively clean) final output (just grep for the lines with commas and use those).
+#
+# The per-bunch luminosity is read directly from brilcalc as it runs, and brilcalc is stopped as soon as we have
+# the lumisections we need (see streamBrilcalc in brilcalcCache.py), so the full --xing output for each fill
+# (about 20G in total) is never fetched. The lumisections which were read, and the beam data, are kept in the
+# brilcalc cache, so rerunning for the same fills with the same thresholds doesn't need brilcalc at all, and
+# Scripts/NBX/investigateBXLumiDiffs.py can look at the same data afterwards.
 #
 # Note: use hfoc for 2015-16 and hfet for 2017-2018 below.
 
@@ -33,9 +41,6 @@ defaultLuminometerList = ["hfet", "pltzero"]
 # This threshold may also get changed -- also below
 defaultBunchThreshold = 0.1
 
-# Whether or not to delete the brilcalc output ater processing.
-deleteAfterProcessing = False
-
 # Heavy ion fills. These are treated differently below. Note that for now we only have the 2018 HI fills here.
 heavyIonFills = [[7427, 7492]]
 luminometerListHI = ["pltzero", "hfoc"]
@@ -98,7 +103,7 @@ veryLowFills = [3846, 3847, 7299]
 # Read the WBM CSV file. This will also define the list of fills that we check against the other sources.
 
 if len(sys.argv) < 2:
-    print "Usage: "+sys.argv[0]+" CSVFile [fills]"
+    print("Usage: "+sys.argv[0]+" CSVFile [fills]")
     sys.exit(0)
 
 fillList = []
@@ -114,7 +119,7 @@ with open(sys.argv[1]) as csvFile:
         targetNBunch = int(row[21])
         fillList.append(thisFill)
 #        if (thisNBunch != targetNBunch):
-#            print "Warning: for fill",thisFill,"number of colliding bunches =",thisNBunch,"but expected",targetNBunch,"from filling scheme"
+#            print("Warning: for fill",thisFill,"number of colliding bunches =",thisNBunch,"but expected",targetNBunch,"from filling scheme")
         nBunchWBM[thisFill] = thisNBunch
         nBunchWBMTarget[thisFill] = targetNBunch
 
@@ -142,9 +147,9 @@ with open(sys.argv[1]) as csvFile:
             elif fillingScheme.find("Multi_525ns_152_150_0_0_8bpi_19inj") >= 0:
                 nBunchFromScheme = 150
             else:
-                print "Failed to parse filling scheme",fillingScheme
+                print("Failed to parse filling scheme",fillingScheme)
         if int(nBunchFromScheme) != targetNBunch:
-            print "Warning: for fill",thisFill,"WBM target bunches =",targetNBunch,"but filling scheme specifies",nBunchFromScheme
+            print("Warning: for fill",thisFill,"WBM target bunches =",targetNBunch,"but filling scheme specifies",nBunchFromScheme)
 
 # If an individual fill (or fills) is/are specified on the command line, use those instead
 if (len(sys.argv) > 2):
@@ -169,30 +174,20 @@ for fill in fillList:
                 luminometerList[i] = alternateLuminometer[fill][luminometerList[i]]
             
     # Get the number of colliding bunches from the beam information.
-    beamFileName = "temp_beam_"+str(fill)+".csv"
-    if not os.path.exists(beamFileName):
-        os.system("brilcalc beam -f "+str(fill)+" -o "+beamFileName)
-    
-    nBunchBeam = -1
-    with open(beamFileName) as beamFile:
-        reader = csv.reader(beamFile, delimiter=',')
-        for row in reader:
-            if row[0][0] == '#':
-                continue
+    beamOutput = runBrilcalc(["beam", "-f", str(fill)])
 
-            nBunchThisRow = int(row[7])
-            if (nBunchBeam == -1):
-                nBunchBeam = nBunchThisRow
-            else:
-                if (nBunchBeam != nBunchThisRow):
-                    print "Warning: number of colliding bunches changed during fill",fill
+    nBunchBeam = -1
+    for row in (beamOutput.rows() if beamOutput is not None else []):
+        nBunchThisRow = int(row[7])
+        if (nBunchBeam == -1):
+            nBunchBeam = nBunchThisRow
+        else:
+            if (nBunchBeam != nBunchThisRow):
+                print("Warning: number of colliding bunches changed during fill",fill)
 
     if (nBunchBeam == -1):
-        print "Error: failed to find number of bunches in beam data for fill",fill
-    # print "Found",nBunchBeam,"colliding bunches in beam data for fill",fill
-
-    if (deleteAfterProcessing):
-        os.remove(beamFileName)
+        print("Error: failed to find number of bunches in beam data for fill",fill)
+    # print("Found",nBunchBeam,"colliding bunches in beam data for fill",fill)
 
     # Get the number of colliding bunches from the luminometers.
     # This code is taken from compareBXPatterns.py but is much simpler since it only
@@ -214,80 +209,62 @@ for fill in fillList:
         if luminometer in differentThreshold and fill in differentThreshold[luminometer]:
             bunchThreshold = differentThreshold[luminometer][fill]
 
-        filledBunches = set()
-        dataFileName = "bxdata_"+str(fill)+"_"+luminometer+".csv"
-        
-        if not os.path.exists(dataFileName):
-            os.system('brilcalc lumi --xing -b "STABLE BEAMS" -u hz/ub -f '+str(fill)+' --type '+luminometer+' --xingTr '+str(bunchThreshold)+' -o '+dataFileName)
-
-        nlines = 0
-        with open(dataFileName) as dataFile:
-            reader = csv.reader(dataFile, delimiter=',')
-            for row in reader:
-                if row[0][0] == '#':
-                    continue
-
-                # To save time and annoyance, just consider the first 25 lines of the file, since presumably
-                # any differences in the rest of the file are due to either (a) specific luminometer issues
-                # (which we don't really care about for this purpose) or (b) a bunch decaying faster than its
-                # companions (which can happen but we can't really account for that in our simple total so
-                # let's not worry about it). For the aggregated method we may need more lines, however.
-                if (nlines > 25 and fill not in veryLowFills) or nlines > 500:
-                    break
-
-                # Next, split up the individual BX data. Use the slice
-                # to drop the initial and final brackets.
-                thisNBunch = 0
-                if len(row) < 9:
-                    print row
-                # If there's no data at all, just skip this row. We'll get an accurate count once we get data.
-                if (row[9][0:2] == '[]'):
-                    bxFields = []
-                    continue
-                else:
-                    bxFields = row[9][1:-1].split(' ')
-                avgLumi = 0
-
-                nlines += 1
-
-                if not (fill in veryLowFills):
-                    # "Regular" method: look at the filled BXes LS-by-LS
-
-                    # Find the filled BXes and the luminosity in them.
-                    for i in range(0, len(bxFields), 3):
-                        thisNBunch += 1
-                        avgLumi += float(bxFields[i+1])
-
-                    if thisNBunch > 0:
-                        avgLumi /= thisNBunch
-
-                    # If this is the first LS we've examined, store this as the number of BXes.
-                    if (nBunchLumi == -1):
-                        nBunchLumi = thisNBunch
-                        firstAvgLumi = avgLumi
-                        # print "Found",nBunchLumi,"filled bunch crossings in",luminometer
-
-                    # Otherwise, see if this matches the number we were expecting.
-                    else:
-                        if (thisNBunch != nBunchLumi):
-                            # Maybe the fill dropped a little before the STABLE BEAMS
-                            # flag cleared, or we're in a miniscan. Check the average lumi
-                            # to see if it decreased a lot. If so, a mismatch is pretty
-                            # harmless.
-                            if (avgLumi < firstAvgLumi*0.1):
-                                # print "Probably harmless mismatch in "+luminometer+ " (much lower lumi) in run:fill "+row[0]+" ls "+row[1]
-                                pass
-                            else:
-                                print "Mismatch in numBX "+luminometer+" run:fill "+row[0]+" ls "+row[1]+": expected",nBunchLumi,"got",thisNBunch
-                    # end of if statement above
+        # To save time and annoyance, just consider the first 25 lines of the output, since presumably
+        # any differences in the rest of the file are due to either (a) specific luminometer issues
+        # (which we don't really care about for this purpose) or (b) a bunch decaying faster than its
+        # companions (which can happen but we can't really account for that in our simple total so
+        # let's not worry about it). For the aggregated method we may need more lines, however.
+        # If there's no data at all in a row, just skip it. We'll get an accurate count once we get data.
+        maxLines = 501 if fill in veryLowFills else 26
+        rows = []
+        for row in streamBrilcalc(["lumi", "--xing", "-b", "STABLE BEAMS", "-u", "hz/ub", "-f", str(fill), "--type", luminometer,
+                                   "--xingTr", str(bunchThreshold)]):
+            if len(row) < 10:
+                print(row)
+                continue
+            if row[9][0:2] == '[]':
+                continue
+            rows.append(row)
+            if len(rows) >= maxLines:
+                break
+
+        # Split up the individual BX data for all of the rows at once (see bunchData.py).
+        bunches = BunchData.fromStrings(row[9] for row in rows)
+
+        if not (fill in veryLowFills):
+            # "Regular" method: look at the filled BXes LS-by-LS
+
+            # Find the number of filled BXes and the average luminosity in them (the empty rows were skipped
+            # above, so every row has at least one).
+            nBunches = bunches.counts()
+            avgLumis = numpy.zeros(len(bunches))
+            if len(bunches) > 0:
+                avgLumis = numpy.add.reduceat(bunches.delivered.astype(numpy.float64), bunches.offsets[:-1]) / nBunches
+
+            for row, thisNBunch, avgLumi in zip(rows, nBunches, avgLumis):
+                # If this is the first LS we've examined, store this as the number of BXes.
+                if (nBunchLumi == -1):
+                    nBunchLumi = thisNBunch
+                    firstAvgLumi = avgLumi
+                    # print("Found",nBunchLumi,"filled bunch crossings in",luminometer)
+
+                # Otherwise, see if this matches the number we were expecting.
                 else:
-                    # "Alternate" method: aggregate filled bunches over all (first 25) lumisections
-                    # Store the filled BX number
-                    for i in range(0, len(bxFields), 3):
-                        filledBunches.add(bxFields[i])
-
-            # end of loop over rows
-        # end of file read
+                    if (thisNBunch != nBunchLumi):
+                        # Maybe the fill dropped a little before the STABLE BEAMS
+                        # flag cleared, or we're in a miniscan. Check the average lumi
+                        # to see if it decreased a lot. If so, a mismatch is pretty
+                        # harmless.
+                        if (avgLumi < firstAvgLumi*0.1):
+                            # print("Probably harmless mismatch in "+luminometer+ " (much lower lumi) in run:fill "+row[0]+" ls "+row[1])
+                            pass
+                        else:
+                            print("Mismatch in numBX "+luminometer+" run:fill "+row[0]+" ls "+row[1]+": expected",nBunchLumi,"got",thisNBunch)
+                # end of if statement above
+        else:
+            # "Alternate" method: aggregate filled bunches over all (first 500) lumisections
+            # Store the filled BX numbers
+            filledBunches = set(int(bx) for bx in bunches.filledBX())
 
         # If we're using the alternate method, look at the total number of bunches.
         if (fill in veryLowFills):
@@ -296,19 +273,16 @@ for fill in fillList:
                 refFilledBunches = set(filledBunches)
                 nBunchLumi = thisNBunch
             elif (thisNBunch != nBunchLumi):
-                print "Mismatch in aggregated numBX "+luminometer+": expected",nBunchLumi,"got",thisNBunch,"missing",refFilledBunches-filledBunches
+                print("Mismatch in aggregated numBX "+luminometer+": expected",nBunchLumi,"got",thisNBunch,"missing",refFilledBunches-filledBunches)
 
-        # Clean up the raw data file.
-        if deleteAfterProcessing:
-            os.remove(dataFileName)
     
     # end of loop over luminometers
-    # print "Found",nBunchLumi,"bunches from luminometer data"
+    # print("Found",nBunchLumi,"bunches from luminometer data")
 
     # OK finally we have all the information. Now let's see if it agrees.
     if (nBunchWBM[fill] == nBunchBeam and nBunchWBM[fill] == nBunchLumi):
-        print "Fill",fill,"has",nBunchWBM[fill],"colliding bunches"
+        print("Fill",fill,"has",nBunchWBM[fill],"colliding bunches")
     else:
-        print "Error: for fill",fill,"WBM reports",nBunchWBM[fill],"beam reports",nBunchBeam,"and luminometers report",nBunchLumi,"colliding bunches"
-    print str(fill)+","+str(nBunchWBMTarget[fill])+","+str(nBunchWBM[fill])+","+str(nBunchBeam)+","+str(nBunchLumi)
+        print("Error: for fill",fill,"WBM reports",nBunchWBM[fill],"beam reports",nBunchBeam,"and luminometers report",nBunchLumi,"colliding bunches")
+    print(str(fill)+","+str(nBunchWBMTarget[fill])+","+str(nBunchWBM[fill])+","+str(nBunchBeam)+","+str(nBunchLumi))
     sys.stderr.write("Finished fill "+str(fill)+"\n")
@@ -1,8 +1,11 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
+import os
 import sys
 import argparse
-import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from normtag import Normtag, composite, writeNormtag
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-n", "--normtaglist", help="Comma-separated list of normtag (e.g. 'nt1.json,nt2.json')")
@@ -12,114 +15,28 @@ parser.add_argument("--maxrun", default=1e7, type=int, help="maximum run number
 
 args=parser.parse_args()
 
-# both args are list of lists where each list is a range of LSs
-def RemoveLSs(baseList,listToRM):
-    expandedBaseList=[]
-    #print "baseList",baseList
-    #print "listToRM",listToRM
-    for lsRange in baseList:
-        for iLS in range(lsRange[0],lsRange[1]+1):
-            expandedBaseList.append(iLS)
-    
-    #print "added all",expandedBaseList
-    for lsRange in listToRM:
-        for iLS in range(lsRange[0],lsRange[1]+1):
-            if iLS in expandedBaseList:
-                expandedBaseList.remove(iLS)
-
-    #print "removed some",expandedBaseList
-    
-    condensedList=[]
-    lastLS=0
-    for iLS in expandedBaseList:
-        if iLS==expandedBaseList[0]:
-            condensedList.append([iLS,-1])
-        elif iLS-lastLS>1:
-            condensedList[-1][1]=lastLS
-            condensedList.append([iLS,-1])
-
-        if iLS==expandedBaseList[-1]:
-            condensedList[-1][1]=iLS
-        lastLS=iLS
-
-    #print condensedList
-    return condensedList
-
 normtagslist=args.normtaglist.split(",")
 
 rankAlgo="Default"
-print "This script will fill a new normtag with the contents of the given normtags."
+print("This script will fill a new normtag with the contents of the given normtags.")
 if rankAlgo == "Default":
-    print "The default ranking algo gives highest priority to the first normtag in the list and lowest priority to the last normtag in the list."
-
-
-print normtagslist
-
-normtags={}
+    print("The default ranking algo gives highest priority to the first normtag in the list and lowest priority to the last normtag in the list.")
 
+print(normtagslist)
 
+normtags=[]
 for normtagfilename in normtagslist:
-    ntfile=open(normtagfilename)
-    normtags[normtagfilename]=json.load(ntfile)
-
-
-compositeNT=[]
-filledRuns=[]
+    normtags.append(Normtag.fromFile(normtagfilename, args.minrun, args.maxrun))
 
 if rankAlgo=="Default":
-    print "go through NTs in the order received"
-    print "fill in new list with luminometers if run,ls not covered"
-    for normtagfilename in normtagslist:
-        for line in normtags[normtagfilename]:
-            run=line[1].keys()[0]
-            lsRanges=line[1][line[1].keys()[0]]
-            if int(run) > args.maxrun or int(run) < args.minrun:
-                #print "run",run,args.maxrun,args.minrun,int(run) > args.maxrun, int(run) < args.minrun,int(run) > args.maxrun or int(run) < args.minrun
-                continue
-            if not compositeNT:
-                compositeNT.append(line)
-            else:
-                #print "find run in list--search whole list--run could be in more than one line"
-                iLine=0
-                for item in compositeNT:
-                    comRun=item[1].keys()[0]
-                    #print "if run found remove all LSs already covered"
-                    if comRun==run:
-                        #print "in com",item
-                        #print "to be included",line    
-                        lsRanges=RemoveLSs(lsRanges,item[1][run])
-                        if not lsRanges:
-                            break
-                    elif comRun>run:
-                        break
-                    iLine=iLine+1
-                if run not in filledRuns:
-                    compositeNT.insert(iLine,line)
-                elif lsRanges:
-                    # If there's multiple ranges, break them down into individual entries so we can sort them properly later.
-                    for thisRange in reversed(lsRanges):
-                        newDict={}
-                        newDict[run]=[thisRange]
-                        compositeNT.insert(iLine,[line[0],newDict])
-                
-            filledRuns.append(run)
-
-
-# Sort the final NT so that everything appears in the proper order. Two steps: first sort by first lumisection
-# number and then by run.
-compositeNT.sort(key=lambda x: x[1].values()[0][0][0])
-compositeNT.sort(key=lambda x: int(x[1].keys()[0]))
-
-outputFile=open(args.outputfile,"w")
-outputFile.write("[\n")
-for line in compositeNT:
-    #schade... ths simple way can't be decoded
-    #outputFile.write(str(line))
-    # example line:    ["hfoc16v1",{"271037":[[1,15]]}],
-    outputFile.write("[\""+str(line[0])+"\", {\""+str(line[1].keys()[0])+"\": "+str(line[1][line[1].keys()[0]])+"}]")
-    if line != compositeNT[-1]:
-        outputFile.write(",\n")
-        
-outputFile.write("\n]\n")
-outputFile.close()
-print "Wrote new normtag to",args.outputfile
+    print("go through NTs in the order received")
+    print("fill in new list with luminometers if run,ls not covered")
+    # This is a single sweep over the sorted LS ranges of all of the normtags at once, taking the first
+    # normtag that covers each range, so there's no need to expand the ranges into individual lumisections.
+    compositeNT=composite(normtags)
+
+# The output is already sorted by run and then by first lumisection, with one range per line, e.g.
+#    ["hfoc16v1", {"271037": [[1, 15]]}],
+with open(args.outputfile,"w") as outputFile:
+    writeNormtag(compositeNT, outputFile)
+print("Wrote new normtag to",args.outputfile)
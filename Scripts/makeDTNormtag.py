@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # This script makes the 2018 DT normtag. This is necessary because the DT normtag includes a constant factor
 # for background subtraction but the way this is implemented in brilcalc means that it needs to be divided by
@@ -6,11 +6,18 @@
 #
 # For dt18v2: rescale by 1/1.0417 in all areas except for fills 7005-7065 which are rescaled by 1/1.021 instead
 # For dt18PAS: additional rescale by 1/0.9976
+#
+# The number of colliding bunches and the first run of each fill come from the local fill metadata mirror (see
+# fillmeta.py), so run python3 fillmeta.py sync first if you haven't yet.
+
+import os, sys
+import calendar
 
-import csv
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import fillmeta
 
-fill_info_file = "/afs/cern.ch/user/p/plujan/FillInformation/Run2FillData.csv"
 start_fill = 6570
+end_time = calendar.timegm((2019, 1, 1, 0, 0, 0))
 
 sigmavis_base = 182981
 background = 210
@@ -18,31 +25,33 @@ orbit_freq = 1/(3564*24.95e-9)
 
 last_nbx = -1
 
-with open(fill_info_file) as fill_info:
-    reader = csv.reader(fill_info, delimiter=',')
-    for row in reader:
-        if row[1] == "nbx":
-            continue
-
-        fill = int(row[0])
-        if fill < start_fill:
-            continue
-
-        scale_factor = 1.0417
-        if (fill >= 7005 and fill <= 7065):
-            scale_factor = 1.021
-        scale_factor *= 0.9976
-
-        sigmavis = sigmavis_base*scale_factor
-        a1 = orbit_freq/sigmavis
-        a0 = -a1*background
-
-        nbx = int(row[1])
-        start_run = int(row[4])
-
-        if (nbx != last_nbx or fill == 7005 or fill == 7069):
-            print "    - %d:" % (start_run)
-            print "        func: poly1d"
-            print "        payload: {'coefs': '%.5f, %.5f'}" % (a1, a0/nbx)
-            print "        comments: fill %d, sigmavis %.0f, background %d, nbx %d" % (fill, sigmavis, background, nbx)
-        last_nbx = nbx
+try:
+    fills = fillmeta.fillInfo(start_fill)
+except IOError as ex:
+    print("Error:", ex)
+    sys.exit(1)
+
+for info in fills:
+    # only the 2018 proton physics fills with STABLE BEAMS
+    if info["start"] >= end_time or info["amodetag"] != "PROTPHYS" or not info["stableRuns"]:
+        continue
+    fill = info["fill"]
+
+    scale_factor = 1.0417
+    if (fill >= 7005 and fill <= 7065):
+        scale_factor = 1.021
+    scale_factor *= 0.9976
+
+    sigmavis = sigmavis_base*scale_factor
+    a1 = orbit_freq/sigmavis
+    a0 = -a1*background
+
+    nbx = info["nbx"]
+    start_run = info["stableRuns"][0]
+
+    if (nbx != last_nbx or fill == 7005 or fill == 7069):
+        print("    - %d:" % (start_run))
+        print("        func: poly1d")
+        print("        payload: {'coefs': '%.5f, %.5f'}" % (a1, a0/nbx))
+        print("        comments: fill %d, sigmavis %.0f, background %d, nbx %d" % (fill, sigmavis, background, nbx))
+    last_nbx = nbx
@@ -3,10 +3,14 @@
 # This script will take a normtag file and produce a JSON file containing the list of lumisections covered by
 # that normtag, so you can use it in, for example, the -i input to brilcalc.
 
+import os
 import json
 import sys
 import argparse
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from normtag import checkRecord
+
 parser = argparse.ArgumentParser()
 parser.add_argument("normtag_file", help="Input normtag file")
 parser.add_argument("json_file", help="Output JSON file")
@@ -18,18 +22,15 @@ with open(args.normtag_file) as normtag_input:
 output_lumisections = {}
 
 for i in parsed_normtag:
-    if len(i[1].keys()) != 1:
-        print "Error: malformed entry", i
+    if checkRecord(i):
+        print("Error: malformed entry", i, "("+checkRecord(i)+")")
         sys.exit(1)
-    run = i[1].keys()[0]
+    run = list(i[1].keys())[0]
     lumis = i[1][run]
     
     for lsrange in lumis:
-        if len(lsrange) != 2:
-            print "Error: malformed entry", i
-            sys.exit(1)
         if lsrange[1] < lsrange[0]:
-            print "Error: malformed entry",i
+            print("Error: malformed entry", i)
         # if this run isn't yet in the output, add it there
         if run not in output_lumisections:
             output_lumisections[run] = [lsrange]
@@ -45,4 +46,4 @@ for i in parsed_normtag:
 
 with open(args.json_file, "w") as json_output:
     json.dump(output_lumisections, json_output, sort_keys=True)
-print "Output written to "+args.json_file+"."
+print("Output written to "+args.json_file+".")
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+# makeNormtagSidecar.py
+#
+# Creates (or updates) the binary sidecar files for one or more normtag or certification JSON files. Once a
+# sidecar exists, Normtag.fromFile() in normtag.py reads it instead of re-parsing the JSON, and it is
+# automatically rebuilt whenever the JSON file changes. See normtag.py for the format. Use --remove to delete
+# the sidecars again.
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from normtag import writeSidecar, sidecarFileNames
+
+parser = argparse.ArgumentParser()
+parser.add_argument("files", nargs="+", help="Normtag or certification JSON file(s)")
+parser.add_argument("--remove", action="store_true", help="Remove the sidecar files instead of creating them")
+args = parser.parse_args()
+
+for fileName in args.files:
+    if args.remove:
+        for sidecarName in sidecarFileNames(fileName):
+            if os.path.exists(sidecarName):
+                os.unlink(sidecarName)
+        print("Removed sidecar for", fileName)
+        continue
+    try:
+        rows, iovtags = writeSidecar(fileName)
+    except ValueError as ex:
+        print("Couldn't make sidecar for", fileName+":", ex.args[0])
+        continue
+    print("Wrote sidecar for %s: %d ranges, %d iovtags, %d bytes" %
+          (fileName, len(rows), len(iovtags), sum(os.path.getsize(f) for f in sidecarFileNames(fileName))))
@@ -18,7 +18,7 @@ try:
         l = entry[0]
         if l not in normtag_ls:
             normtag_ls[l] = 0
-        runs = entry[1].keys()
+        runs = list(entry[1].keys())
         assert(len(runs) == 1)
         run = runs[0]
         # Count the number of lumisections in each range specified and add them to the total.
@@ -26,7 +26,7 @@ try:
             normtag_ls[l] += run_range[1] - run_range[0] + 1
 
 except:
-    print "Something went wrong in parsing the input normtag file. Please check the file."
+    print("Something went wrong in parsing the input normtag file. Please check the file.")
     sys.exit(1)
 
 tot_ls = 0
@@ -34,4 +34,4 @@ for l in normtag_ls:
     tot_ls += normtag_ls[l]
 
 for l in normtag_ls:
-    print "%s: %d/%d (%.2f%%)" % (l, normtag_ls[l], tot_ls, 100.0*normtag_ls[l]/tot_ls)
+    print("%s: %d/%d (%.2f%%)" % (l, normtag_ls[l], tot_ls, 100.0*normtag_ls[l]/tot_ls))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# normtagDiff.py
+#
+# Compares two normtags (or certification JSON files) and reports, in both directions, the lumisection ranges
+# which were added (only in the second), removed (only in the first), or retagged (a different iovtag), with the
+# number of lumisections in each category per run, per fill, and overall. The comparison is done on LS ranges
+# (see diffNormtags in normtag.py), so two full-year files take well under a second.
+#
+# Either file can also be given as a git revision and path, e.g. to see what the last commit changed:
+# python3 Scripts/normtagDiff.py HEAD~1:normtag_BRIL.json normtag_BRIL.json
+#
+# To group the results by fill, the run -> fill mapping is needed. Either give a brilcalc CSV output file which
+# covers the runs (any brilcalc lumi output with the run:fill column) with --fills, or use --brilcalc to get it
+# from brilcalc directly. Otherwise the results are just grouped by run.
+#
+# With -j, the results are also written to a JSON file (- for stdout) in the form:
+# {"summary": {"added": N, "removed": N, "retagged": N},
+#  "fills": {"FILL": {"added": N, ...}, ...},
+#  "runs": {"RUN": {"fill": FILL, "added": [[first, last, iovtag], ...], "removed": [[first, last, iovtag], ...],
+#                   "retagged": [[first, last, oldIovtag, newIovtag], ...], "counts": {"added": N, ...}}, ...}}
+
+import os
+import sys
+import csv
+import json
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from normtag import Normtag, diffNormtags, formatRanges
+
+parser = argparse.ArgumentParser()
+parser.add_argument("old", help="First (old) normtag file, or REVISION:path for a version in git")
+parser.add_argument("new", help="Second (new) normtag file, or REVISION:path for a version in git")
+parser.add_argument("-j", "--json", help="Also write the results as JSON to this file (- for stdout only)")
+group = parser.add_mutually_exclusive_group()
+group.add_argument("--fills", help="brilcalc CSV output file with the run:fill column, to group the results by fill")
+group.add_argument("--brilcalc", action="store_true", help="Run brilcalc to get the fill for each run")
+args = parser.parse_args()
+
+categories = ["added", "removed", "retagged"]
+
+def readNormtag(name):
+    if os.path.exists(name) or ":" not in name:
+        return Normtag.fromFile(name)
+    parsed = json.loads(subprocess.check_output(["git", "show", name]))
+    if isinstance(parsed, dict):
+        return Normtag.fromCertJSON(parsed)
+    return Normtag.fromRecords(parsed)
+
+# Read the run -> fill mapping from brilcalc CSV output.
+def readFills(fileName):
+    runFills = {}
+    with open(fileName) as csvFile:
+        for row in csv.reader(csvFile):
+            if not row or row[0].startswith("#"):
+                continue
+            run, fill = row[0].split(":")
+            runFills[int(run)] = int(fill)
+    return runFills
+
+diff = diffNormtags(readNormtag(args.old), readNormtag(args.new))
+
+runFills = {}
+if args.fills:
+    runFills = readFills(args.fills)
+elif args.brilcalc and diff:
+    tempFile = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+    tempFile.close()
+    subprocess.check_call(["brilcalc", "lumi", "--begin", str(min(diff)), "--end", str(max(diff)), "-o", tempFile.name])
+    runFills = readFills(tempFile.name)
+    os.unlink(tempFile.name)
+
+summary = dict((c, 0) for c in categories)
+fills = {}
+runs = {}
+for run in sorted(diff):
+    fill = runFills.get(run)
+    runResult = {"fill": fill, "added": [], "removed": [], "retagged": []}
+    for first, last, oldTag, newTag in diff[run]:
+        if oldTag is None:
+            runResult["added"].append([first, last, newTag])
+        elif newTag is None:
+            runResult["removed"].append([first, last, oldTag])
+        else:
+            runResult["retagged"].append([first, last, oldTag, newTag])
+    runResult["counts"] = dict((c, sum(r[1] - r[0] + 1 for r in runResult[c])) for c in categories)
+    runs[str(run)] = runResult
+    for c in categories:
+        summary[c] += runResult["counts"][c]
+    if runFills:
+        fillCounts = fills.setdefault(str(fill) if fill is not None else "unknown", dict((c, 0) for c in categories))
+        for c in categories:
+            fillCounts[c] += runResult["counts"][c]
+
+def formatCounts(counts):
+    return ", ".join("%d %s" % (counts[c], c) for c in categories)
+
+def formatTagged(ranges):
+    # group consecutive ranges with the same iovtag(s) for printing
+    groups = []
+    for r in ranges:
+        if groups and groups[-1][0] == r[2:]:
+            groups[-1][1].append(r[:2])
+        else:
+            groups.append((r[2:], [r[:2]]))
+    return "; ".join(formatRanges(lsRanges) + " (" + " -> ".join(tags) + ")" for tags, lsRanges in groups)
+
+if args.json != "-":
+    lastFill = -1
+    for run in sorted(diff):
+        runResult = runs[str(run)]
+        if runFills and runResult["fill"] != lastFill:
+            fillKey = str(runResult["fill"]) if runResult["fill"] is not None else "unknown"
+            print("Fill %s: %s" % (fillKey, formatCounts(fills[fillKey])))
+            lastFill = runResult["fill"]
+        print("  Run %d:" % run)
+        for c in categories:
+            if runResult[c]:
+                print("    %s: %s" % (c, formatTagged(runResult[c])))
+    print("Total: %s LS in %d run%s" % (formatCounts(summary), len(runs), "" if len(runs) == 1 else "s"))
+
+if args.json:
+    output = {"summary": summary, "fills": fills, "runs": runs}
+    if args.json == "-":
+        json.dump(output, sys.stdout, sort_keys=True)
+        print()
+    else:
+        with open(args.json, "w") as jsonFile:
+            json.dump(output, jsonFile, sort_keys=True)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# validateNormtag.py
+#
+# If you need to manually edit a normtag for whatever reason, please run this script on it first to make sure
+# that it isn't broken. Unlike validateNormtag.sh, this doesn't need brilcalc or the production environment;
+# it reads the normtag once and checks for:
+# - malformed records (the same checks as makeJSONFromNormtag.py)
+# - reversed ranges
+# - unknown iovtags (by default, iovtags which don't start with the name of one of our luminometers; use -t to
+#   give the exact list of valid iovtags instead)
+# - overlapping ranges (an error if the iovtags are different, since then it's ambiguous which one is used; a
+#   warning if they're just duplicates)
+# - records which are out of order
+# - with -j, lumisections in a JSON file (e.g. the DCSOnly JSON) which are not covered by the normtag, for the
+#   runs between the first and last run in the normtag
+#
+# Problems are reported by line number. The exit status is 1 if there are any errors (or any warnings, with
+# --strict), so this can be used as a pre-commit hook.
+#
+# Example: python3 Scripts/validateNormtag.py normtag_BRIL.json -j json_DCSONLY.txt
+
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from normtag import validateNormtag
+
+parser = argparse.ArgumentParser()
+parser.add_argument("normtag", nargs="*", default=["normtag_BRIL.json"], help="Normtag file(s) to validate (default: normtag_BRIL.json)")
+parser.add_argument("-j", "--json", help="Also report lumisections in this JSON file which are missing in the normtag")
+parser.add_argument("-t", "--iovtags", help="Comma-separated list of valid iovtags, or a file with one iovtag per line")
+parser.add_argument("--strict", action="store_true", help="Treat warnings as errors")
+args = parser.parse_args()
+
+iovtags = None
+if args.iovtags:
+    if os.path.isfile(args.iovtags):
+        with open(args.iovtags) as iovtagFile:
+            iovtags = set(line.strip() for line in iovtagFile if line.strip())
+    else:
+        iovtags = set(args.iovtags.split(","))
+
+certJSON = None
+if args.json:
+    with open(args.json) as jsonFile:
+        certJSON = json.load(jsonFile)
+
+status = 0
+for fileName in args.normtag:
+    with open(fileName) as normtagFile:
+        contents = normtagFile.read()
+    try:
+        records = json.loads(contents)
+    except ValueError as ex:
+        print("%s: not valid JSON: %s" % (fileName, ex.args[0]))
+        status = 1
+        continue
+
+    # If the file has one record per line (as it should), we can give line numbers.
+    recordLines = [n for n, line in enumerate(contents.split("\n"), 1) if line.lstrip().startswith("[\"")]
+    if isinstance(records, list) and len(recordLines) == len(records):
+        locate = lambda i: "line %d" % recordLines[i]
+    else:
+        locate = lambda i: "record %d" % (i+1)
+
+    problems = validateNormtag(records, iovtags, certJSON, locate)
+    for level, message in problems:
+        print("%s: %s: %s" % (fileName, level, message))
+    nErrors = len([p for p in problems if p[0] == "error"])
+    nWarnings = len(problems) - nErrors
+    print("%s: %d records, %d error%s, %d warning%s" % (fileName, len(records), nErrors, "" if nErrors == 1 else "s",
+                                                        nWarnings, "" if nWarnings == 1 else "s"))
+    if nErrors > 0 or (args.strict and nWarnings > 0):
+        status = 1
+
+sys.exit(status)
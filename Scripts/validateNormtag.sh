@@ -2,8 +2,11 @@
 
 # If you need to manually edit a normtag for whatever reason,
 # please run this script on it first to make sure that the normtag
-# actually works and isn't broken for whatever reason. This uses
-# the 2018 DCSOnly json but feel free to change that for other years.
+# actually works and isn't broken for whatever reason. This first
+# runs the offline checks in validateNormtag.py (which don't need
+# brilcalc), and then, if brilcalc is available, checks that it
+# produces proper output using the 2018 DCSOnly json but feel free
+# to change that for other years.
 
 # Default to normtag_BRIL.json but if an argument is given, use that.
 normtag=./normtag_BRIL.json
@@ -13,4 +16,10 @@ fi
 
 echo "Normtag file to validate: $normtag"
 
+python3 $(dirname $0)/validateNormtag.py $normtag || exit 1
+
+if ! command -v brilcalc > /dev/null; then
+    echo "brilcalc not found, skipping the brilcalc check."
+    exit 0
+fi
 brilcalc lumi --normtag $normtag -i /afs/cern.ch/cms/CAF/CMSCOMM/COMM_DQM/certification/Collisions18/13TeV/DCSOnly/json_DCSONLY.txt -u /pb
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
-import json
+import os, sys
 import argparse
 
-# Take a csv output file from brilcalc and average the pileup in that file.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from normtag import Normtag
+
+# Take two normtag files and print the lumisection ranges which are in the first but not the second.
 
 # Parse input arguments.
 parser = argparse.ArgumentParser()
@@ -11,49 +14,38 @@ parser.add_argument('infile', help='First input file to compare.')
 parser.add_argument('infile2', help='Second input file to compare.')
 args = parser.parse_args()
 
+# Read in both normtags. These are kept as sorted lists of LS ranges per run, so the comparison below goes
+# range by range rather than lumisection by lumisection.
 valid_lumisections = {}
-# Read in current normtag for the luminometers and populate them in
-# the hash valid_lumisections[l].
 for f in [args.infile, args.infile2]:
-    valid_lumisections[f] = {}
-    with open(f, 'r') as jsonFile:
-        validPeriods = json.load(jsonFile)
-    for entry in validPeriods:
-        runHash = entry[1]
-        for run in runHash.keys():
-            r = int(run)
-            if r not in valid_lumisections[f]:
-                valid_lumisections[f][r] = set()
-            ranges = runHash[run]
-            for thisRange in ranges:
-                startLS = thisRange[0]
-                endLS = thisRange[1]
-                for i in range(startLS, endLS+1):
-                    valid_lumisections[f][r].add(i)
+    valid_lumisections[f] = Normtag.fromFile(f)
 
-# Now look for things in one and not the other.
+# Now look for things in one and not the other. Each range in the first file is split into the pieces which
+# are missing from the second file and the pieces which are present. A missing range continues until we hit
+# a lumisection which is present in both.
+first = valid_lumisections[args.infile]
+second = valid_lumisections[args.infile2]
+inFirstOnly = first - second
+inBoth = first & second
 inMissingRange = False
 totalMissingLS = 0
-for r in sorted(valid_lumisections[args.infile].keys()):
-    for ls in sorted(valid_lumisections[args.infile][r]):
-        if not inMissingRange and (r not in valid_lumisections[args.infile2] or ls not in valid_lumisections[args.infile2][r]):
+for r in first.runs():
+    missing = [[a, b, True] for a, b in inFirstOnly.ranges(r)]
+    present = [[a, b, False] for a, b in inBoth.ranges(r)]
+    for startPiece, endPiece, isMissing in sorted(missing + present):
+        if not inMissingRange and isMissing:
             inMissingRange = True
             startRun = r
-            startLS = ls
-        if inMissingRange and r in valid_lumisections[args.infile2] and ls in valid_lumisections[args.infile2][r]:
-            print str(startRun)+":"+str(startLS)+" to "+str(lastRun)+":"+str(lastLS)+" in "+args.infile+" but not in "+args.infile2
+            startLS = startPiece
+        if inMissingRange and not isMissing:
+            print(str(startRun)+":"+str(startLS)+" to "+str(lastRun)+":"+str(lastLS)+" in "+args.infile+" but not in "+args.infile2)
             inMissingRange = False
         if inMissingRange:
-            totalMissingLS += 1
+            totalMissingLS += endPiece - startPiece + 1
         lastRun = r
-        lastLS = ls
+        lastLS = endPiece
 
 # don't forget to check last range
 if inMissingRange:
-    print str(startRun)+":"+str(startLS)+" to "+str(lastRun)+":"+str(lastLS)+" in "+args.infile+" but not in "+args.infile2
-print "Total of",totalMissingLS,"LS missing"
-
-# for r in sorted(valid_lumisections[args.infile].keys()):
-#     for ls in sorted(valid_lumisections[args.infile][r]):
-#         if r not in valid_lumisections[args.infile2] or ls not in valid_lumisections[args.infile2][r]:
-#             print r,ls,"in",args.infile,"but not in",args.infile2
+    print(str(startRun)+":"+str(startLS)+" to "+str(lastRun)+":"+str(lastLS)+" in "+args.infile+" but not in "+args.infile2)
+print("Total of",totalMissingLS,"LS missing")
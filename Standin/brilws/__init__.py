@@ -0,0 +1 @@
+# A stand-in for the brilws package, with just what brilcalcCache.py uses (see cli/brilcalc_main.py).
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+# brilcalc_main.py
+#
+# The stand-in brilcalc (Standin/brilcalc) as brilws.cli.brilcalc_main, so that the in-process backend of
+# brilcalcCache.py can be run against the stand-in lumi DB as well as the brilcalc command. As in brilws,
+# brilcalc_main() takes its arguments from sys.argv, and the database is opened with create_engine() (here giving
+# a FakeLumiDB, which is passed to the script as fakeLumiDB.sharedDB), which brilcalcCache.py replaces to reuse the
+# same one for all queries. To use it, put Standin/ on the Python path:
+#
+#   export PYTHONPATH=$PWD/Standin BRILCALC_BACKEND=inprocess
+
+import os
+import sys
+import runpy
+
+STANDIN_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, STANDIN_DIR)
+import fakeLumiDB
+
+SCRIPT = os.path.join(STANDIN_DIR, "brilcalc")
+
+def create_engine(url, **kwargs):
+    return fakeLumiDB.FakeLumiDB(url[len("sqlite:///"):])
+
+def brilcalc_main(progname):
+    # the database given by FAKE_LUMIDB now, not when fakeLumiDB was imported
+    url = "sqlite:///" + os.environ.get("FAKE_LUMIDB", fakeLumiDB.DB_FILE)
+    try:
+        engine = create_engine(url)
+    except IOError as ex:
+        print(ex.args[0])
+        sys.exit(1)
+    fakeLumiDB.sharedDB = engine
+    try:
+        runpy.run_path(SCRIPT, run_name="brilcalc")
+    finally:
+        fakeLumiDB.sharedDB = None
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+# fakeLumiDB.py
+#
+# A local stand-in for the lumi DB, so that doFillValidation.py, lumiValidate.py and the scripts can be run,
+# timed, and profiled without the production brilcalc environment and the Oracle cms_lumi_prod schema. It
+# consists of a SQLite file with lhcfill and ids_datatag tables in the same layout as in cms_lumi_prod, plus a
+# few standin_* tables which describe synthetic but realistic fills, and the fake brilcalc command in this directory,
+# which serves lumi (--byls, --xing, per run) and beam (also --xing) queries from it in the same CSV layout as
+# the real brilcalc.
+#
+# The fills, luminometers and anomalies are described by a JSON configuration file (see example.json):
+#
+#   start         when the first fill starts: "YYYY-MM-DD HH:MM:SS" (UTC), or e.g. "-12h" for 12 hours ago
+#   firstRun      the first run number
+#   datatag       the datatag brilcalc reports when none is given
+#   online        luminometers in the order the online luminosity uses them, when no --type or --normtag is given
+#   fills         list of fills; each gives fill (the number), and optionally count (to make several consecutive
+#                 fills which are otherwise the same), nls (lumisections), nadjust (lumisections in ADJUST
+#                 before STABLE BEAMS), nbx (colliding bunches), runs (number of runs), peak (Hz/ub), lifetime
+#                 (hours), amodetag, egev, and turnaround (hours until the next fill)
+#   luminometers  for each luminometer, scale (online calibration relative to the true luminosity),
+#                 calibrated (the same with --normtag), noise (relative, per lumisection), and slope (relative
+#                 change per hour into the fill)
+#   anomalies     list of {fill, luminometer, kind, first, last, value} with the lumisections counted from the
+#                 start of the fill: kind "gap" (no data), "spike" (luminosity multiplied by value), or "shift"
+#                 (the per-bunch data shifted by value BXs)
+#
+# Only fills which have started are in lhcfill, and only lumisections which are over are in ids_datatag and in
+# the brilcalc output, so with a
+# relative start time the stand-in behaves like a live system where new fills appear over time. All random
+# numbers are seeded from the fill and luminometer, so the same configuration always gives the same data.
+#
+# To set up (the database is Standin/lumidb.sqlite, or FAKE_LUMIDB if set):
+#
+#   python3 Standin/fakeLumiDB.py create [-c config.json]
+#   export PATH=$PWD/Standin:$PATH FAKE_LUMIDB=$PWD/Standin/lumidb.sqlite BRILDB_AUTHFILE=$PWD/Standin/db.ini
+#
+# create also writes db.ini next to the database, with a service which fillmeta.py (and so doFillValidation.py,
+# lumiValidate.py, get_recentfill.py and get_fill_amodetag.py) opens as SQLite instead of Oracle.
+# FAKE_BRILCALC_LATENCY (seconds) adds a delay to every brilcalc call, to emulate the time spent waiting for the
+# database.
+
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import argparse
+import calendar
+
+import numpy
+
+DB_FILE = os.environ.get("FAKE_LUMIDB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "lumidb.sqlite"))
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example.json")
+
+# The FakeLumiDB for the stand-in brilcalc to use instead of opening DB_FILE itself. This is set by
+# brilws/cli/brilcalc_main.py while the stand-in brilcalc runs in-process.
+sharedDB = None
+
+NBX = 3564
+NORB = 2**18
+NBPERLS = 64
+LS_SECONDS = NORB*NBX/40.0790e6
+ORBIT_FREQUENCY = 11245.6
+MINBIAS_XSEC = 80000.0 # ub
+BUNCH_INTENSITY = 1.15e11
+AMODETAGS = {"UNKNOWN": 0, "PROTPHYS": 1, "IONPHYS": 2, "PAPHYS": 3}
+
+FILL_DEFAULTS = {"count": 1, "nls": 1000, "nadjust": 10, "nbx": 2544, "runs": 1, "peak": 15000.0, "lifetime": 15.0,
+                 "amodetag": "PROTPHYS", "egev": 6500, "turnaround": 2.0}
+LUMINOMETER_DEFAULTS = {"scale": 1.0, "calibrated": 1.0, "noise": 0.003, "slope": 0.0}
+
+SCHEMA = """
+create table standin_fill (fillnum integer primary key, timestampsec integer, nls integer, nadjust integer,
+                           numbxbeamactive integer, amodetagid integer, targetegev integer, peak real,
+                           lifetime real);
+create view lhcfill as
+    select fillnum, timestampsec, %d as norb, %d as nbperls, amodetagid, numbxbeamactive, targetegev
+    from standin_fill where timestampsec <= cast(strftime('%%s', 'now') as integer);
+create table standin_run (runnum integer primary key, fillnum integer, firstls integer, nls integer);
+create table standin_ids (datatagnameid integer, datatagid integer primary key, fillnum integer, runnum integer,
+                          lsnum integer, timestampsec integer, cmson integer, beamstatusid integer);
+create index standin_ids_fill on standin_ids (fillnum);
+create view ids_datatag as
+    select * from standin_ids where timestampsec + %d <= cast(strftime('%%s', 'now') as integer);
+create table standin_luminometer (name text primary key, priority integer, scale real, calibrated real,
+                                  noise real, slope real);
+create table standin_anomaly (fillnum integer, luminometer text, kind text, firstls integer, lastls integer,
+                              value real);
+create table standin_meta (key text primary key, value text);
+""" % (NORB, NBPERLS, int(LS_SECONDS+1))
+
+# Parse a start time: "YYYY-MM-DD HH:MM:SS" (UTC) or an offset from now like "-12h" or "-30m".
+def parseStart(value):
+    match = re.match(r"^([+-]?\d+(?:\.\d+)?)([hm])$", value)
+    if match:
+        return int(time.time() + float(match.group(1))*(3600 if match.group(2) == "h" else 60))
+    return calendar.timegm(time.strptime(value, "%Y-%m-%d %H:%M:%S"))
+
+def create(fileName, config):
+    if os.path.exists(fileName):
+        os.unlink(fileName)
+    con = sqlite3.connect(fileName)
+    con.executescript(SCHEMA)
+    meta = {"datatag": config.get("datatag", "online"), "created": str(int(time.time()))}
+    con.executemany("insert into standin_meta values (?, ?)", meta.items())
+
+    online = config.get("online", [])
+    for name, params in config.get("luminometers", {}).items():
+        params = dict(LUMINOMETER_DEFAULTS, **params)
+        priority = online.index(name) if name in online else None
+        con.execute("insert into standin_luminometer values (?, ?, ?, ?, ?, ?)",
+                    (name, priority, params["scale"], params["calibrated"], params["noise"], params["slope"]))
+
+    startTime = parseStart(config.get("start", "2018-06-01 08:00:00"))
+    runnum = config.get("firstRun", 316000)
+    for spec in config.get("fills", []):
+        spec = dict(FILL_DEFAULTS, **spec)
+        for i in range(spec["count"]):
+            fillnum = spec["fill"] + i
+            con.execute("insert into standin_fill values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (fillnum, startTime, spec["nls"], spec["nadjust"], spec["nbx"], AMODETAGS[spec["amodetag"]],
+                         spec["egev"], spec["peak"], spec["lifetime"]))
+            # split the fill into runs of (nearly) equal length
+            boundaries = numpy.linspace(0, spec["nls"], spec["runs"]+1).astype(int)
+            for first, last in zip(boundaries[:-1], boundaries[1:]):
+                con.execute("insert into standin_run values (?, ?, ?, ?)", (runnum, fillnum, int(first)+1,
+                                                                             int(last-first)))
+                # the lumisection IDs (ids_datatag), which the fill end times and run lists come from
+                con.executemany("insert into standin_ids (datatagnameid, fillnum, runnum, lsnum, timestampsec, cmson, "
+                                "beamstatusid) values (0, ?, ?, ?, ?, 1, ?)",
+                                [(fillnum, runnum, i-first+1, int(startTime + i*LS_SECONDS),
+                                  10 if i < spec["nadjust"] else 11) for i in range(int(first), int(last))])
+                runnum += 1
+            startTime += int(spec["nls"]*LS_SECONDS + spec["turnaround"]*3600)
+
+    for anomaly in config.get("anomalies", []):
+        con.execute("insert into standin_anomaly values (?, ?, ?, ?, ?, ?)",
+                    (anomaly["fill"], anomaly["luminometer"], anomaly["kind"], anomaly.get("first", 1),
+                     anomaly.get("last", 999999), anomaly.get("value", 1.0)))
+    con.commit()
+    con.close()
+
+    # a db.ini service for fillmeta.py
+    with open(os.path.join(os.path.dirname(os.path.abspath(fileName)), "db.ini"), "w") as iniFile:
+        iniFile.write("[online]\nprotocol = sqlite\nuser = standin\npwd = \ndescriptor = %s\n" %
+                      os.path.abspath(fileName))
+
+# The bunch pattern for a fill: trains of 48 bunches with 8 empty BXs in between, starting at BX 1.
+def bunchPattern(nbx):
+    positions = numpy.arange(NBX)
+    filled = positions[positions % 56 < 48]
+    return filled[:nbx] + 1
+
+# A random generator for a fill and luminometer (or "" for the beam and the true luminosity).
+def _random(fillnum, name):
+    return numpy.random.RandomState(zlib.crc32(("%d:%s" % (fillnum, name)).encode()))
+
+# The data for one fill. All of the per-lumisection arrays have one entry per lumisection of the fill which is
+# over, counted from the start of the fill.
+class Fill(object):
+    def __init__(self, db, row):
+        self.db = db
+        (self.fillnum, self.timestampsec, nls, self.nadjust, self.nbx, self.amodetagid, self.egev, self.peak,
+         self.lifetime) = row
+        # only the lumisections which are over
+        nOver = int((time.time() - self.timestampsec)/LS_SECONDS)
+        self.nls = max(0, min(nls, nOver))
+        self.complete = self.nls == nls
+        self.time = self.timestampsec + numpy.arange(self.nls)*LS_SECONDS
+        self.beamstatus = numpy.where(numpy.arange(self.nls) < self.nadjust, "ADJUST", "STABLE BEAMS")
+        self.runs = numpy.zeros(self.nls, dtype=numpy.int64)
+        self.runls = numpy.zeros(self.nls, dtype=numpy.int64)
+        for runnum, firstls, nrunls in db.con.execute("select runnum, firstls, nls from standin_run where fillnum=? "
+                                                      "order by runnum", (self.fillnum,)):
+            first = min(firstls-1, self.nls)
+            last = min(firstls-1+nrunls, self.nls)
+            self.runs[first:last] = runnum
+            self.runls[first:last] = numpy.arange(1, last-first+1)
+        self.bx = bunchPattern(self.nbx)
+
+        # true luminosity (Hz/ub): decaying with the lifetime in STABLE BEAMS, lower before
+        rng = _random(self.fillnum, "")
+        hours = (self.time - self.timestampsec)/3600.0
+        self.hours = hours
+        self.trueLumi = self.peak*numpy.exp(-hours/self.lifetime)
+        self.trueLumi[:self.nadjust] *= 0.1
+        self.deadtime = numpy.clip(0.02 + 0.01*rng.standard_normal(self.nls), 0, 0.2)
+        # relative luminosity of the individual bunches
+        weights = numpy.clip(1 + 0.1*rng.standard_normal(len(self.bx)), 0.5, 1.5)
+        self.bunchWeights = weights/weights.sum()
+        self.intensity = BUNCH_INTENSITY*numpy.clip(1 + 0.05*rng.standard_normal(len(self.bx)), 0.8, 1.2)
+
+    # The anomalies for a luminometer as (kind, first index, last index + 1, value).
+    def anomalies(self, name):
+        return [(kind, first-1, last, value) for kind, first, last, value in
+                self.db.con.execute("select kind, firstls, lastls, value from standin_anomaly "
+                                    "where fillnum=? and luminometer=?", (self.fillnum, name))]
+
+    # The luminosity (Hz/ub) measured by a luminometer in each lumisection, NaN where it has no data.
+    def lumi(self, name, calibrated=False):
+        params = self.db.luminometer(name)
+        rng = _random(self.fillnum, name)
+        scale = params["calibrated"] if calibrated else params["scale"]
+        lumi = self.trueLumi*scale*(1 + params["slope"]*self.hours)*(1 + params["noise"]*rng.standard_normal(self.nls))
+        for kind, first, last, value in self.anomalies(name):
+            if kind == "gap":
+                lumi[first:last] = numpy.nan
+            elif kind == "spike":
+                lumi[first:last] *= value
+        return lumi
+
+    # The per-bunch luminosity (Hz/ub) of a luminometer for lumisections first to last as a (lumisections x
+    # NBX) array, for BX numbers 1 to NBX.
+    def bunchLumi(self, name, lumi, first, last):
+        rng = _random(self.fillnum, name + ":bx%d" % first)
+        bunches = numpy.zeros((last-first, NBX))
+        noise = 1 + 3*self.db.luminometer(name)["noise"]*rng.standard_normal((last-first, len(self.bx)))
+        bunches[:, self.bx-1] = numpy.nan_to_num(lumi[first:last])[:, None]*self.bunchWeights[None, :]*noise
+        for kind, shiftFirst, shiftLast, value in self.anomalies(name):
+            if kind == "shift":
+                rows = slice(max(shiftFirst, first)-first, max(min(shiftLast, last)-first, 0))
+                bunches[rows] = numpy.roll(bunches[rows], int(value), axis=1)
+        return bunches
+
+    # Beam intensities (total for beam 1 and beam 2) in each lumisection.
+    def beamIntensity(self):
+        decay = numpy.exp(-self.hours/(2*self.lifetime))
+        return self.intensity.sum()*decay, self.intensity.sum()*0.99*decay
+
+class FakeLumiDB(object):
+    def __init__(self, fileName=DB_FILE):
+        if not os.path.exists(fileName):
+            raise IOError("%s doesn't exist; create it with python3 %s create" % (fileName, __file__))
+        # the in-process stand-in brilcalc may use the same FakeLumiDB from several threads (one at a time)
+        self.con = sqlite3.connect(fileName, check_same_thread=False)
+        self.meta = dict(self.con.execute("select key, value from standin_meta"))
+        self.luminometers = {}
+        for name, priority, scale, calibrated, noise, slope in self.con.execute("select * from standin_luminometer"):
+            self.luminometers[name] = {"priority": priority, "scale": scale, "calibrated": calibrated, "noise": noise,
+                                       "slope": slope}
+
+    def luminometer(self, name):
+        if name not in self.luminometers:
+            raise KeyError("unknown luminometer %s" % name)
+        return self.luminometers[name]
+
+    # The luminometers used for the online luminosity, best first.
+    def online(self):
+        return sorted((p["priority"], name) for name, p in self.luminometers.items() if p["priority"] is not None)
+
+    # The fills which have started, optionally only those in a fill, run, or time range.
+    def fills(self, fillMin=None, fillMax=None, runMin=None, runMax=None, timeMin=None, timeMax=None):
+        query = "select * from standin_fill where fillnum in (select fillnum from lhcfill)"
+        binds = []
+        for condition, value in (("fillnum >= ?", fillMin), ("fillnum <= ?", fillMax),
+                                 ("fillnum in (select fillnum from standin_run where runnum >= ?)", runMin),
+                                 ("fillnum in (select fillnum from standin_run where runnum <= ?)", runMax),
+                                 ("timestampsec + nls*%f >= ?" % LS_SECONDS, timeMin), ("timestampsec <= ?", timeMax)):
+            if value is not None:
+                query += " and " + condition
+                binds.append(value)
+        return [Fill(self, row) for row in self.con.execute(query + " order by fillnum", binds)]
+
+    def info(self):
+        nFills, firstFill, lastFill, firstTime = self.con.execute(
+            "select count(*), min(fillnum), max(fillnum), min(timestampsec) from standin_fill").fetchone()
+        nStarted = self.con.execute("select count(*) from lhcfill").fetchone()[0]
+        nRuns = self.con.execute("select count(*) from standin_run").fetchone()[0]
+        nAnomalies = self.con.execute("select count(*) from standin_anomaly").fetchone()[0]
+        print("datatag %s, luminometers %s (online: %s)" % (self.meta["datatag"], ", ".join(sorted(self.luminometers)),
+                                                            ", ".join(name for p, name in self.online())))
+        print("%d fills (%s-%s, %d started), %d runs, %d anomalies, first fill starts %s UTC" %
+              (nFills, firstFill, lastFill, nStarted, nRuns, nAnomalies,
+               time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(firstTime or 0))))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or show the stand-in lumi DB "+DB_FILE)
+    subparsers = parser.add_subparsers(dest="command")
+    createParser = subparsers.add_parser("create", help="Create the database from a configuration file")
+    createParser.add_argument("-c", "--config", default=DEFAULT_CONFIG, help="JSON configuration (default %(default)s)")
+    subparsers.add_parser("info", help="Show what is in the database")
+    args = parser.parse_args()
+
+    if args.command == "create":
+        with open(args.config) as configFile:
+            create(DB_FILE, json.load(configFile))
+    FakeLumiDB().info()
@@ -0,0 +1,710 @@
+#!/usr/bin/env python3
+
+# brilcalcCache.py
+#
+# A shared on-disk cache for brilcalc results. doFillValidation.py, lumiValidate.py and several of the scripts
+# all call brilcalc for the same fills with the same arguments (the validation GUI gets each luminometer's data,
+# and then the validation plot gets exactly the same data again), and each call takes from several seconds to
+# minutes. runBrilcalc() runs brilcalc (reading the CSV output directly from its stdout, so that several calls
+# can run at the same time without any temporary files) and returns the parsed result as a BrilcalcOutput; if
+# the same query has been made before, the result is returned from the cache instead. runBrilcalcMany() runs
+# several queries in parallel, with at most BRILCALC_JOBS (default 4) brilcalc processes at a time
+# (runBrilcalcAsCompleted() does the same but gives each result as soon as it is done), and streamBrilcalc()
+# gives the rows one at a time as brilcalc writes them, for queries where only the first part of the output is
+# needed.
+#
+# If the brilws package (which brilcalc is part of) can be imported, the queries are run in-process by calling
+# brilcalc's main function directly, which saves starting a new Python interpreter and importing brilws for every
+# query, and the database engine (and with it the connection pool) is kept and reused for the following queries.
+# If that fails for any reason other than brilcalc itself reporting an error, the query is run with the brilcalc
+# command as before. Of queries run in parallel, the ones which come while another one is running in-process use
+# the command. Set BRILCALC_BACKEND=subprocess to always use the command, or inprocess to require brilws.
+#
+# The cache key is computed from the brilcalc arguments after normalization (the order of the options and the
+# -o output file don't matter), and for any --normtag or -i argument which is a file, from the contents of the
+# file rather than its name, so editing a normtag automatically gives a new key. An explicit --datatag is part of
+# the arguments and so also part of the key. The default datatag can't be known without asking brilcalc, so
+# when a new default datatag is deployed, the cache should be invalidated (see below).
+#
+# Each entry is stored as a compressed .npz file with one array per column; numeric columns are stored as
+# numbers when the text can be reproduced exactly, so csvText() gives back exactly what brilcalc wrote. The
+# per-bunch data from --xing is stored in the CSR form of bunchData.py (only the BXs which brilcalc listed, as
+# binary arrays), which takes a fraction of the space of the text and is much faster to read back than parsing
+# it again; bunches() gives it as a BunchData directly. This makes the cache the store for the BX-level scripts
+# (getNBX.py, compareBXPatterns.py and the ones in Scripts/NBX), which used to keep the brilcalc output for each
+# fill in bxdata_*.csv files so that they could be rerun. The total size of the cache is limited to
+# BRILCALC_CACHE_SIZE MB (default 500), and the least recently used entries are removed when it gets bigger than
+# that. Results where the last lumisection is less than RECENT_SECONDS old (the fill might still be ongoing or
+# the data might still be reprocessed), for a --begin and --end time range which isn't over yet, or which are
+# empty (except for a time range which is over), are not stored; fillWatcher.py, which only fetches fills which
+# are over, stores them sooner by giving a shorter recentSeconds.
+#
+# The cache is in .brilcalc_cache in this directory, or BRILCALC_CACHE_DIR if set; setting BRILCALC_CACHE=0
+# turns it off. Without NumPy, runBrilcalc() still works but nothing is cached. To manage the cache:
+#
+#   python3 brilcalcCache.py info
+#   python3 brilcalcCache.py invalidate -f 8000 8001    (or -r RUN ..., or --datatag TAG)
+#   python3 brilcalcCache.py clear
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import calendar
+import argparse
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+
+try:
+    import numpy
+    from bunchData import BunchData
+except ImportError:
+    # Without NumPy results are simply not cached.
+    numpy = None
+
+CACHE_DIR = os.environ.get("BRILCALC_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".brilcalc_cache"))
+CACHE_SIZE = int(os.environ.get("BRILCALC_CACHE_SIZE", "500"))*1024*1024
+CACHE_ENABLED = os.environ.get("BRILCALC_CACHE", "1") != "0"
+CACHE_FORMAT_VERSION = 1
+RECENT_SECONDS = 6*3600
+# Maximum number of brilcalc processes run at the same time by runBrilcalcMany().
+MAX_JOBS = int(os.environ.get("BRILCALC_JOBS", "4"))
+# How to run brilcalc: "inprocess", "subprocess", or "auto" (in-process if brilws can be imported).
+BACKEND = os.environ.get("BRILCALC_BACKEND", "auto")
+
+# Arguments which name a file whose contents affect the result.
+FILE_OPTIONS = ("--normtag", "-i")
+# Arguments which don't affect the result.
+IGNORED_OPTIONS = ("-o", "--output-style")
+# The arrays of a BunchData column, as stored in an entry.
+BUNCH_ARRAYS = ("offsets", "bx", "delivered", "recorded")
+
+# Parsed brilcalc CSV output: the comment lines before the data (the last one being the column names), the
+# columns of the data rows, and the summary comment lines after the data. Each column is stored together with
+# its format: "int", "%.Nf" (a float printed with N decimals), "str", or for the per-bunch data of --xing, the
+# format of one (bx, value, value) triplet in brackets, e.g. "[%d %.9f %.9f]", in which case the column is a
+# BunchData (see bunchData.py). complete is False for the first part of the output as kept by streamBrilcalc().
+class BrilcalcOutput(object):
+    def __init__(self, header, names, columns, formats, footer, trailingNewline=True, complete=True):
+        self.header = header
+        self.names = names
+        self.columns = columns
+        self.formats = formats
+        self.footer = footer
+        self.trailingNewline = trailingNewline
+        self.complete = complete
+
+    @classmethod
+    def fromText(cls, text):
+        lines = text.split("\n")
+        trailingNewline = bool(lines) and lines[-1] == ""
+        if trailingNewline:
+            lines.pop()
+        nHeader = 0
+        while nHeader < len(lines) and lines[nHeader].startswith("#"):
+            nHeader += 1
+        nData = nHeader
+        while nData < len(lines) and not lines[nData].startswith("#"):
+            nData += 1
+        rows = [line.split(",") for line in lines[nHeader:nData]]
+        nColumns = len(rows[0]) if rows else 0
+        if any(len(row) != nColumns for row in rows):
+            raise ValueError("brilcalc output rows have different numbers of columns")
+        names = lines[nHeader-1].split(",") if nHeader > 0 else []
+        if len(names) != nColumns:
+            names = ["col%d" % i for i in range(nColumns)]
+        columns = []
+        formats = []
+        for values in zip(*rows):
+            column, columnFormat = _packColumn(list(values))
+            columns.append(column)
+            formats.append(columnFormat)
+        return cls(lines[:nHeader], names, columns, formats, lines[nData:], trailingNewline)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    # The values of a column (by name or index) as strings, exactly as brilcalc wrote them.
+    def strings(self, column):
+        if not isinstance(column, int):
+            column = self.names.index(column)
+        values = self.columns[column]
+        columnFormat = self.formats[column]
+        if columnFormat == "str":
+            return [v.decode() if isinstance(v, bytes) else v for v in values]
+        if columnFormat == "int":
+            return [str(v) for v in values.tolist()]
+        if columnFormat.startswith("["):
+            return values.toStrings(columnFormat[1:-1], zeroBelow=_zeroBelow(columnFormat))
+        return [columnFormat % v for v in values.tolist()]
+
+    # The values of a column (by name or index): a NumPy array for numeric columns, a BunchData for per-bunch
+    # data, a list of strings otherwise.
+    def column(self, column):
+        if not isinstance(column, int):
+            column = self.names.index(column)
+        if self.formats[column] == "str":
+            return self.strings(column)
+        return self.columns[column]
+
+    # The per-bunch data in a column (by name or index) as a BunchData, without going through the strings if
+    # the column is stored that way.
+    def bunches(self, column):
+        if not isinstance(column, int):
+            column = self.names.index(column)
+        if self.formats[column].startswith("["):
+            return self.columns[column]
+        return BunchData.fromStrings(self.strings(column))
+
+    # The data rows as lists of strings, as csv.reader would give them.
+    def rows(self):
+        return [list(row) for row in zip(*[self.strings(i) for i in range(len(self.columns))])]
+
+    # Data row i as a list of strings, without formatting the whole output.
+    def row(self, i):
+        row = []
+        for values, columnFormat in zip(self.columns, self.formats):
+            if columnFormat == "str":
+                row.append(values[i].decode() if isinstance(values[i], bytes) else values[i])
+            elif columnFormat == "int":
+                row.append(str(values[i]))
+            elif columnFormat.startswith("["):
+                row.append(values.toStrings(columnFormat[1:-1], i, i+1, _zeroBelow(columnFormat))[0])
+            else:
+                row.append(columnFormat % values[i])
+        return row
+
+    # The complete output as brilcalc wrote it, e.g. for pandas.read_csv(io.StringIO(output.csvText())).
+    def csvText(self):
+        lines = self.header + [",".join(row) for row in self.rows()] + self.footer
+        return "\n".join(lines) + ("\n" if self.trailingNewline else "")
+
+    def datatag(self):
+        for line in self.header:
+            match = re.search(r"Data tag\s*:\s*([^\s,]+)", line)
+            if match:
+                return match.group(1)
+        return None
+
+    # The runs and fills in the output, from the run:fill column or separate fill and run columns.
+    def runsAndFills(self):
+        names = [n.lstrip("#") for n in self.names]
+        runs = set()
+        fills = set()
+        if "run:fill" in names:
+            for value in self.strings(names.index("run:fill")):
+                fields = value.split(":")
+                if len(fields) == 2 and fields[0].isdigit() and fields[1].isdigit():
+                    runs.add(int(fields[0]))
+                    fills.add(int(fields[1]))
+        else:
+            for name, values in (("run", runs), ("fill", fills)):
+                if name in names:
+                    values.update(int(v) for v in self.strings(names.index(name)) if v.isdigit())
+        return sorted(runs), sorted(fills)
+
+    # The time of the last data row (in seconds since the epoch), or None if there is no time column or it can't
+    # be parsed.
+    def lastTime(self):
+        names = [n.lstrip("#") for n in self.names]
+        if len(self) == 0 or "time" not in names:
+            return None
+        return _parseTime(self.strings(names.index("time"))[-1])
+
+# Store a column of strings in the most compact form which still reproduces the strings exactly.
+def _packColumn(values):
+    if numpy is None:
+        return values, "str"
+    if all(re.match(r"-?\d+$", v) for v in values):
+        column = numpy.array([int(v) for v in values], dtype=numpy.int64)
+        if [str(v) for v in column.tolist()] == values:
+            return column, "int"
+    match = re.match(r"-?\d+\.(\d+)$", values[0])
+    if match:
+        columnFormat = "%%.%df" % len(match.group(1))
+        try:
+            column = numpy.array(values, dtype=numpy.float64)
+        except ValueError:
+            column = None
+        if column is not None and [columnFormat % v for v in column.tolist()] == values:
+            return column, columnFormat
+    if values[0].startswith("[") and all(v.startswith("[") and v.endswith("]") for v in values):
+        column, columnFormat = _packBunches(values)
+        if column is not None:
+            return column, columnFormat
+    return numpy.array([v.encode() for v in values]), "str"
+
+# Store the per-bunch data from --xing in the CSR form of BunchData, which keeps only the BXs that brilcalc
+# listed and is much smaller and faster to read than the strings. brilcalc writes the values with a fixed
+# number of decimals (lumi, writing values below the precision as 0) or in scientific notation (beam), so the
+# format is taken from the first value written with a decimal point, and the strings must come out exactly the
+# same again. float32 is used when it's precise enough, otherwise float64.
+def _packBunches(values):
+    valueFormats = []
+    for value in values:
+        tokens = value[1:-1].split(" ")
+        for position in (1, 2):
+            for token in tokens[position::3]:
+                match = re.match(r"-?\d+\.(\d+)(e[+-]\d+)?$", token)
+                if match:
+                    valueFormats.append("%%.%d%s" % (len(match.group(1)), "e" if match.group(2) else "f"))
+                    break
+        if len(valueFormats) == 2:
+            break
+        valueFormats = []
+    if not valueFormats:
+        return None, "str"
+    columnFormat = "[%d " + " ".join(valueFormats) + "]"
+    try:
+        column = BunchData.fromStrings(values, numpy.float64)
+    except ValueError:
+        return None, "str"
+    narrowColumn = BunchData(column.offsets, column.bx, column.delivered.astype(numpy.float32),
+                             column.recorded.astype(numpy.float32))
+    zeroBelow = _zeroBelow(columnFormat)
+    nSample = min(len(values), 20)
+    for candidate in (narrowColumn, column):
+        # check the first few rows before formatting all of them
+        if (candidate.toStrings(columnFormat[1:-1], 0, nSample, zeroBelow) == values[:nSample] and
+            candidate.toStrings(columnFormat[1:-1], zeroBelow=zeroBelow) == values):
+            return candidate, columnFormat
+    return None, "str"
+
+# The values which brilcalc writes as 0 in a per-bunch column with the given format, i.e. the ones below the
+# precision for a fixed number of decimals.
+def _zeroBelow(columnFormat):
+    match = re.search(r"%\.(\d+)f", columnFormat)
+    return 10**-int(match.group(1)) if match else None
+
+# Split brilcalc arguments into the subcommand and a sorted list of (option, value) pairs, with file arguments
+# replaced by the hash of their contents.
+def _normalizeArgs(args):
+    args = [str(a) for a in args]
+    command = args[0] if args and not args[0].startswith("-") else ""
+    options = []
+    i = 1 if command else 0
+    while i < len(args):
+        option = args[i]
+        value = None
+        if i+1 < len(args) and not args[i+1].startswith("-"):
+            value = args[i+1]
+            i += 1
+        i += 1
+        if option in IGNORED_OPTIONS:
+            continue
+        if option in FILE_OPTIONS and os.path.isfile(value):
+            with open(value, "rb") as argFile:
+                value = "sha1:" + hashlib.sha1(argFile.read()).hexdigest()
+        options.append((option, value))
+    return command, sorted(options, key=lambda o: (o[0], o[1] or ""))
+
+def cacheKey(args):
+    command, options = _normalizeArgs(args)
+    return hashlib.sha1(json.dumps([CACHE_FORMAT_VERSION, command, options]).encode()).hexdigest()
+
+def _entryFileName(key):
+    return os.path.join(CACHE_DIR, key + ".npz")
+
+def _readEntry(key):
+    fileName = _entryFileName(key)
+    if not os.path.exists(fileName):
+        return None
+    try:
+        with numpy.load(fileName) as entry:
+            meta = json.loads(str(entry["meta"]))
+            columns = []
+            for i, columnFormat in enumerate(meta["formats"]):
+                if columnFormat.startswith("["):
+                    columns.append(BunchData(*[entry["c%d_%s" % (i, a)] for a in BUNCH_ARRAYS]))
+                else:
+                    columns.append(entry["c%d" % i])
+    except Exception:
+        # A corrupted entry (e.g. from a full disk) is just treated as missing.
+        _removeEntry(fileName)
+        return None
+    # Mark the entry as recently used.
+    os.utime(fileName, None)
+    return BrilcalcOutput(meta["header"], meta["names"], columns, meta["formats"], meta["footer"],
+                          meta["trailingNewline"], meta.get("complete", True))
+
+def _writeEntry(key, args, output):
+    runs, fills = output.runsAndFills()
+    meta = {"version": CACHE_FORMAT_VERSION, "args": [str(a) for a in args], "created": time.time(),
+            "datatag": output.datatag(), "runs": runs, "fills": fills, "header": output.header,
+            "names": output.names, "formats": output.formats, "footer": output.footer,
+            "trailingNewline": output.trailingNewline, "complete": output.complete}
+    arrays = {}
+    for i, column in enumerate(output.columns):
+        if isinstance(column, BunchData):
+            for a in BUNCH_ARRAYS:
+                arrays["c%d_%s" % (i, a)] = getattr(column, a)
+        else:
+            arrays["c%d" % i] = column
+    arrays["meta"] = numpy.array(json.dumps(meta))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Write to a temporary file and rename it, so that other processes never see a partial entry.
+    fd, tempName = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tempFile:
+            numpy.savez_compressed(tempFile, **arrays)
+        os.replace(tempName, _entryFileName(key))
+    except Exception:
+        _removeEntry(tempName)
+        raise
+    evict(keep=_entryFileName(key))
+
+def _removeEntry(fileName):
+    try:
+        os.unlink(fileName)
+    except OSError:
+        pass
+
+def _parseTime(value):
+    if value.isdigit():
+        return int(value)
+    try:
+        return calendar.timegm(time.strptime(value, "%m/%d/%y %H:%M:%S"))
+    except ValueError:
+        return None
+
+def _isCacheable(output, args, recentSeconds=None):
+    if recentSeconds is None:
+        recentSeconds = RECENT_SECONDS
+    # A time range which is open or ends in the future (e.g. the current year) will get more data later.
+    options = dict(_normalizeArgs(args)[1])
+    endTime = None
+    if "--begin" in options:
+        if "--end" not in options:
+            return False
+        endTime = _parseTime(options["--end"] or "")
+        if endTime is not None and endTime > 1e8 and time.time() - endTime < recentSeconds:
+            return False
+    if len(output) == 0:
+        # An empty result is only final for a time range which is over (e.g. a week without beam in the shards
+        # of getYearLS.py); for a fill or run, the data might just not be there yet.
+        return endTime is not None and endTime > 1e8
+    lastTime = output.lastTime()
+    if lastTime is None:
+        return "time" not in [n.lstrip("#") for n in output.names]
+    return time.time() - lastTime > recentSeconds
+
+# Remove anything which brilcalc printed before the CSV output itself (i.e. before the first comment line).
+def _trimOutput(text):
+    if text.startswith("#"):
+        return text
+    start = text.find("\n#")
+    return text[start+1:] if start >= 0 else ""
+
+# The two ways of running brilcalc. run() returns the CSV output for the given arguments as text, or None if
+# brilcalc failed.
+class SubprocessBackend(object):
+    name = "subprocess"
+
+    def run(self, args):
+        # With --output-style csv and no -o, brilcalc writes the CSV to stdout, so no temporary file is needed.
+        result = subprocess.run(["brilcalc"] + args + ["--output-style", "csv"], stdout=subprocess.PIPE,
+                                universal_newlines=True)
+        if result.returncode != 0:
+            return None
+        return _trimOutput(result.stdout)
+
+class InProcessBackend(object):
+    name = "inprocess"
+
+    def __init__(self):
+        from brilws.cli import brilcalc_main
+        self.module = brilcalc_main
+        # brilcalc_main uses sys.argv and module-level state, so only one query can run at a time (see also
+        # SharedInProcessBackend).
+        self.lock = threading.RLock()
+        # brilcalc_main creates a new database engine for every query; give it back the same one instead.
+        self.engines = {}
+        createEngine = brilcalc_main.create_engine
+        def sharedEngine(url, **kwargs):
+            key = (str(url), tuple(sorted(kwargs.items())))
+            if key not in self.engines:
+                self.engines[key] = createEngine(url, **kwargs)
+            return self.engines[key]
+        brilcalc_main.create_engine = sharedEngine
+
+    def run(self, args):
+        # The output goes to a (private) file rather than to stdout here, since other threads may be printing.
+        fd, tempName = tempfile.mkstemp(prefix="brilcalc_", suffix=".csv")
+        os.close(fd)
+        try:
+            with self.lock:
+                savedArgv = sys.argv
+                sys.argv = ["brilcalc"] + args + ["-o", tempName]
+                try:
+                    self.module.brilcalc_main("brilcalc")
+                except SystemExit as ex:
+                    if ex.code is not None and ex.code != 0:
+                        return None
+                finally:
+                    sys.argv = savedArgv
+            with open(tempName) as outputFile:
+                return outputFile.read()
+        finally:
+            _removeEntry(tempName)
+
+# For queries run in parallel (runBrilcalcMany and runBrilcalcAsCompleted): each query is run in-process if the
+# in-process backend isn't busy with another one, and with the brilcalc command otherwise, so one of the parallel
+# queries at a time still saves starting brilcalc.
+class SharedInProcessBackend(object):
+    name = "inprocess+subprocess"
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def run(self, args):
+        if not self.backend.lock.acquire(False):
+            return _subprocessBackend.run(args)
+        try:
+            return self.backend.run(args)
+        finally:
+            self.backend.lock.release()
+
+_subprocessBackend = SubprocessBackend()
+_defaultBackend = None
+
+# The backend selected by BRILCALC_BACKEND. With auto, if brilws can't be imported or the in-process backend
+# can't be set up for any other reason (e.g. a version of brilws without create_engine in brilcalc_main), the
+# brilcalc command is used.
+def getBackend():
+    global _defaultBackend
+    if _defaultBackend is None:
+        _defaultBackend = _subprocessBackend
+        if BACKEND != "subprocess":
+            try:
+                _defaultBackend = InProcessBackend()
+            except Exception as ex:
+                if BACKEND == "inprocess":
+                    raise
+                if not isinstance(ex, ImportError):
+                    print("Warning: couldn't set up brilcalc in-process (%s: %s), using the brilcalc command instead" %
+                          (type(ex).__name__, ex))
+    return _defaultBackend
+
+# The backend for queries run in parallel.
+def _parallelBackend():
+    backend = getBackend()
+    if isinstance(backend, InProcessBackend):
+        return SharedInProcessBackend(backend)
+    return backend
+
+# Run brilcalc with the given arguments (e.g. ["lumi", "-f", "8000", "--byls"]; no -o) and return the output as
+# a BrilcalcOutput, or None if brilcalc failed. recentSeconds replaces RECENT_SECONDS for deciding whether the
+# result is stored, for a caller which knows that the fill is over (see fillWatcher.py).
+def runBrilcalc(args, useCache=True, backend=None, recentSeconds=None):
+    key = None
+    if useCache and CACHE_ENABLED and numpy is not None:
+        key = cacheKey(args)
+        output = _readEntry(key)
+        if output is not None and output.complete:
+            return output
+
+    if backend is None:
+        backend = getBackend()
+    args = [str(a) for a in args]
+    try:
+        text = backend.run(args)
+    except Exception as ex:
+        if backend is _subprocessBackend:
+            raise
+        print("Warning: running brilcalc in-process failed (%s: %s), running the brilcalc command instead" %
+              (type(ex).__name__, ex))
+        text = _subprocessBackend.run(args)
+    if text is None:
+        return None
+
+    try:
+        output = BrilcalcOutput.fromText(text)
+    except ValueError:
+        return None
+    if key is not None and _isCacheable(output, args, recentSeconds) and output.csvText() == text:
+        try:
+            _writeEntry(key, args, output)
+        except (OSError, IOError) as ex:
+            print("Warning: couldn't write to brilcalc cache %s: %s" % (CACHE_DIR, ex))
+    return output
+
+# Run brilcalc and yield the data rows (as lists of strings, like csv.reader) as soon as brilcalc writes them.
+# If the caller stops early (e.g. breaks out of the loop over the rows), brilcalc is stopped, so this is the way
+# to look at the beginning of a large query like a whole fill with --xing. The rows which were read are kept in
+# the cache as an incomplete entry (or a complete one if brilcalc finished), so running the same query again
+# gives those rows from the cache, and brilcalc is only run again if more rows are needed than it has.
+def streamBrilcalc(args, useCache=True):
+    args = [str(a) for a in args]
+    key = None
+    nCached = 0
+    if useCache and CACHE_ENABLED and numpy is not None:
+        key = cacheKey(args)
+        cached = _readEntry(key)
+        if cached is not None:
+            for i in range(len(cached)):
+                yield cached.row(i)
+            if cached.complete:
+                return
+            nCached = len(cached)
+
+    process = subprocess.Popen(["brilcalc"] + args + ["--output-style", "csv"], stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    lines = []
+    nData = 0
+    finished = False
+    try:
+        # Skip anything before the header and the summary after the data, and the rows we already have.
+        state = "before"
+        for line in process.stdout:
+            if line.startswith("#"):
+                if state == "before":
+                    state = "header"
+                elif state == "data":
+                    state = "after"
+            elif state == "header" or state == "data":
+                state = "data"
+                nData += 1
+            if state != "before":
+                lines.append(line)
+            if state == "data" and nData > nCached:
+                yield line.rstrip("\r\n").split(",")
+        finished = True
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+        if key is not None and nData > nCached and (process.returncode == 0 or not finished):
+            _storeStream(key, args, "".join(lines), finished)
+    if finished and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, ["brilcalc"] + args)
+
+# Keep the output read by streamBrilcalc() in the cache. If brilcalc was stopped, the last line might be cut off.
+def _storeStream(key, args, text, complete):
+    if not complete:
+        text = text[:text.rfind("\n")+1]
+    try:
+        output = BrilcalcOutput.fromText(text)
+    except ValueError:
+        return
+    output.complete = complete
+    if _isCacheable(output, args) and output.csvText() == text:
+        try:
+            _writeEntry(key, args, output)
+        except (OSError, IOError) as ex:
+            print("Warning: couldn't write to brilcalc cache %s: %s" % (CACHE_DIR, ex))
+
+# Run several brilcalc queries at the same time (at most maxJobs, default BRILCALC_JOBS or 4) and return the
+# outputs in the same order as the queries. Most of the time of a brilcalc call is spent starting up and waiting
+# for the database, so this is much faster than running them one after the other. The in-process backend can only
+# run one query at a time, so with it, each query is run in-process if it is free and with the brilcalc command
+# otherwise (see SharedInProcessBackend).
+def runBrilcalcMany(argsList, maxJobs=None, useCache=True, recentSeconds=None):
+    argsList = list(argsList)
+    nJobs = min(maxJobs or MAX_JOBS, len(argsList))
+    if nJobs <= 1:
+        return [runBrilcalc(args, useCache, recentSeconds=recentSeconds) for args in argsList]
+    backend = _parallelBackend()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nJobs) as executor:
+        return list(executor.map(lambda args: runBrilcalc(args, useCache, backend, recentSeconds), argsList))
+
+# Like runBrilcalcMany, but yield (index, output) for each query as soon as it is done rather than waiting for all
+# of them, so the caller can already work on the first results (e.g. the shards of a long time range) while the
+# others are still running.
+def runBrilcalcAsCompleted(argsList, maxJobs=None, useCache=True):
+    argsList = list(argsList)
+    nJobs = min(maxJobs or MAX_JOBS, len(argsList))
+    if nJobs <= 1:
+        for i, args in enumerate(argsList):
+            yield i, runBrilcalc(args, useCache)
+        return
+    backend = _parallelBackend()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nJobs) as executor:
+        futures = {executor.submit(runBrilcalc, args, useCache, backend): i for i, args in enumerate(argsList)}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+# All entries in the cache as (fileName, size, last used) tuples, least recently used first.
+def _listEntries():
+    if not os.path.isdir(CACHE_DIR):
+        return []
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".npz"):
+            fileName = os.path.join(CACHE_DIR, name)
+            try:
+                stat = os.stat(fileName)
+            except OSError:
+                continue
+            entries.append((fileName, stat.st_size, stat.st_mtime))
+    return sorted(entries, key=lambda e: e[2])
+
+# Remove the least recently used entries until the cache is below maxSize bytes.
+def evict(maxSize=None, keep=None):
+    if maxSize is None:
+        maxSize = CACHE_SIZE
+    entries = _listEntries()
+    total = sum(e[1] for e in entries)
+    for fileName, size, lastUsed in entries:
+        if total <= maxSize:
+            break
+        if fileName != keep:
+            _removeEntry(fileName)
+            total -= size
+
+def _entryMeta(fileName):
+    try:
+        with numpy.load(fileName) as entry:
+            return json.loads(str(entry["meta"]))
+    except Exception:
+        return None
+
+# Remove the entries which contain any of the given fills or runs or have the given datatag (all of them if
+# nothing is given). Returns the number of entries removed.
+def invalidate(fills=None, runs=None, datatag=None):
+    nRemoved = 0
+    for fileName, size, lastUsed in _listEntries():
+        if fills or runs or datatag:
+            meta = _entryMeta(fileName)
+            if meta is not None and not (set(fills or []) & set(meta["fills"]) or set(runs or []) & set(meta["runs"]) or
+                                         (datatag and meta["datatag"] == datatag)):
+                continue
+        _removeEntry(fileName)
+        nRemoved += 1
+    return nRemoved
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the brilcalc result cache in "+CACHE_DIR)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("info", help="Show the cache contents")
+    subparsers.add_parser("clear", help="Remove all entries")
+    invalidateParser = subparsers.add_parser("invalidate", help="Remove the entries for some fills, runs or a datatag")
+    invalidateParser.add_argument("-f", "--fill", type=int, nargs="+", default=[], help="Fill(s) to remove")
+    invalidateParser.add_argument("-r", "--run", type=int, nargs="+", default=[], help="Run(s) to remove")
+    invalidateParser.add_argument("--datatag", help="Remove the entries made with this datatag")
+    args = parser.parse_args()
+
+    if numpy is None:
+        print("NumPy is not available, so the brilcalc cache is not used.")
+        sys.exit(1)
+    if args.command == "clear":
+        print("Removed %d entries" % invalidate())
+    elif args.command == "invalidate":
+        if not (args.fill or args.run or args.datatag):
+            print("Please give the fills (-f), runs (-r) or datatag (--datatag) to invalidate, or use clear.")
+            sys.exit(1)
+        print("Removed %d entries" % invalidate(args.fill, args.run, args.datatag))
+    else:
+        entries = _listEntries()
+        for fileName, size, lastUsed in reversed(entries):
+            meta = _entryMeta(fileName) or {"args": ["?"], "datatag": None}
+            print("%s  %8.1f kB  %s  datatag %s  brilcalc %s%s" %
+                  (time.strftime("%Y-%m-%d %H:%M", time.localtime(lastUsed)), size/1024.0,
+                   os.path.basename(fileName)[:12], meta["datatag"], " ".join(meta["args"]),
+                   "" if meta.get("complete", True) else "  (first part only)"))
+        print("%d entries, %.1f of %.1f MB" % (len(entries), sum(e[1] for e in entries)/1024.0/1024.0,
+                                               CACHE_SIZE/1024.0/1024.0))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# bunchData.py
+#
+# Parsing of the per-bunch data from brilcalc lumi --xing. brilcalc writes this as one field per lumisection of
+# the form "[bx1 delivered1 recorded1 bx2 delivered2 recorded2 ...]", listing only the BXs above the --xingTr
+# threshold, and lumiValidate.py, getNBX.py, compareBXPatterns.py, and the scripts in Scripts/NBX all need it.
+# Rather than splitting each field and building Python lists or one pandas Series per lumisection, BunchData
+# parses the whole column at once into a compressed sparse row (CSR) layout:
+#
+#   offsets    (int64, one more than the number of lumisections): the entries for lumisection i are
+#              offsets[i]:offsets[i+1] in the arrays below
+#   bx         (uint16): the BX numbers (1-3564)
+#   delivered  (float32): the delivered luminosity in each BX
+#   recorded   (float32): the recorded luminosity in each BX
+#
+# For a typical fill this takes a small fraction of the memory of a dense lumisections x 3564 table. toDense()
+# gives the dense table if it's needed anyway, e.g. for plotting.
+#
+# Example:
+#
+#   data = BunchData.fromStrings(row[9] for row in rows)
+#   for i in range(len(data)):
+#       bx, delivered, recorded = data.row(i)
+
+import numpy
+
+# Number of BXs in an LHC orbit.
+NBX = 3564
+
+class BunchData(object):
+    def __init__(self, offsets, bx, delivered, recorded):
+        self.offsets = offsets
+        self.bx = bx
+        self.delivered = delivered
+        self.recorded = recorded
+
+    # Parse the per-bunch fields (one string per lumisection, with or without the brackets). The values are
+    # stored as float32 unless another dtype is given.
+    @classmethod
+    def fromStrings(cls, fields, dtype=numpy.float32):
+        inner = [f.strip().strip("[]").strip() for f in fields]
+        # brilcalc separates the values by single spaces, so the number of values is one more than the number of
+        # spaces. If that doesn't add up (e.g. extra whitespace), count them the slow way instead.
+        counts = numpy.array([s.count(" ") + 1 if s else 0 for s in inner], dtype=numpy.int64)
+        text = " ".join(s for s in inner if s)
+        values = numpy.fromstring(text, dtype=numpy.float64, sep=" ") if text else numpy.zeros(0)
+        if counts.sum() != len(values):
+            counts = numpy.array([len(s.split()) for s in inner], dtype=numpy.int64)
+            values = numpy.array(text.split(), dtype=numpy.float64)
+        if numpy.any(counts % 3 != 0):
+            raise ValueError("per-bunch data for lumisection %d doesn't consist of (bx, delivered, recorded) triplets" %
+                             int(numpy.nonzero(counts % 3)[0][0]))
+        offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts // 3, out=offsets[1:])
+        triplets = values.reshape(-1, 3)
+        return cls(offsets, triplets[:, 0].astype(numpy.uint16), triplets[:, 1].astype(dtype),
+                   triplets[:, 2].astype(dtype))
+
+    # The inverse of fromStrings: format lumisections first to last (default all) as "[bx delivered recorded ...]"
+    # with the given format for one triplet, e.g. "%d %.9f %.9f". If zeroBelow is given, values smaller than that
+    # are written as 0 the way brilcalc does it (a delivered value of 0 also gives a recorded value of 0).
+    def toStrings(self, tripletFormat, first=0, last=None, zeroBelow=None):
+        if last is None:
+            last = len(self)
+        entries = slice(self.offsets[first], self.offsets[last])
+        values = numpy.column_stack([self.bx[entries].astype(numpy.float64),
+                                     self.delivered[entries].astype(numpy.float64),
+                                     self.recorded[entries].astype(numpy.float64)]).ravel().tolist()
+        offsets = ((self.offsets[first:last+1] - self.offsets[first])*3).tolist()
+        small = None
+        if zeroBelow is not None:
+            small = (numpy.abs(self.delivered[entries]) < zeroBelow) | (numpy.abs(self.recorded[entries]) < zeroBelow)
+        bxFormat, deliveredFormat, recordedFormat = tripletFormat.split(" ")
+        rowFormats = {}
+        strings = []
+        for i in range(last - first):
+            start, end = offsets[i], offsets[i+1]
+            if small is not None and small[start//3:end//3].any():
+                # the slow way, one triplet at a time
+                triplets = []
+                for j in range(start, end, 3):
+                    bx, delivered, recorded = values[j:j+3]
+                    if abs(delivered) < zeroBelow:
+                        triplets.append((bxFormat + " 0 0") % bx)
+                    elif abs(recorded) < zeroBelow:
+                        triplets.append((bxFormat + " " + deliveredFormat + " 0") % (bx, delivered))
+                    else:
+                        triplets.append(tripletFormat % (bx, delivered, recorded))
+                strings.append("[" + " ".join(triplets) + "]")
+                continue
+            n = (end - start)//3
+            if n not in rowFormats:
+                rowFormats[n] = "[" + " ".join([tripletFormat]*n) + "]"
+            strings.append(rowFormats[n] % tuple(values[start:end]))
+        return strings
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # The BXs, delivered, and recorded luminosity for lumisection i.
+    def row(self, i):
+        first, last = self.offsets[i], self.offsets[i+1]
+        return self.bx[first:last], self.delivered[first:last], self.recorded[first:last]
+
+    # The number of BXs listed for each lumisection.
+    def counts(self):
+        return numpy.diff(self.offsets)
+
+    # The BXs which appear in any lumisection, sorted.
+    def filledBX(self):
+        return numpy.unique(self.bx)
+
+    # The lumisection (row) index of each entry.
+    def rowIndex(self):
+        return numpy.repeat(numpy.arange(len(self), dtype=numpy.int64), self.counts())
+
+    # A dense (lumisections x BXs) array of the delivered (or recorded) luminosity. By default there is one
+    # column for each BX from 1 to 3564; columns can be given as an array of BX numbers to only include those.
+    # BXs without data are set to missing.
+    def toDense(self, values="delivered", columns=None, missing=0.0):
+        data = getattr(self, values)
+        if columns is None:
+            columns = numpy.arange(1, NBX+1)
+        columnIndex = numpy.full(NBX+1, -1, dtype=numpy.int64)
+        columnIndex[columns] = numpy.arange(len(columns))
+        entryColumns = columnIndex[self.bx]
+        keep = entryColumns >= 0
+        dense = numpy.full((len(self), len(columns)), missing, dtype=numpy.float32)
+        dense[self.rowIndex()[keep], entryColumns[keep]] = data[keep]
+        return dense
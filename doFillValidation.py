@@ -10,9 +10,9 @@
 # - show the user a list of lumisections that are missing for each luminometer (hopefully none)
 # - give the user a chance to invalidate lumisections for a given luminometer, if they see things
 #   in the fill validation plot that suggest that these need to be invalidated.
-# Once this is done, this will write out the normtags (the overall normtag_BRIL and the normtags
-# for the individual luminometers) with the information from the new fill and then proceed to
-# the next.
+# Once this is done, this will save the information from the new fill for the normtags (the overall
+# normtag_BRIL and the normtags for the individual luminometers) and then proceed to the next. The
+# normtags are written out once all of the fills are done.
 
 import sys
 try:
@@ -22,7 +22,6 @@ except ImportError:
     sys.exit(1)
 import tkinter.messagebox
 import os
-import csv
 import argparse
 import json
 import smtplib
@@ -31,6 +30,14 @@ from email.mime.text import MIMEText
 import getpass # for username
 import socket  # for hostname
 import subprocess
+import tempfile
+import concurrent.futures
+from normtag import recordSortKey
+from brilcalcCache import runBrilcalcMany
+import fillmeta
+from fillWatcher import fillQueries, plotFileName
+from lumiTable import joinOutputs
+from lumiRatios import tableRatios, formatRatioStats
 # Check to make sure the brilcalc environment is properly set up.
 try:
     subprocess.check_output('which brilcalc',shell=True)
@@ -102,16 +109,18 @@ summaryEmailRecipients = ['alexey.shevelev@cern.ch', 'andres.delannoy@cern.ch',
 
 # Paths to various things.
 lumiValidatePath = "./lumiValidate.py"         # script for making fill validation plot
-getRecentFillPath = "./get_recentfill.py"      # helper script to find most recent fill
 logFileName = "./fillValidationLog.json"       # log JSON
 bestLumiFileName = "./normtag_BRIL.json"       # best lumi JSON
 lumiJSONFileNamePattern = "./normtag_%s.json"  # filename pattern for individual luminometer JSONs
 dbAuthFileName = "./db.ini"                    # authentication file for DB
 lockFileName = "lock.doFillValidation"         # lock file name
 sessionStateFileName = "sessionRestore.doFillValidation"  # saved session state file name
+journalFileName = "journal.doFillValidation"   # journal of completed fills not yet written to the JSON files
+sessionFiles = {}                              # the JSON files of this session, kept in memory (see loadSessionFile)
 
 # Constants
 eofRunNumber = 9999999 # dummy run number greater than any real run
+prefetchFills = 2      # number of upcoming fills whose data is fetched in the background (see startPrefetch)
 
 # Parse command-line arguments
 parser = argparse.ArgumentParser()
@@ -136,6 +145,8 @@ if args.add:
     addMode = True
     comments_name = args.add+'_comments'
     validation_name = args.add+'_validated_by'
+# This is stored with each fill in the journal (see below), since it determines how the fill is applied to the files.
+sessionMode = 'revalidate' if revalidateMode else ('add' if addMode else 'normal')
 
 # Before we even get started, check the variables set above to make sure that they are consistent. Otherwise,
 # we'll definitely have problems later on.
@@ -176,29 +187,6 @@ for t in list(emailTargets.values()):
         print("Please fix the variables at the top of the script and try again.")
         sys.exit(1)
 
-# Similarly, check the JSON files to make sure that they are valid. Otherwise, we're going to crash when we
-# try to update them.
-allJSONFiles = [logFileName, bestLumiFileName]
-for l in luminometers:
-    allJSONFiles.append(lumiJSONFileNamePattern % l)
-for j in allJSONFiles:
-    try:
-        with open(j, 'r') as jsonFile:
-            parsedData = json.load(jsonFile)
-    except IOError as ex:
-        print(("Couldn't open JSON file",j+":",ex.strerror))
-        print("Please make sure all input JSON files are present before running this script.")
-        sys.exit(1)
-    except ValueError as ex:
-        print(("Error parsing JSON file",j+":",ex.args[0]))
-        print("Please correct all problems in the input JSON files before running this script.")
-        print("Use Scripts/checkJSONSyntax.py to get more precise information on the problem in this file.")
-        sys.exit(1)
-    except:
-        print(("Unexpected error in JSON file",j))
-        print("Please correct all problems in the input JSON files before running this script.")
-        raise
-
 #### Subroutines begin here
 
 # This is the implementation for the dialog window to select new ranges to invalidate.
@@ -428,7 +416,29 @@ def doInvalidateDialog():
     root.wait_window(d.dwin)
     return
 
+# Show the fill summary plot. If fillWatcher.py has already made it, that is shown right away, with a button to
+# open the interactive version; otherwise lumiValidate.py is run to make it.
 def displayPlot():
+    plotFile = plotFileName(fillNumber)
+    if os.path.exists(plotFile):
+        try:
+            displaySavedPlot(plotFile)
+            return
+        except TclError as ex:
+            print("WARNING: couldn't show the plot "+plotFile+": "+str(ex))
+    displayInteractivePlot()
+
+def displaySavedPlot(plotFile):
+    image = PhotoImage(file=plotFile)
+    plotWindow = Toplevel(root)
+    plotWindow.title("Fill "+str(fillNumber)+" summary plot")
+    plotLabel = Label(plotWindow, image=image)
+    plotLabel.image = image  # keep a reference, otherwise the image is gone
+    plotLabel.pack()
+    Button(plotWindow, text="Open interactive plot", command=displayInteractivePlot).pack()
+    Button(plotWindow, text="Close", command=plotWindow.destroy).pack()
+
+def displayInteractivePlot():
     print("One second, creating fill summary plot...")
     # Separate luminometers into those that we use the online value for (with --type) and those that we need a
     # normtag for (i.e., those in requiresNormtag) that go with --normtag.
@@ -439,6 +449,15 @@ def displayPlot():
         cmd += ' --type '+' '.join(type_luminometers)
     if normtag_luminometers:
         cmd += ' --normtag '+' '.join(normtag_luminometers)
+    # Hand the data we already got in getValidSections over to lumiValidate.py, so that it doesn't have to call
+    # brilcalc for all of the luminometers again. lumiValidate.py removes the file once it has read it.
+    if fillData:
+        sharedData = {'fill': fillNumber, 'units': fillUnits,
+                      'data': dict((name, output.csvText()) for name, output in fillData.items())}
+        fd, sharedDataFileName = tempfile.mkstemp(prefix='plotData_'+str(fillNumber)+'_', suffix='.json')
+        with os.fdopen(fd, 'w') as sharedDataFile:
+            json.dump(sharedData, sharedDataFile)
+        cmd += ' --shared-data '+sharedDataFileName
     cmd += " --primary "+" ".join(primaryLuminometers)+" &"
     os.system(cmd)
     return
@@ -487,6 +506,8 @@ def exitWithoutSave():
     if len(completedFills) > 0:
         msg += " (Note: fills that you have already completed have already been saved.)"
     if tkinter.messagebox.askyesno("Are you sure?", msg):
+        stopPrefetch()
+        writeSessionFiles()
         if (len(completedFills) > 0):
             makeEmails()
             gitCommit()
@@ -593,52 +614,160 @@ def makeEmails():
     sendEmail(emailSubject, summaryEmailBody, summaryEmailRecipients)
 
 
-# Helper routine to get the valid lumisections for a given luminometer by calling brilcalc.
-# This is an adaption of bestLumi.py which stores the output in the giant dictionary defined below.
-
-def getValidSections(fillNumber, l):
-    print(("Please wait, getting valid lumisections for "+l))
-    tempFileName="temp_"+l+".csv"
-    if l in requiresNormtag:
-        l_argument = ' --normtag '+detectorTags[l]
-    else:
-        l_argument = ' --type '+l
-    os.system('brilcalc lumi -f '+str(fillNumber)+l_argument+' -b "STABLE BEAMS" --byls -o '+tempFileName)
+# Get the units to use for the luminosity values for this fill: Hz/ub for proton fills, Hz/mb for ion fills. These are
+# also the units that the validation plot uses (see displayPlot). The accelerator modes of all of the fills to
+# validate are looked up together at the start (see fillmeta.py), so this usually doesn't need the database.
+def getFillUnits(fillNumber):
+    try:
+        amodetag = fillmeta.amodetag(fillNumber)
+    except Exception as ex:
+        print("WARNING: couldn't get the accelerator mode of fill "+str(fillNumber)+", assuming proton physics: "+str(ex))
+        amodetag = None
+    if amodetag == "IONPHYS" or amodetag == "PAPHYS":
+        return "hz/mb"
+    return "hz/ub"
+
+# Get all of the brilcalc data for a fill and work out everything the main loop needs from it. The queries (the
+# lumi for each luminometer and the beam currents) are run in parallel (see runBrilcalcMany in brilcalcCache.py);
+# if fillWatcher.py is running, they are usually already in the cache. This returns a dictionary with:
+# - units: the units of the luminosity (see getFillUnits)
+# - outputs: the brilcalc output for each luminometer with data, for the validation plot and the ratios
+# - lumiSections: the recorded lumisections (see getValidSections), with the ones after the beam dump removed
+#   (see trimEndFill)
+# - found: the luminometers which had any lumisections at all, before the ones after the beam dump were removed
+# - runs: the runs in the fill, as strings (see getBeamCurrents)
+# Since this doesn't touch the GUI or the global state, it can run in the background (see startPrefetch).
+
+def fetchFillData(fillNumber):
+    units = getFillUnits(fillNumber)
+    queries = fillQueries(fillNumber, units, luminometers, requiresNormtag, detectorTags)
+    outputs = runBrilcalcMany(queries)
+    fill = {'units': units, 'outputs': {}, 'lumiSections': {}, 'found': set()}
+    getValidSections(fillNumber, outputs[:-1], fill['outputs'], fill['lumiSections'])
+    for r in fill['lumiSections']:
+        for ls in fill['lumiSections'][r]:
+            fill['found'].update(fill['lumiSections'][r][ls])
+    beamCurrents, startBeamCurrent, fill['runs'] = getBeamCurrents(outputs[-1])
+    if fill['found']:
+        trimEndFill(fill['lumiSections'], beamCurrents, startBeamCurrent)
+    return fill
+
+# Since getting the data for a fill takes a while, the data for the next prefetchFills fills is fetched and
+# processed (see fetchFillData) in a background thread while the user is working on the current one, so that the
+# next fill is ready as soon as the user is done with this one. prefetchedFills has the future for each fill
+# which has been queued. stopPrefetch() has to be called before the program exits once anything has been queued;
+# otherwise the background thread carries on with the queued fills while Python is shutting down, and their
+# brilcalc queries fail.
+
+prefetchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+prefetchedFills = {}
+
+def startPrefetch(fills):
+    for f in fills:
+        if f not in prefetchedFills:
+            prefetchedFills[f] = prefetchExecutor.submit(fetchFillData, f)
+
+def getFillData(fillNumber):
+    future = prefetchedFills.pop(fillNumber, None)
+    if future is not None:
+        try:
+            return future.result()
+        except Exception as ex:
+            # Just try again.
+            print("WARNING: getting the data for fill "+str(fillNumber)+" in the background failed: "+str(ex))
+    return fetchFillData(fillNumber)
+
+# Drop the fills which haven't been started yet, and wait for the one which is being fetched (if any).
+
+def stopPrefetch():
+    for f in prefetchedFills:
+        if not prefetchedFills[f].cancel() and not prefetchedFills[f].done():
+            print("Waiting for the data for fill "+str(f)+", which is being fetched in the background...")
+    prefetchExecutor.shutdown(wait=True)
+
+# Helper routine to get the valid lumisections for all luminometers from their brilcalc output. The outputs are
+# processed in the order of the luminometers list, so the result doesn't depend on which query finished first.
+
+def getValidSections(fillNumber, outputs, fillData, lumiSections):
+    for l, output in zip(luminometers, outputs):
+        addValidSections(fillNumber, l, output, fillData, lumiSections)
+    return
 
-    with open(tempFileName) as csv_input:
-        reader = csv.reader(csv_input, delimiter=',')
-        for row in reader:
-            if row[0][0] == '#':
-                continue
-            runfill=row[0].split(':')
-            run=int(runfill[0])
-            fill=int(runfill[1])
-            lsnums=row[1].split(':')
-            ls=int(lsnums[0])
-            thisdet=row[8]
-            # Sanity checks! If these ever actually appear I will be -very- surprised
-            if (fill != fillNumber):
-                print("WARNING: Output from brilcalc didn't match expected fill")
-            if (thisdet.lower() != l and l not in requiresNormtag):
-                print("WARNING: Output from brilcalc didn't contain expected detector")
-            # Stuff it in the dictionary!
-            if not run in recordedLumiSections:
-               recordedLumiSections[run] = {}
-            if ls in recordedLumiSections[run]:
-                recordedLumiSections[run][ls].add(l)
-            else:
-                recordedLumiSections[run][ls] = set([l])
+# Add the valid lumisections for one luminometer from its brilcalc output to lumiSections, a two-dimensional
+# dictionary with keys run number and lumisection number, where the value is the set of the luminometers present
+# for that lumisection. This is an adaption of bestLumi.py. The brilcalc output itself is also kept in fillData
+# for the validation plot.
 
-    os.unlink(tempFileName)
+def addValidSections(fillNumber, l, output, fillData, lumiSections):
+    if output is None:
+        print("WARNING: brilcalc failed to get the data for "+l+" for fill "+str(fillNumber))
+        return
+    fillData[detectorTags[l] if l in requiresNormtag else l] = output
+
+    for row in output.rows():
+        runfill=row[0].split(':')
+        run=int(runfill[0])
+        fill=int(runfill[1])
+        lsnums=row[1].split(':')
+        ls=int(lsnums[0])
+        thisdet=row[8]
+        # Sanity checks! If these ever actually appear I will be -very- surprised
+        if (fill != fillNumber):
+            print("WARNING: Output from brilcalc didn't match expected fill")
+        if (thisdet.lower() != l and l not in requiresNormtag):
+            print("WARNING: Output from brilcalc didn't contain expected detector")
+        # Stuff it in the dictionary!
+        if not run in lumiSections:
+           lumiSections[run] = {}
+        if ls in lumiSections[run]:
+            lumiSections[run][ls].add(l)
+        else:
+            lumiSections[run][ls] = set([l])
     return
 
+# Get the beam currents (the sum of the two beams) from the output of brilcalc beam, as a dictionary like the
+# recorded lumisections, so we can clean stray lumisections at the end. Returns the beam currents, the first one
+# (as a reference for trimEndFill), and the runs seen, as strings since that's what the JSON files use.
+
+def getBeamCurrents(output):
+    beamCurrents = {}
+    startBeamCurrent = -1
+    runs = set()
+    for row in (output.rows() if output is not None else []):
+        run=int(row[1])
+        ls=int(row[2])
+        beam1=float(row[5])
+        beam2=float(row[6])
+        if run not in beamCurrents:
+            beamCurrents[run] = {}
+        beamCurrents[run][ls] = (beam1+beam2)
+        if (startBeamCurrent == -1):
+            startBeamCurrent = (beam1+beam2) # save this as a reference
+        runs.add(str(run))
+    return beamCurrents, startBeamCurrent, runs
+
+# The median, MAD, and slopes vs. time and lumi of the ratios between the luminometers in this fill (see
+# lumiRatios.py), as text for the main window, so that the numbers we always look at in the validation plot can
+# be checked at a glance. As in the plot, only the ratios involving a primary luminometer are included.
+
+def ratioSummary():
+    if len(fillData) < 2:
+        return "Not enough luminometers with data for any ratios."
+    try:
+        table = joinOutputs(fillData, 'delivered('+fillUnits+')')
+        primary = [detectorTags[l] if l in requiresNormtag else l for l in primaryLuminometers]
+        ratioNames, ratios, stats = tableRatios(table, list(fillData), primary)
+    except Exception as ex:
+        return "Couldn't calculate the ratios: "+str(ex)
+    return formatRatioStats(ratioNames, stats)
+
 # Why do we bother with getting the beam currents? Here's why: sometimes the STABLE BEAMS flag is not cleared until several
 # lumisections after the fill actually ends (especially if the beam dump is unprogrammed). These lumisections are obviously
 # not actually useful and should be excluded. Since BCM1F is tied to the beam currents, it will also stop publishing when the
 # beam dump actually happens, so we may get spurious warnings about bcm1f not present if we do get these extra lumisections.
 # So...we look for cases where a) the beam currents are much lower (I use a factor of 50, although in practice it looks like
 # it's closer to 1e4) and b) BCM1F is not present, and drop those.
-def trimEndFill():
+def trimEndFill(recordedLumiSections, beamCurrents, startBeamCurrent):
     # reverse sort to start at end of fill
     for r in sorted(list(recordedLumiSections.keys()), reverse=True):
         if r not in beamCurrents:
@@ -673,32 +802,175 @@ def writeFormattedJSON(obj, fp, sortKeys):
     fp.write(",\n".join(outputLines))
     fp.write("\n]\n")
 
+# The JSON files (the log, bestlumi, and the individual luminometers) are read once at the start of the session
+# and kept in memory in sessionFiles, and each completed fill is applied to them there, rather than re-reading
+# and rewriting every file after every fill. So that nothing is lost if the session is interrupted, the changes
+# for each fill are first written to a journal file (one JSON object per line), which is replayed at the start
+# of the next session. The files themselves are then written once, by writeSessionFiles(), when the session
+# ends.
+
+def loadSessionFile(fileName, data=None):
+    with open(fileName, 'rb') as jsonFile:
+        contents = jsonFile.read()
+    if data is None:
+        data = json.loads(contents.decode('utf-8'))
+    sortKeys = (fileName == logFileName)
+    outputLines = [json.dumps(i, sort_keys=sortKeys) for i in data]
+    # If the file is exactly as writeFormattedJSON would write it, then new records at the end can just be
+    # appended in place.
+    canonical = (contents == ("[\n" + ",\n".join(outputLines) + "\n]\n").encode('utf-8'))
+    sessionFiles[fileName] = {'data': data, 'sortKeys': sortKeys, 'size': len(contents), 'nOriginal': len(data),
+                              'canonical': canonical, 'appendOnly': True, 'modified': False}
+
+def getSessionFile(fileName):
+    if fileName not in sessionFiles:
+        loadSessionFile(fileName)
+    return sessionFiles[fileName]
+
+# Apply the changes for one fill (as stored in the journal) to the files in memory. These are: the log entry
+# for the fill, the runs in the fill, and the new normtag records for each file. What to do with them depends
+# on the mode: normally they just go at the end; in revalidate mode, the old log entry and the old records for
+# these runs are replaced; and in add mode, the information for the new luminometer is added to the existing
+# log entry.
+
+def applyFillChanges(fillChanges):
+    logData = getSessionFile(logFileName)
+    logObject = fillChanges['log']
+    if fillChanges['mode'] == 'revalidate':
+        for i in range(len(logData['data'])):
+            if logData['data'][i]['fill'] == fillChanges['fill']:
+                logData['data'][i] = logObject
+        logData['appendOnly'] = False
+    elif fillChanges['mode'] == 'add':
+        for i in range(len(logData['data'])):
+            if logData['data'][i]['fill'] == fillChanges['fill']:
+                for k in logObject:
+                    if k in ['missing_lumisections', 'invalidated_lumisections']:
+                        logData['data'][i][k].extend(logObject[k])
+                    elif k != 'fill':
+                        logData['data'][i][k] = logObject[k]
+        logData['appendOnly'] = False
+    else:
+        logData['data'].append(logObject)
+    logData['modified'] = True
+
+    for fileName in fillChanges['records']:
+        jsonData = getSessionFile(fileName)
+        if fillChanges['mode'] == 'revalidate':
+            # Warning: if a run spans more than one fill, this could cause too much to be deleted, but I think
+            # that this case is unlikely enough that we can get away with it.
+            keptRecords = [x for x in jsonData['data'] if list(x[1].keys())[0] not in fillChanges['runs']]
+            jsonData['data'] = sorted(keptRecords + fillChanges['records'][fileName], key=recordSortKey)
+            jsonData['appendOnly'] = False
+        else:
+            jsonData['data'].extend(fillChanges['records'][fileName])
+        jsonData['modified'] = True
+
+def writeJournal(entry):
+    with open(journalFileName, 'a') as journalFile:
+        journalFile.write(json.dumps(entry)+"\n")
+        journalFile.flush()
+        os.fsync(journalFile.fileno())
+
+# Save the changes for a completed fill: first to the journal, then to the files in memory.
+
+def recordFillChanges(fillChanges):
+    writeJournal(fillChanges)
+    applyFillChanges(fillChanges)
+
+# Write all of the modified files out. This is done in two steps so that it can be safely redone if it gets
+# interrupted: first, the new contents are prepared (as FILE.new for files which have to be rewritten, or as
+# the text to write at the end for files which only had records appended to them) and this is saved in the
+# journal, and only then are the actual files changed (by commitSessionFiles). Once that's done, the journal
+# isn't needed any more.
+
+def writeSessionFiles():
+    commit = {}
+    for fileName in sessionFiles:
+        jsonData = sessionFiles[fileName]
+        newData = jsonData['data'][jsonData['nOriginal']:]
+        if jsonData['appendOnly'] and jsonData['canonical'] and jsonData['nOriginal'] > 0:
+            if not newData:
+                continue
+            outputLines = [json.dumps(i, sort_keys=jsonData['sortKeys']) for i in newData]
+            commit[fileName] = {'offset': jsonData['size']-3, 'text': ",\n" + ",\n".join(outputLines) + "\n]\n"}
+        elif jsonData['modified']:
+            with open(fileName+'.new', 'w') as jsonOutput:
+                writeFormattedJSON(jsonData['data'], jsonOutput, jsonData['sortKeys'])
+                jsonOutput.flush()
+                os.fsync(jsonOutput.fileno())
+            commit[fileName] = None
+    if commit:
+        writeJournal({'commit': commit})
+        commitSessionFiles(commit)
+        for fileName in commit:
+            loadSessionFile(fileName, sessionFiles[fileName]['data'])
+    if os.path.exists(journalFileName):
+        os.unlink(journalFileName)
+
+def commitSessionFiles(commit):
+    for fileName in commit:
+        if commit[fileName] is None:
+            # if FILE.new is gone, this was already done
+            if os.path.exists(fileName+'.new'):
+                os.replace(fileName+'.new', fileName)
+        else:
+            with open(fileName, 'r+b') as jsonFile:
+                jsonFile.seek(commit[fileName]['offset'])
+                jsonFile.write(commit[fileName]['text'].encode('utf-8'))
+                jsonFile.truncate()
+                jsonFile.flush()
+                os.fsync(jsonFile.fileno())
+
+# Read the journal left behind by an interrupted session.
+
+def readJournal():
+    entries = []
+    with open(journalFileName, 'r') as journalFile:
+        for line in journalFile:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # The last entry was only partially written, so that fill was never completed. Drop it so that
+                # new entries don't end up after it.
+                with open(journalFileName, 'w') as newJournalFile:
+                    for e in entries:
+                        newJournalFile.write(json.dumps(e)+"\n")
+                break
+    return entries
+
+# If the session was interrupted while writing out the files, finish that (before the files are read in, since
+# some of them may be incomplete).
+
+def finishInterruptedWrite():
+    entries = readJournal()
+    if entries and 'commit' in entries[-1]:
+        commitSessionFiles(entries[-1]['commit'])
+        os.unlink(journalFileName)
+        print("Finished writing the JSON files from the last session.")
+
+# Otherwise, apply the fills in the journal to the files in memory. The journal is kept until they are written
+# out. Returns the number of fills recovered.
+
+def recoverJournal():
+    entries = readJournal()
+    for e in entries:
+        applyFillChanges(e)
+    for fileName in sessionFiles:
+        if os.path.exists(fileName+'.new'):
+            os.unlink(fileName+'.new')
+    return len(entries)
+
 # This takes the output for a single fill and writes it out to the JSON files.
 
 def produceOutput():
-    # 1) Update log JSON with information for this fill.
+    # 1) Log entry for this fill. If we're in normal mode, this just goes at the end of the log. If we're in
+    # revalidate mode, then it replaces the old log entry. If we're in add mode, then it's added to the old one.
+    # Phew. (See applyFillChanges.)
     logObject = {'fill': fillNumber, validation_name: userName, comments_name: commentsEntry.get(1.0, END),
                  'missing_lumisections': missingLumiSections, 'invalidated_lumisections': invalidatedLumiSections}
-    # If we're in normal mode, just append the log entry to the end. If we're in revalidate mode, then replace
-    # the old log entry with the new one. If we're in add mode, then add the new log entry to the old one. Phew.
-    if revalidateMode:
-        for i in range(len(parsedLogData)):
-            if parsedLogData[i]['fill'] == fillNumber:
-                parsedLogData[i] = logObject
-    elif addMode:
-        for i in range(len(parsedLogData)):
-            if parsedLogData[i]['fill'] == fillNumber:
-                parsedLogData[i][validation_name] = userName
-                parsedLogData[i][comments_name] = logObject[comments_name]
-                for x in missingLumiSections:
-                    parsedLogData[i]['missing_lumisections'].append(x)
-                for x in invalidatedLumiSections:
-                    parsedLogData[i]['invalidated_lumisections'].append(x)
-    else:
-        parsedLogData.append(logObject)
-
-    with open(logFileName, 'w') as jsonOutput:
-        writeFormattedJSON(parsedLogData, jsonOutput, True)
+    fillChanges = {'fill': fillNumber, 'mode': sessionMode, 'log': logObject, 'runs': sorted(runsSeenThisFill),
+                   'records': {}}
 
     # The issue at beginning/end of run for BCM1F has been fixed, so no need to do any automatic invalidation
     # any more. Yay!
@@ -713,14 +985,7 @@ def produceOutput():
 
     # 2) Next, do bestlumi. This is the most complicated...
     if not addMode:
-        with open(bestLumiFileName, 'r') as bestLumiFile:
-            parsedBestLumiData = json.load(bestLumiFile)
-
-        # If we're in revalidate mode, then delete the runs in this fill from the JSON file. Warning: if a run
-        # spans more than one fill, this could cause too much to be deleted, but I think that this case is
-        # unlikely enough that we can get away with it.
-        if revalidateMode:
-            parsedBestLumiData = [x for x in parsedBestLumiData if list(x[1].keys())[0] not in runsSeenThisFill]
+        parsedBestLumiData = []
 
         lastLumin = ""
         lastRun = -1
@@ -758,14 +1023,7 @@ def produceOutput():
             jsonRecord = [detectorTags[lastLumin], {str(lastRun): [[startLS, lastLS]]}]
             parsedBestLumiData.append(jsonRecord)
 
-        # Re-sort the list if we've appended things that should actually go in the middle.
-        if revalidateMode:
-            # sort first by run number, then by first LS number. this looks ugly because of the format of the JSON file, but that's what it is.
-            # we could in theory go deeper, but these two keys should be sufficient.
-            parsedBestLumiData = sorted(parsedBestLumiData, key=lambda x: (int(list(x[1].keys())[0]), list(x[1].values())[0][0][0]))
-
-        with open(bestLumiFileName, 'w') as bestLumiFile:
-            writeFormattedJSON(parsedBestLumiData, bestLumiFile, False)
+        fillChanges['records'][bestLumiFileName] = parsedBestLumiData
 
     # Now the individual luminometers. This is similar to the above but of course without
     # the fallback if a luminometer is missing. Note if we're in add mode, then we only need
@@ -773,12 +1031,7 @@ def produceOutput():
     lumiList = [args.add] if addMode else luminometers
     for l in lumiList:
         lumiJSONFileName = lumiJSONFileNamePattern % l
-        with open(lumiJSONFileName, 'r') as lumiJSONFile:
-            parsedLumiJSONData = json.load(lumiJSONFile)
-
-        # If we're in revalidate mode, then delete the runs in this fill from the JSON file.
-        if revalidateMode:
-            parsedLumiJSONData = [x for x in parsedLumiJSONData if list(x[1].keys())[0] not in runsSeenThisFill]
+        parsedLumiJSONData = []
 
         lastRun = -1
         startLS = -1
@@ -804,14 +1057,11 @@ def produceOutput():
             jsonRecord = [detectorTags[l], {str(lastRun): [[startLS, lastLS]]}]
             parsedLumiJSONData.append(jsonRecord)
 
-        # As above, re-sort the list if necessary.
-        if revalidateMode:
-            parsedLumiJSONData = sorted(parsedLumiJSONData, key=lambda x: (int(list(x[1].keys())[0]), list(x[1].values())[0][0][0]))
+        fillChanges['records'][lumiJSONFileName] = parsedLumiJSONData
 
-        with open(lumiJSONFileName, 'w') as lumiJSONFile:
-            writeFormattedJSON(parsedLumiJSONData, lumiJSONFile, False)
-
-    print(("Finished writing output for fill "+str(fillNumber)))
+    # The files themselves are written at the end of the session.
+    recordFillChanges(fillChanges)
+    print(("Finished saving output for fill "+str(fillNumber)))
 
     # 3) Copy the email information for this fill into the overall emailInformation dictionary.
     for l in emailRecipients:
@@ -882,15 +1132,55 @@ if os.path.exists(sessionStateFileName):
         emailInformation[l] = list(savedSessionState['email_information'][l])
     readSavedSession = True
 
+# If the last session was interrupted while it was writing out the JSON files, finish that first, since some
+# of them may be incomplete.
+if os.path.exists(journalFileName):
+    finishInterruptedWrite()
+
+# Next, check the JSON files to make sure that they are valid. Otherwise, we're going to crash when we try to
+# update them. This also reads them into memory, where they stay for the rest of the session.
+allJSONFiles = [logFileName, bestLumiFileName]
+for l in luminometers:
+    allJSONFiles.append(lumiJSONFileNamePattern % l)
+for j in allJSONFiles:
+    try:
+        loadSessionFile(j)
+    except IOError as ex:
+        print(("Couldn't open JSON file",j+":",ex.strerror))
+        print("Please make sure all input JSON files are present before running this script.")
+        os.unlink(lockFileName)
+        sys.exit(1)
+    except ValueError as ex:
+        print(("Error parsing JSON file",j+":",ex.args[0]))
+        print("Please correct all problems in the input JSON files before running this script.")
+        print("Use Scripts/checkJSONSyntax.py to get more precise information on the problem in this file.")
+        os.unlink(lockFileName)
+        sys.exit(1)
+    except:
+        print(("Unexpected error in JSON file",j))
+        print("Please correct all problems in the input JSON files before running this script.")
+        os.unlink(lockFileName)
+        raise
+
+# If there are fills from an interrupted session in the journal, apply them to the files in memory.
+if os.path.exists(journalFileName):
+    nRecovered = recoverJournal()
+    print("Recovered "+str(nRecovered)+" completed fill"+("" if nRecovered == 1 else "s")+" from the journal of the last session.")
+
 # First read in the validation log so we can see what the last fill validated was.
-logFile = open(logFileName, 'r')
-parsedLogData = json.load(logFile)
+parsedLogData = sessionFiles[logFileName]['data']
 # In principle the most recent fill should be the last entry -- but let's protect ourselves against
 # strange things happening and just go over the whole thing
 lastFill = -1
 for f in parsedLogData:
     if int(f['fill']) > lastFill:
         lastFill = int(f['fill'])
+# Bring the local fill metadata mirror up to date (see fillmeta.py), so that the fill list and the accelerator
+# modes below don't need the database.
+try:
+    fillmeta.sync()
+except Exception as ex:
+    print("WARNING: couldn't update the fill metadata mirror: "+str(ex))
 # Next, get the list of new fills.
 if revalidateMode:
     fillList = args.revalidate
@@ -901,13 +1191,14 @@ elif addMode:
         if comments_name not in f:
             fillList.append(int(f['fill']))
 else:
-    #fillList = eval(os.popen("python "+getRecentFillPath+" -p "+dbAuthFileName+" -f "+str(lastFill)).read())
-    #fillList = eval(os.popen("python "+getRecentFillPath+" -f "+str(lastFill)).read())
-
-    # popen is is considered outdated and discouraged in favor of the more powerful and secure subprocess module, April  2025
-    fillList = eval(subprocess.run(["python", getRecentFillPath, "-f "+str(lastFill)], capture_output=True, text=True).stdout)
+    fillList = fillmeta.fillsSince(lastFill)
 
 nfills = len(fillList)
+# Look up the accelerator modes (for getFillUnits) of all of the fills with one query.
+try:
+    fillmeta.amodetags(fillList)
+except Exception as ex:
+    print("WARNING: couldn't get the accelerator modes of the fills: "+str(ex))
 
 if len(fillList) == 0:
     tkinter.messagebox.showinfo("Nothing to do!", "It looks like there are no new fills to validate. Thanks for checking!")
@@ -938,22 +1229,14 @@ with open(lockFileName, 'w') as lockFile:
 currentFillSaved = False
 
 # Now, loop over each fill and do the validation for each.
-for fillNumber in fillList:
-    # This is a two-dimensional dictionary with keys: run number and lumisection number.
-    # The value is a set of the luminometers that are present for that lumisection.
-    recordedLumiSections = {}
+for fillIndex, fillNumber in enumerate(fillList):
     # This is an array of strings containing information on the invalidated lumi sections.
     invalidatedLumiSections = []
     # This is an array of objects containing information on the missing lumi sections.
     missingLumiSections = []
-    # This is a dictionary like recordedLumiSections containing the beam currents.
-    beamCurrents = {}
     emailInformationThisFill = {}
     for l in emailRecipients:
         emailInformationThisFill[l] = []
-    # This tracks the runs seen in the current fill, so that if we're in revalidation mode we can delete the
-    # old data from the normtag files.
-    runsSeenThisFill = set()
 
     # If we read in the saved session state, go ahead and populate various variables from that. Otherwise, just populate it afresh
     # for the new fill.
@@ -968,6 +1251,7 @@ for fillNumber in fillList:
     else:
         if (fillNumber != savedSessionState['current_fill']):
             tkinter.messagebox.showerror("Bad data", "Fatal error: The fill stored in the saved session data does not match the current fill. Please consult an expert.")
+            stopPrefetch()
             sys.exit(1)
         lumiPriority = list(savedSessionState['lumi_priority'])
 
@@ -976,30 +1260,33 @@ for fillNumber in fillList:
         invalidatedLumiSections = copy.deepcopy(savedSessionState['invalidated_lumi_sections'])
         savedSessionState['invalidated_lumi_sections'] = invalidatedLumiSections
 
-    # 1) Get the list of lumi sections recorded for each luminometer and the beam currents.
+    # 1) Get the list of lumi sections recorded for each luminometer and the beam currents (see fetchFillData).
+    # Usually this was already done in the background while the user was working on the previous fill.
 
     print(("Getting data for fill "+str(fillNumber)+"..."))
-    for l in luminometers:
-        getValidSections(fillNumber, l)
+    fill = getFillData(fillNumber)
+    startPrefetch(fillList[fillIndex+1:fillIndex+1+prefetchFills])
+    fillUnits = fill['units']
+    # The brilcalc output for each luminometer (see getValidSections).
+    fillData = fill['outputs']
+    # This is a two-dimensional dictionary with keys: run number and lumisection number.
+    # The value is a set of the luminometers that are present for that lumisection. The lumisections after the
+    # beam dump have already been removed (see trimEndFill).
+    recordedLumiSections = fill['lumiSections']
+    # This tracks the runs seen in the current fill, so that if we're in revalidation mode we can delete the
+    # old data from the normtag files.
+    runsSeenThisFill = fill['runs']
     
     # See if we actually got any data for this fill. This proceeds rather differently if we're in add mode or not, so...
     if not addMode:
-        if len(recordedLumiSections) == 0:
+        if len(fill['found']) == 0:
             tkinter.messagebox.showwarning("No data for fill", "Note: no data with STABLE BEAMS was found for fill "+str(fillNumber)+" in the luminosity DB. Perhaps this fill never reached STABLE BEAMS. Otherwise, please contact an expert.")
             # Do log it though!
+            # If we're in revalidate mode, then this replaces the old log entry. No idea why you would want to
+            # revalidate an empty fill, but we should cover this case just in case!
             logObject = {'fill': fillNumber, validation_name: userName, comments_name: 'No data in lumiDB for this fill',
                          'missing_lumisections': [], 'invalidated_lumisections': []}
-            # If we're in revalidate mode, then replace the old log entry with the new one. No idea why you would want to
-            # revalidate an empty fill, but we should cover this case just in case!
-            if revalidateMode:
-                for i in range(len(parsedLogData)):
-                    if parsedLogData[i]['fill'] == fillNumber:
-                        parsedLogData[i] = logObject
-            else:
-                # Otherwise, just append this to the end like normal.
-                parsedLogData.append(logObject)
-            with open(logFileName, 'w') as jsonOutput:
-                writeFormattedJSON(parsedLogData, jsonOutput, True)
+            recordFillChanges({'fill': fillNumber, 'mode': sessionMode, 'log': logObject, 'runs': [], 'records': {}})
 
             # Mark as finished and move onto next fill.
             completedFills.append(fillNumber)
@@ -1008,21 +1295,11 @@ for fillNumber in fillList:
             readSavedSession = False
             continue
     else:
-        hasData = False
-        for r in recordedLumiSections:
-            for ls in recordedLumiSections[r]:
-                if args.add in recordedLumiSections[r][ls]:
-                    hasData = True
-        if not hasData:
+        if args.add not in fill['found']:
             tkinter.messagebox.showwarning("No data for fill", "Note: no data for "+args.add+" was found for fill "+str(fillNumber)+" in the luminosity DB. Presumably this luminometer was not present for this fill. Otherwise, please contact an expert.")
             # Find the fill in the log file and add the comment in for it.
-            for i in range(len(parsedLogData)):
-                if parsedLogData[i]['fill'] == fillNumber:
-                    parsedLogData[i][comments_name] = 'No '+args.add+' data in lumiDB for this fill'
-                    parsedLogData[i][validation_name] = userName
-
-            with open(logFileName, 'w') as jsonOutput:
-                writeFormattedJSON(parsedLogData, jsonOutput, True)
+            logObject = {'fill': fillNumber, validation_name: userName, comments_name: 'No '+args.add+' data in lumiDB for this fill'}
+            recordFillChanges({'fill': fillNumber, 'mode': sessionMode, 'log': logObject, 'runs': [], 'records': {}})
 
             # Mark as finished and move onto next fill.
             completedFills.append(fillNumber)
@@ -1031,30 +1308,6 @@ for fillNumber in fillList:
             readSavedSession = False
             continue
 
-    # Get beam currents so we can clean stray lumisections at the end.
-    print("Please wait, getting beam currents")
-    os.system('brilcalc beam -f '+str(fillNumber)+' -b "STABLE BEAMS" -o temp_beam.csv')
-    startBeamCurrent=-1
-    with open('temp_beam.csv') as csv_input:
-        reader = csv.reader(csv_input, delimiter=',')
-        for row in reader:
-            if row[0][0] == '#':
-                continue
-            run=int(row[1])
-            ls=int(row[2])
-            beam1=float(row[5])
-            beam2=float(row[6])
-            if run not in beamCurrents:
-                beamCurrents[run] = {}
-            beamCurrents[run][ls] = (beam1+beam2)
-            if (startBeamCurrent == -1):
-                startBeamCurrent = (beam1+beam2) # save this as a reference
-            runsSeenThisFill.add(str(run)) # use a string here because the JSON files use strings
-    os.unlink('temp_beam.csv')
-
-    # Clean extra lumisections after the beam dump.
-    trimEndFill()
-
     # 2) Display the fill validation plot.
 
     displayPlot()
@@ -1113,6 +1366,12 @@ for fillNumber in fillList:
     invalList = Text(root, width=60, height=15)
     invalList.grid(row=11, column=1, columnspan=3)
 
+    ratioLabel = Label(root, text='Luminometer ratios')
+    ratioLabel.grid(row=12, column=0, columnspan=4)
+    ratioList = Text(root, width=100, height=8, font=('Courier', 10))
+    ratioList.grid(row=13, column=0, columnspan=4)
+    ratioList.insert(END, ratioSummary())
+
     # 4) Look for missing lumisections and populate the missing lumisections field appropriately.
     # If we're in add mode, only do this check for the added luminometer.
     lumiList = [args.add] if addMode else luminometers
@@ -1184,6 +1443,7 @@ for fillNumber in fillList:
     # Disable missing and invalidated fields
     missingList.config(state=DISABLED)
     invalList.config(state=DISABLED)
+    ratioList.config(state=DISABLED)
 
     root.mainloop()
 
@@ -1192,6 +1452,8 @@ for fillNumber in fillList:
     # we should just exit semi-gracefully.
     if not currentFillSaved:
         print("Application closed.")
+        stopPrefetch()
+        writeSessionFiles()
         os.unlink(lockFileName)
         sys.exit(1)
 
@@ -1201,6 +1463,8 @@ for fillNumber in fillList:
     root = Tk()
 
 print("Validation complete. Thanks!")
+stopPrefetch()
+writeSessionFiles()
 makeEmails()
 gitCommit()
 os.unlink(lockFileName)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# fillWatcher.py
+#
+# Waits for new fills and gets everything that doFillValidation.py needs for them ready before anyone starts a
+# validation session. For each fill after the last one in the validation log, once the fill is over, this:
+# - runs the brilcalc queries of doFillValidation.py (the lumi for each luminometer, and the beam currents), so
+#   that they are parsed and stored in the brilcalc cache (see brilcalcCache.py), and
+# - makes the fill validation plot with lumiValidate.py --save, which doFillValidation.py then shows right away
+#   instead of waiting for lumiValidate.py (it can still open the interactive plot from there).
+#
+# The new fills come from the local fill metadata mirror (see fillmeta.py), which is synced on every poll, so
+# all of the polling goes through the one pooled database connection of fillmeta. If there's nothing new (or the
+# database can't be reached), the time between polls is doubled, up to --max-interval; as soon as there is a new
+# fill it goes back to --interval. A fill is considered over once there is a newer fill and its last lumisection
+# is more than --settle seconds old. Normally the cache doesn't keep results for the most recent 6 hours, since a
+# fill might still be going on; since this only fetches fills which are over, it keeps them after --settle.
+#
+# The luminometers and tags are read from doFillValidation.py, so they only have to be changed there.
+#
+# Usage:
+#   python3 fillWatcher.py                  (runs until stopped)
+#   python3 fillWatcher.py --once           (checks for new fills once, e.g. from cron)
+
+import os
+import sys
+import ast
+import json
+import time
+import argparse
+import subprocess
+import fillmeta
+from brilcalcCache import runBrilcalcMany, CACHE_DIR
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+VALIDATION_SCRIPT = os.path.join(BASE_DIR, "doFillValidation.py")
+# The settings of doFillValidation.py which are needed here.
+SETTINGS = ["luminometers", "requiresNormtag", "detectorTags", "primaryLuminometers", "logFileName",
+            "lumiValidatePath"]
+PLOT_DIR = os.path.join(CACHE_DIR, "plots")
+
+# Read the settings from doFillValidation.py (without running it, since that starts the GUI). Relative paths are
+# relative to the directory of doFillValidation.py, which is where it is run from.
+def readSettings(fileName=VALIDATION_SCRIPT):
+    with open(fileName) as f:
+        tree = ast.parse(f.read(), fileName)
+    settings = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in SETTINGS:
+                settings[name] = ast.literal_eval(node.value)
+    missing = [name for name in SETTINGS if name not in settings]
+    if missing:
+        raise ValueError("couldn't find %s in %s" % (", ".join(missing), fileName))
+    for name in ["logFileName", "lumiValidatePath"]:
+        settings[name] = os.path.join(os.path.dirname(os.path.abspath(fileName)), settings[name])
+    return settings
+
+# The brilcalc queries for the validation of a fill: the lumi for each luminometer (with --type, or the detector
+# tag for those in requiresNormtag) in the order of the luminometers list, and then the beam currents.
+def fillQueries(fill, units, luminometers, requiresNormtag, detectorTags):
+    queries = []
+    for l in luminometers:
+        if l in requiresNormtag:
+            l_argument = ['--normtag', detectorTags[l]]
+        else:
+            l_argument = ['--type', l]
+        queries.append(['lumi', '--byls', '-u', units, '-f', str(fill), '-b', 'STABLE BEAMS'] + l_argument)
+    queries.append(['beam', '-f', str(fill), '-b', 'STABLE BEAMS'])
+    return queries
+
+# Where the validation plot of a fill is saved.
+def plotFileName(fill):
+    return os.path.join(PLOT_DIR, "fill_%d.png" % int(fill))
+
+# The most recent fill in the validation log.
+def lastValidatedFill(logFileName):
+    with open(logFileName) as f:
+        return max(int(entry['fill']) for entry in json.load(f))
+
+def log(message):
+    print(time.strftime("%Y-%m-%d %H:%M:%S"), message, flush=True)
+
+# Fetch the data of a fill and make its plot. Returns True if everything worked.
+def prepareFill(fill, settings, settle):
+    # Like getFillUnits in doFillValidation.py, but without a fallback: data with the wrong units shouldn't end up
+    # in the cache, so in that case the fill is just tried again later.
+    amodetag = fillmeta.amodetag(fill)
+    units = "hz/mb" if amodetag == "IONPHYS" or amodetag == "PAPHYS" else "hz/ub"
+    queries = fillQueries(fill, units, settings["luminometers"], settings["requiresNormtag"],
+                          settings["detectorTags"])
+    start = time.time()
+    outputs = runBrilcalcMany(queries, recentSeconds=settle)
+    failed = [" ".join(q) for q, output in zip(queries, outputs) if output is None]
+    if failed:
+        log("brilcalc failed for fill %d: %s" % (fill, "; ".join(failed)))
+        return False
+    log("got the data for fill %d in %.1f s" % (fill, time.time() - start))
+
+    # The same plot as displayPlot in doFillValidation.py; lumiValidate.py gets the data from the cache.
+    luminometers = settings["luminometers"]
+    cmd = [sys.executable, settings["lumiValidatePath"], "-f", str(fill), "-b", "STABLE BEAMS"]
+    types = [l for l in luminometers if l not in settings["requiresNormtag"]]
+    normtags = [settings["detectorTags"][l] for l in luminometers if l in settings["requiresNormtag"]]
+    if types:
+        cmd += ["--types"] + types
+    if normtags:
+        cmd += ["--normtags"] + normtags
+    cmd += ["--primary"] + settings["primaryLuminometers"]
+    os.makedirs(PLOT_DIR, exist_ok=True)
+    # Write the plot under another name first, so that doFillValidation.py never shows a half-written one.
+    fileName = plotFileName(fill)
+    tmpFileName = fileName[:-len(".png")] + ".tmp.png"
+    start = time.time()
+    try:
+        subprocess.run(cmd + ["--save", tmpFileName], check=True, cwd=BASE_DIR,
+                       env=dict(os.environ, MPLBACKEND="agg"))
+    except (OSError, subprocess.CalledProcessError) as ex:
+        log("making the plot for fill %d failed: %s" % (fill, ex))
+        return False
+    os.replace(tmpFileName, fileName)
+    log("made the plot for fill %d in %.1f s: %s" % (fill, time.time() - start, fileName))
+    return True
+
+# One poll: sync the mirror, and prepare the fills after the last validated one which are over and which haven't
+# been done yet. Returns the number of fills which were prepared.
+def poll(settings, settle, done):
+    fillmeta.sync()
+    fills = fillmeta.fillsSince(lastValidatedFill(settings["logFileName"]))
+    pending = [f for f in fills[:-1] if f not in done]
+    if not pending:
+        return 0
+    times = fillmeta.fillTimes(pending)
+    nPrepared = 0
+    for fill in pending:
+        start, end = times.get(fill) or (None, None)
+        if end is None:
+            # No lumisections at all (e.g. a fill without beam), so there's nothing to fetch.
+            log("fill %d has no lumisections, skipping it" % fill)
+            done.add(fill)
+            continue
+        if time.time() - end < settle:
+            continue
+        if os.path.exists(plotFileName(fill)):
+            done.add(fill)
+            continue
+        log("preparing fill %d" % fill)
+        if prepareFill(fill, settings, settle):
+            done.add(fill)
+            nPrepared += 1
+    return nPrepared
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch the data and make the validation plot for new fills as soon as they are over.")
+    parser.add_argument('-i', '--interval', type=float, default=60, help='Seconds between polls when there are new fills. Default: %(default)s')
+    parser.add_argument('-m', '--max-interval', type=float, default=900, help='Maximum seconds between polls when there is nothing new. Default: %(default)s')
+    parser.add_argument('-s', '--settle', type=float, default=1800, help='Seconds after the last lumisection of a fill before it is fetched. Default: %(default)s')
+    parser.add_argument('-l', '--log-file', help='Validation log to take the last validated fill from. Default: the one of doFillValidation.py')
+    parser.add_argument('--once', action='store_true', help='Poll only once and exit.')
+    args = parser.parse_args()
+
+    settings = readSettings()
+    if args.log_file:
+        settings["logFileName"] = args.log_file
+    done = set()
+    interval = args.interval
+    while True:
+        try:
+            nPrepared = poll(settings, args.settle, done)
+        except Exception as ex:
+            log("polling failed: %s" % ex)
+            nPrepared = 0
+        if args.once:
+            break
+        if nPrepared > 0:
+            interval = args.interval
+        else:
+            interval = min(interval*2, args.max_interval)
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+# fillmeta.py
+#
+# Fill metadata from the lumi DB (cms_lumi_prod): which fills there are, their accelerator mode, their start and
+# end times, and their runs. doFillValidation.py and lumiValidate.py used to get these by running
+# get_recentfill.py and get_fill_amodetag.py, which meant starting a new Python interpreter, parsing db.ini,
+# and opening a new Oracle connection for every single question. This module keeps one connection pool for the
+# whole session, answers questions for several fills with one query, and remembers the answers for
+# FILLMETA_TTL seconds (default 300), so e.g. the units of a fill are only looked up once even though both the
+# prefetching and the validation of the fill need them. It can be used from several threads.
+#
+# Example:
+#
+#   import fillmeta
+#   newFills = fillmeta.fillsSince(8000)
+#   modes = fillmeta.amodetags(newFills)      # {fill: "PROTPHYS", ...}
+#   times = fillmeta.fillTimes(newFills)      # {fill: (start, end), ...} in seconds since the epoch
+#   runs = fillmeta.fillRuns(newFills)        # {fill: [run, ...], ...}
+#
+# The database service is read from the authentication file BRILDB_AUTHFILE (default /brildata/db/db.ini),
+# service "online"; use setService() to pick another one. Besides Oracle, a service can have protocol sqlite, in
+# which case the descriptor is a SQLite file with the same tables (e.g. the stand-in in Standin/).
+#
+# Since the metadata of a fill doesn't change any more once the fill is over, it can also be kept in a local
+# mirror (.fillmeta.sqlite in this directory, or FILLMETA_MIRROR if set) with the lhcfill table and the runs of
+# each fill. sync() (or "python3 fillmeta.py sync") updates the mirror, fetching only the fills from the most
+# recent one already mirrored on (that one again, since it might not have been over yet). After that, lookups for
+# mirrored fills are answered from the mirror without asking the database, which also works offline; the most
+# recent mirrored fill, and the list of new fills, only come from the mirror for FILLMETA_TTL seconds after the
+# last sync. fillInfo() gives the full mirrored information for a range of fills, e.g. for makeDTNormtag.py.
+#
+#   python3 fillmeta.py sync
+#   python3 fillmeta.py info
+
+import os
+import sys
+import time
+import base64
+import argparse
+import sqlite3
+import threading
+from configparser import ConfigParser
+
+AUTH_FILE = os.environ.get("BRILDB_AUTHFILE", "/brildata/db/db.ini")
+SERVICE = "online"
+TTL = float(os.environ.get("FILLMETA_TTL", "300"))
+SCHEMA = "cms_lumi_prod"
+MIRROR_FILE = os.environ.get("FILLMETA_MIRROR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fillmeta.sqlite"))
+STABLE_BEAMS = 11
+
+MIRROR_SCHEMA = '''
+create table if not exists lhcfill (fillnum integer primary key, timestampsec integer, norb integer, nbperls integer,
+                                    amodetagid integer, numbxbeamactive integer, targetegev integer);
+create table if not exists runs (runnum integer primary key, fillnum integer, firstls integer, lastls integer,
+                                 starttime integer, endtime integer, nstable integer);
+create index if not exists runs_fill on runs (fillnum);
+create table if not exists syncinfo (key text primary key, value);
+'''
+
+AMODETAGS = {1: "PROTPHYS", 2: "IONPHYS", 3: "PAPHYS"}
+# Length of a lumisection in seconds, to get the end of the last lumisection of a fill.
+LS_SECONDS = 2**18*3564/40.0790e6
+
+def parseServiceMap(authFile):
+    '''
+    parse service config ini file
+    output: {servicealias:[protocol,user,passwd,descriptor]}
+    '''
+    result = {}
+    parser = ConfigParser()
+    parser.read(authFile)
+    for s in parser.sections():
+        result[s] = [parser.get(s, 'protocol'), parser.get(s, 'user'), parser.get(s, 'pwd'), parser.get(s, 'descriptor')]
+    return result
+
+# A connection to one database service: a pooled SQLAlchemy engine for Oracle, or a single SQLite connection
+# (with the file attached as cms_lumi_prod, so that the queries are the same). execute() takes a query with
+# :name parameters and returns the rows as tuples.
+class FillMetadataDB(object):
+    def __init__(self, service):
+        protocol, user, passwd, descriptor = service
+        self.lock = threading.Lock()
+        self.engine = None
+        self.sqlite = None
+        if protocol == "sqlite":
+            self.sqlite = sqlite3.connect(":memory:", check_same_thread=False)
+            self.sqlite.execute("attach database ? as %s" % SCHEMA, (descriptor,))
+        else:
+            from sqlalchemy import create_engine
+            passwd = base64.b64decode(passwd).decode("UTF-8")
+            self.engine = create_engine("oracle+cx_oracle://%s:%s@%s" % (user, passwd, descriptor),
+                                        max_identifier_length=128, pool_size=2, pool_pre_ping=True)
+
+    def execute(self, query, binds={}):
+        if self.sqlite is not None:
+            with self.lock:
+                return [tuple(row) for row in self.sqlite.execute(query, binds)]
+        from sqlalchemy import text
+        with self.engine.connect() as con:
+            return [tuple(row) for row in con.execute(text(query), binds)]
+
+_db = None
+_dbLock = threading.Lock()
+_cache = {}
+_cacheLock = threading.Lock()
+
+# Use another authentication file or service than the default. This closes the current connection.
+def setService(authFile=None, service=None):
+    global AUTH_FILE, SERVICE, _db
+    with _dbLock:
+        AUTH_FILE = authFile or AUTH_FILE
+        SERVICE = service or SERVICE
+        _db = None
+    clearCache()
+
+def getDB():
+    global _db
+    with _dbLock:
+        if _db is None:
+            serviceMap = parseServiceMap(AUTH_FILE)
+            if SERVICE not in serviceMap:
+                raise KeyError("service %s not found in %s" % (SERVICE, AUTH_FILE))
+            _db = FillMetadataDB(serviceMap[SERVICE])
+        return _db
+
+def clearCache():
+    with _cacheLock:
+        _cache.clear()
+
+def _cached(key):
+    with _cacheLock:
+        entry = _cache.get(key)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+    return None
+
+def _store(key, value):
+    with _cacheLock:
+        _cache[key] = (time.time() + TTL, value)
+
+# The local mirror. Lookups use one shared connection; sync() writes through it as well.
+class Mirror(object):
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(fileName, check_same_thread=False)
+        self.con.executescript(MIRROR_SCHEMA)
+
+    def execute(self, query, binds={}):
+        with self.lock:
+            return self.con.execute(query, binds).fetchall()
+
+    # The most recent mirrored fill (None if the mirror is empty) and the time of the last sync.
+    def state(self):
+        with self.lock:
+            lastFill = self.con.execute("select max(fillnum) from lhcfill").fetchone()[0]
+            synced = self.con.execute("select value from syncinfo where key='synced'").fetchone()
+        return lastFill, synced[0] if synced else None
+
+    # Whether everything up to now is in the mirror, i.e. the last sync was less than TTL seconds ago.
+    def fresh(self):
+        synced = self.state()[1]
+        return synced is not None and time.time() - synced < TTL
+
+    # The fills whose metadata is final in the mirror (all but the most recent fill, unless the mirror is fresh).
+    def finalFills(self, fills):
+        lastFill = self.state()[0]
+        if lastFill is None:
+            return []
+        if self.fresh():
+            return [f for f in fills if f <= lastFill]
+        return [f for f in fills if f < lastFill]
+
+_mirror = None
+
+# The mirror, or None if there isn't one (and create is False).
+def getMirror(create=False):
+    global _mirror
+    with _dbLock:
+        if _mirror is None and (create or os.path.exists(MIRROR_FILE)):
+            _mirror = Mirror(MIRROR_FILE)
+        return _mirror
+
+# Update the mirror from the database: all fills from the most recent one already mirrored on, and their runs.
+# Returns the number of new fills.
+def sync():
+    mirror = getMirror(create=True)
+    lastFill = mirror.state()[0] or 0
+    db = getDB()
+    fills = db.execute("select fillnum, timestampsec, norb, nbperls, amodetagid, numbxbeamactive, targetegev "
+                       "from %s.lhcfill where fillnum >= :minfill" % SCHEMA, {"minfill": lastFill})
+    runs = db.execute("select runnum, fillnum, min(lsnum), max(lsnum), min(timestampsec), max(timestampsec), "
+                      "count(distinct case when beamstatusid = %d then lsnum end) from %s.ids_datatag "
+                      "where fillnum >= :minfill group by runnum, fillnum" % (STABLE_BEAMS, SCHEMA),
+                      {"minfill": lastFill})
+    with mirror.lock:
+        with mirror.con:
+            mirror.con.execute("delete from lhcfill where fillnum >= ?", (lastFill,))
+            mirror.con.execute("delete from runs where fillnum >= ?", (lastFill,))
+            mirror.con.executemany("insert into lhcfill values (?, ?, ?, ?, ?, ?, ?)", fills)
+            mirror.con.executemany("insert or replace into runs values (?, ?, ?, ?, ?, ?, ?)", runs)
+            mirror.con.execute("insert or replace into syncinfo values ('synced', ?)", (time.time(),))
+    clearCache()
+    return len([f for f in fills if f[0] > lastFill])
+
+# Look up a per-fill quantity for several fills: local(fills) gives the values for the fills which can be
+# answered from the mirror (if there is one), and the others are fetched from the database with one query,
+# query(fills), unless they are in the cache. Both return {fill: value}. Fills the database doesn't know about get
+# None.
+def _perFill(name, fills, query, local=None):
+    fills = [int(f) for f in fills]
+    result = {}
+    mirror = getMirror()
+    if local is not None and mirror is not None:
+        for i in range(0, len(fills), 500):
+            result.update(local(mirror, fills[i:i+500]))
+    missing = []
+    for f in fills:
+        if f in result:
+            continue
+        value = _cached((name, f))
+        if value is None:
+            missing.append(f)
+        else:
+            result[f] = value
+    if missing:
+        fetched = {}
+        missingSorted = sorted(set(missing))
+        # Oracle allows at most 1000 values in an in (...) list.
+        for i in range(0, len(missingSorted), 500):
+            fetched.update(query(missingSorted[i:i+500]))
+        for f in missing:
+            result[f] = fetched.get(f)
+            if result[f] is not None:
+                _store((name, f), result[f])
+    return result
+
+# " in (:f0, :f1, ...)" and the binds for it.
+def _inList(values):
+    binds = dict(("f%d" % i, v) for i, v in enumerate(values))
+    return " in (" + ", ".join(":" + k for k in binds) + ")", binds
+
+# The fills after fill (sorted), or all fills if fill is None. This comes from the mirror if it is fresh, or if
+# the database can't be reached.
+def fillsSince(fill=None):
+    key = ("since", fill)
+    value = _cached(key)
+    if value is not None:
+        return value
+    query = "select fillnum from %s.lhcfill"
+    binds = {}
+    if fill is not None:
+        query += " where fillnum > :minfill"
+        binds["minfill"] = int(fill)
+    mirror = getMirror()
+    if mirror is not None and mirror.fresh():
+        return sorted(row[0] for row in mirror.execute(query % "main", binds))
+    try:
+        value = sorted(row[0] for row in getDB().execute(query % SCHEMA, binds))
+    except Exception as ex:
+        if mirror is None:
+            raise
+        print("Warning: couldn't get the new fills from the database (%s), using the local mirror" % ex)
+        return sorted(row[0] for row in mirror.execute(query % "main", binds))
+    _store(key, value)
+    return value
+
+# The most recent fill, or 0 if there aren't any.
+def lastFill():
+    fills = fillsSince(None)
+    return fills[-1] if fills else 0
+
+# The accelerator mode of each fill as {fill: "PROTPHYS" / "IONPHYS" / "PAPHYS"}; unknown modes are given as the
+# amodetagid number.
+def amodetags(fills):
+    def query(fills):
+        inList, binds = _inList(fills)
+        rows = getDB().execute("select fillnum, amodetagid from %s.lhcfill where fillnum%s" % (SCHEMA, inList), binds)
+        return dict((f, AMODETAGS.get(tagid, tagid)) for f, tagid in rows)
+    # The accelerator mode is known from the start of the fill, so any mirrored fill will do.
+    def local(mirror, fills):
+        inList, binds = _inList(fills)
+        rows = mirror.execute("select fillnum, amodetagid from lhcfill where fillnum%s" % inList, binds)
+        return dict((f, AMODETAGS.get(tagid, tagid)) for f, tagid in rows)
+    return _perFill("amodetag", fills, query, local)
+
+def amodetag(fill):
+    return amodetags([fill])[int(fill)]
+
+# The start and end time of each fill as {fill: (start, end)} in seconds since the epoch. The start is from
+# lhcfill and the end is the end of the last lumisection recorded for the fill so far, or None if there are no
+# lumisections yet.
+def fillTimes(fills):
+    def query(fills):
+        inList, binds = _inList(fills)
+        starts = dict(getDB().execute("select fillnum, timestampsec from %s.lhcfill where fillnum%s" % (SCHEMA, inList),
+                                      binds))
+        ends = dict(getDB().execute("select fillnum, max(timestampsec) from %s.ids_datatag where fillnum%s "
+                                    "group by fillnum" % (SCHEMA, inList), binds))
+        return dict((f, (start, ends[f] + LS_SECONDS if ends.get(f) is not None else None))
+                    for f, start in starts.items())
+    def local(mirror, fills):
+        inList, binds = _inList(mirror.finalFills(fills))
+        rows = mirror.execute("select l.fillnum, l.timestampsec, max(r.endtime) from lhcfill l left join runs r "
+                              "on l.fillnum = r.fillnum where l.fillnum%s group by l.fillnum" % inList, binds)
+        return dict((f, (start, end + LS_SECONDS if end is not None else None)) for f, start, end in rows)
+    return _perFill("times", fills, query, local)
+
+# The runs in each fill as {fill: [run, ...]}.
+def fillRuns(fills):
+    def query(fills):
+        inList, binds = _inList(fills)
+        result = {}
+        for f, run in getDB().execute("select distinct fillnum, runnum from %s.ids_datatag where fillnum%s "
+                                      "order by fillnum, runnum" % (SCHEMA, inList), binds):
+            result.setdefault(f, []).append(run)
+        return result
+    def local(mirror, fills):
+        inList, binds = _inList(mirror.finalFills(fills))
+        result = dict((row[0], []) for row in mirror.execute("select fillnum from lhcfill where fillnum%s" % inList, binds))
+        for f, run in mirror.execute("select fillnum, runnum from runs where fillnum%s order by runnum" % inList, binds):
+            result.setdefault(f, []).append(run)
+        return result
+    return _perFill("runs", fills, query, local)
+
+# Everything in the mirror about the fills from minFill to maxFill (both optional), as a list of dictionaries with
+# fill, start, end (as in fillTimes), amodetag, egev, nbx (colliding bunches), runs, and stableRuns (the runs with
+# lumisections in STABLE BEAMS), sorted by fill. This only uses the mirror, so run sync() first.
+def fillInfo(minFill=None, maxFill=None):
+    mirror = getMirror()
+    if mirror is None:
+        raise IOError("there is no fill metadata mirror %s yet; run python3 fillmeta.py sync first" % MIRROR_FILE)
+    query = "select fillnum, timestampsec, amodetagid, targetegev, numbxbeamactive from lhcfill where 1=1"
+    binds = {}
+    if minFill is not None:
+        query += " and fillnum >= :minfill"
+        binds["minfill"] = int(minFill)
+    if maxFill is not None:
+        query += " and fillnum <= :maxfill"
+        binds["maxfill"] = int(maxFill)
+    fills = []
+    byFill = {}
+    for f, start, tagid, egev, nbx in mirror.execute(query + " order by fillnum", binds):
+        byFill[f] = {"fill": f, "start": start, "end": None, "amodetag": AMODETAGS.get(tagid, tagid), "egev": egev,
+                     "nbx": nbx, "runs": [], "stableRuns": []}
+        fills.append(byFill[f])
+    runQuery = "select fillnum, runnum, endtime, nstable from runs where fillnum in (%s) order by runnum" % \
+               query.replace("select fillnum, timestampsec, amodetagid, targetegev, numbxbeamactive", "select fillnum")
+    for f, run, end, nstable in mirror.execute(runQuery, binds):
+        info = byFill[f]
+        info["runs"].append(run)
+        if nstable > 0:
+            info["stableRuns"].append(run)
+        if info["end"] is None or end + LS_SECONDS > info["end"]:
+            info["end"] = end + LS_SECONDS
+    return fills
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local fill metadata mirror "+MIRROR_FILE)
+    parser.add_argument("command", choices=["sync", "info"], help="sync: fetch the new fills from the database; "
+                        "info: show what is in the mirror")
+    parser.add_argument("-c", "--connect", help="DB service name (default %s)" % SERVICE)
+    parser.add_argument("-p", "--authpath", help="Authentication ini file (default %s)" % AUTH_FILE)
+    args = parser.parse_args()
+
+    setService(args.authpath, args.connect)
+    if args.command == "sync":
+        startTime = time.time()
+        nNew = sync()
+        print("Got %d new fill%s in %.1f s" % (nNew, "" if nNew == 1 else "s", time.time() - startTime))
+    mirror = getMirror()
+    if mirror is None:
+        print("There is no mirror yet; run python3 %s sync" % sys.argv[0])
+        sys.exit(1)
+    nFills, minFill, maxFill = mirror.execute("select count(*), min(fillnum), max(fillnum) from lhcfill")[0]
+    nRuns = mirror.execute("select count(*) from runs")[0][0]
+    synced = mirror.state()[1]
+    print("%s: %d fills (%s-%s), %d runs, last synced %s" % (MIRROR_FILE, nFills, minFill, maxFill, nRuns,
+                                                             time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(synced))
+                                                             if synced else "never"))
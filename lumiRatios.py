@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# lumiRatios.py
+#
+# The ratios between luminometers, per lumisection, and the numbers we look at for them in every fill. The
+# luminosities of n luminometers (lumisections x n, e.g. from joinByLS in lumiTable.py) are divided for all pairs
+# at once as one float32 array (lumisections x pairs); with a list of primary luminometers, only the pairs
+# involving at least one of them are computed. For each pair, ratioStats() gives
+#
+#   median     the median ratio
+#   mad        the median absolute deviation from the median
+#   slopeTime  the slope of a straight line fit of the ratio vs. time, per hour
+#   slopeLumi  the slope of a straight line fit of the ratio vs. the luminosity of the second luminometer of the
+#              pair (the denominator), per unit of luminosity (e.g. per Hz/ub)
+#   n          the number of lumisections where both luminometers have a value
+#
+# NaNs (a luminometer missing in a lumisection, or a division by zero) are ignored in all of these.
+#
+# Example:
+#
+#   table = joinOutputs(outputs, "delivered")     # see lumiTable.py
+#   names, ratios, stats = tableRatios(table, ["bcm1f", "pltzero", "hfoc", "hfet"], primary=["hfet"])
+#   print(formatRatioStats(names, stats))
+#
+# or, on a plain array, pairRatios(values, primary=[3]) and ratioStats(ratios, time, lumi).
+
+import warnings
+import numpy
+
+# The pairs (i, j) with i < j of n luminometers, in the order above/below of lumiValidate.py (0/1, 0/2, ..., 1/2,
+# ...), and for each one whether it involves one of the primary luminometers (a list of indices; all pairs if
+# it is None).
+def primaryPairMask(n, primary=None):
+    above, below = numpy.triu_indices(n, k=1)
+    if primary is None:
+        return above, below, numpy.ones(len(above), dtype=bool)
+    isPrimary = numpy.zeros(n, dtype=bool)
+    isPrimary[list(primary)] = True
+    return above, below, isPrimary[above] | isPrimary[below]
+
+# The ratio of the luminosities (lumisections x luminometers) for each pair (see primaryPairMask), as a float32
+# array (lumisections x pairs) with NaN where the ratio isn't defined. Returns the pairs and the ratios.
+def pairRatios(values, primary=None):
+    values = numpy.asarray(values, dtype=numpy.float32)
+    above, below, mask = primaryPairMask(values.shape[1], primary)
+    above, below = above[mask], below[mask]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ratios = values[:, above]/values[:, below]
+    ratios[~numpy.isfinite(ratios)] = numpy.nan
+    return list(zip(above.tolist(), below.tolist())), ratios
+
+# "above/below" for each pair.
+def pairNames(names, pairs):
+    return [names[i] + "/" + names[j] for i, j in pairs]
+
+# The slope of a straight line fit of each column of y vs. x (either one column for all, or one per column of y),
+# using only the rows where both are finite, or NaN if there are fewer than two such rows.
+def fitSlopes(y, x):
+    y = numpy.asarray(y, dtype=numpy.float64)
+    x = numpy.asarray(x, dtype=numpy.float64)
+    if x.ndim == 1:
+        x = x[:, numpy.newaxis]
+    x = numpy.broadcast_to(x, y.shape)
+    valid = numpy.isfinite(y) & numpy.isfinite(x)
+    n = valid.sum(axis=0)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        dx = numpy.where(valid, x - numpy.where(valid, x, 0).sum(axis=0)/n, 0)
+        dy = numpy.where(valid, y - numpy.where(valid, y, 0).sum(axis=0)/n, 0)
+        slopes = (dx*dy).sum(axis=0)/(dx*dx).sum(axis=0)
+    slopes[n < 2] = numpy.nan
+    return slopes
+
+# The summary statistics of the ratios (lumisections x pairs) described at the top, as a dictionary of arrays with
+# one value per pair. time (seconds, one per lumisection) and lumi (one per lumisection, or lumisections x pairs)
+# are optional; without them the slopes are NaN.
+def ratioStats(ratios, time=None, lumi=None):
+    ratios = numpy.asarray(ratios, dtype=numpy.float32)
+    nPairs = ratios.shape[1]
+    with warnings.catch_warnings():
+        # pairs without any values give NaN, which is what we want
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = numpy.nanmedian(ratios, axis=0)
+        mad = numpy.nanmedian(numpy.abs(ratios - median), axis=0)
+    stats = {"median": median, "mad": mad, "n": numpy.isfinite(ratios).sum(axis=0)}
+    stats["slopeTime"] = fitSlopes(ratios, time)*3600 if time is not None else numpy.full(nPairs, numpy.nan)
+    stats["slopeLumi"] = fitSlopes(ratios, lumi) if lumi is not None else numpy.full(nPairs, numpy.nan)
+    return stats
+
+# The statistics as text, one line per pair, e.g. for printing or for the validation GUI.
+def formatRatioStats(names, stats):
+    width = max([len(name) for name in names] + [5])
+    lines = ["%-*s %8s %8s %11s %11s %6s" % (width, "ratio", "median", "MAD", "slope/h", "slope/lumi", "n")]
+    for k, name in enumerate(names):
+        lines.append("%-*s %8.4f %8.4f %11.3e %11.3e %6d" % (width, name, stats["median"][k], stats["mad"][k],
+                                                            stats["slopeTime"][k], stats["slopeLumi"][k],
+                                                            stats["n"][k]))
+    return "\n".join(lines)
+
+# The ratios and their statistics for the luminometers cols of a table from joinByLS or joinOutputs (see
+# lumiTable.py), with only the pairs involving one of the primary luminometers if any are given. The time
+# column is used if the table has one. Returns the names of the ratios, the ratios, and the statistics.
+def tableRatios(table, cols, primary=()):
+    values = table[list(cols)].values
+    pairs, ratios = pairRatios(values, [cols.index(p) for p in primary if p in cols] if primary else None)
+    time = table["time"].values if "time" in table else None
+    stats = ratioStats(ratios, time, values[:, [j for i, j in pairs]])
+    return pairNames(cols, pairs), ratios, stats
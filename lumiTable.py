@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# lumiTable.py
+#
+# Lining up the per-lumisection output (brilcalc lumi --byls) of several luminometers or normtags, as needed by
+# lumiValidate.py, Scripts/getYearLS.py and Scripts/compareTwoCSVsFromBRILCALC.py. brilcalc writes the run and
+# lumisection as strings like "316002:7000" and "120:120"; these are parsed to integers once when the output is
+# read, and each lumisection is identified by one packed int64 key, run << 20 | ls (lumisection numbers are far
+# below 2**20), which sorts in (run, ls) order. Joining the luminometers is then a single reindex of each column
+# onto the sorted union (or intersection) of the keys, rather than one pandas.merge on the string columns per
+# luminometer.
+#
+# Example:
+#
+#   outputs = runBrilcalcMany(queries)
+#   columns = {}
+#   for name, output in zip(names, outputs):
+#       data = readByLS(output, ["delivered"])
+#       columns[name] = (data["key"], data["delivered"])
+#   table = joinByLS(columns)     # DataFrame with run, ls, and one column per name, sorted by run and ls
+#
+# or, with the time of each lumisection as well, joinOutputs(dict(zip(names, outputs)), "delivered").
+
+import numpy
+
+# Number of bits of the lumisection number in a packed key.
+LS_BITS = 20
+
+def packRunLS(run, ls):
+    return (numpy.asarray(run, dtype=numpy.int64) << LS_BITS) | numpy.asarray(ls, dtype=numpy.int64)
+
+def unpackRunLS(keys):
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    return keys >> LS_BITS, keys & ((1 << LS_BITS) - 1)
+
+# The index of a column, given either the full name ("#run:fill", "delivered(hz/ub)") or the name without the
+# leading # or the units ("run:fill", "delivered").
+def _columnIndex(names, name):
+    names = [n.lstrip("#") for n in names]
+    name = name.lstrip("#")
+    for i, n in enumerate(names):
+        if n == name or n.startswith(name + "("):
+            return i
+    raise KeyError("no column %s in the brilcalc output (columns: %s)" % (name, ", ".join(names)))
+
+# Read the per-lumisection output of brilcalc (a BrilcalcOutput, see brilcalcCache.py, or the CSV text) into a
+# dictionary of NumPy arrays: run, fill, ls, key (the packed run and ls), row (the index of the row in the output),
+# and each of the given columns, as in BrilcalcOutput.column() and under the name given here. Rows where the
+# run:fill field isn't a valid run and fill are left out.
+def readByLS(output, columns=()):
+    if isinstance(output, str):
+        from brilcalcCache import BrilcalcOutput
+        output = BrilcalcOutput.fromText(output)
+    if len(output) == 0:
+        # An empty output doesn't even have the column names.
+        data = dict((name, numpy.zeros(0, dtype=numpy.int64)) for name in ["row", "run", "fill", "ls", "key"])
+        data.update((name, numpy.zeros(0)) for name in columns)
+        return data
+    runFill = output.strings(_columnIndex(output.names, "run:fill"))
+    lsStrings = output.strings(_columnIndex(output.names, "ls"))
+    rows, runs, fills, ls = [], [], [], []
+    for i, (rf, l) in enumerate(zip(runFill, lsStrings)):
+        fields = rf.split(":")
+        if len(fields) != 2 or not fields[0].isdigit() or not fields[1].isdigit():
+            continue
+        rows.append(i)
+        runs.append(int(fields[0]))
+        fills.append(int(fields[1]))
+        ls.append(int(l.split(":")[0]))
+    data = {"row": numpy.array(rows, dtype=numpy.int64),
+            "run": numpy.array(runs, dtype=numpy.int64),
+            "fill": numpy.array(fills, dtype=numpy.int64),
+            "ls": numpy.array(ls, dtype=numpy.int64)}
+    data["key"] = packRunLS(data["run"], data["ls"])
+    for name in columns:
+        values = output.column(_columnIndex(output.names, name))
+        if isinstance(values, list):
+            values = numpy.array(values, dtype=object)
+        data[name] = values[data["row"]]
+    return data
+
+# The time column of brilcalc (as given by readByLS) in seconds since the epoch: "%m/%d/%y %H:%M:%S" in UTC, or
+# already in seconds with --tssec.
+def parseTimes(values):
+    values = numpy.asarray(values)
+    if values.dtype.kind in "iuf":
+        return values.astype(numpy.float64)
+    import pandas
+    times = pandas.to_datetime(values.astype(str), format="%m/%d/%y %H:%M:%S")
+    return numpy.asarray(times.values.astype("datetime64[s]").astype(numpy.int64), dtype=numpy.float64)
+
+# Join several columns, given as {name: (keys, values)} with the packed keys, into one pandas DataFrame with the
+# columns run, ls, and then one column per name (in the order given), with one row per lumisection sorted by run
+# and ls. With how="outer" (the default) there is a row for every lumisection in any of the columns, and the
+# values which are missing are NaN; with how="inner" only the lumisections in all of the columns are kept. If a
+# key appears more than once in a column, the last value is used.
+def joinByLS(columns, how="outer"):
+    import pandas
+    keyArrays = [numpy.asarray(keys, dtype=numpy.int64) for keys, values in columns.values()]
+    if not keyArrays:
+        allKeys = numpy.zeros(0, dtype=numpy.int64)
+    elif how == "outer":
+        allKeys = numpy.unique(numpy.concatenate(keyArrays))
+    elif how == "inner":
+        allKeys = numpy.unique(keyArrays[0])
+        for keys in keyArrays[1:]:
+            allKeys = numpy.intersect1d(allKeys, keys, assume_unique=False)
+    else:
+        raise ValueError("how must be outer or inner, not %s" % how)
+
+    runs, ls = unpackRunLS(allKeys)
+    table = {"run": runs, "ls": ls}
+    for (name, (keys, values)), keys in zip(columns.items(), keyArrays):
+        values = numpy.asarray(values)
+        if values.dtype.kind in "iub":
+            values = values.astype(numpy.float64)
+        column = numpy.full(len(allKeys), numpy.nan if values.dtype.kind == "f" else None,
+                            dtype=values.dtype if values.dtype.kind == "f" else object)
+        positions = numpy.searchsorted(allKeys, keys)
+        found = positions < len(allKeys)
+        found[found] = allKeys[positions[found]] == keys[found]
+        column[positions[found]] = values[found]
+        table[name] = column
+    return pandas.DataFrame(table, columns=["run", "ls"] + list(columns))
+
+# Join one column (e.g. "delivered") of several brilcalc --byls outputs, given as {name: output}, like joinByLS,
+# with an additional column time (in seconds since the epoch, see parseTimes) after run and ls, taken from
+# whichever of the outputs has the lumisection.
+def joinOutputs(outputs, column, how="outer"):
+    columns = {}
+    timeKeys = []
+    timeValues = []
+    for name, output in outputs.items():
+        data = readByLS(output, [column, "time"])
+        columns[name] = (data["key"], data[column])
+        timeKeys.append(data["key"])
+        timeValues.append(parseTimes(data["time"]))
+    if not columns:
+        return joinByLS({"time": (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0))})
+    # the time column has all of the keys, so it doesn't change which lumisections an inner join keeps
+    columns = dict([("time", (numpy.concatenate(timeKeys), numpy.concatenate(timeValues)))] + list(columns.items()))
+    return joinByLS(columns, how)
@@ -8,16 +8,25 @@
 # 3) If you give a type or normtag of the format "name1@name2", then it will interpret "name1" as the type or
 # normtag to use and "name2" as the datatag to use, so older versions of the data can be compared either
 # against the newest data other or against other luminometers.
+# 4) --shared-data option to use the data which doFillValidation.py has already got from brilcalc, rather than
+# calling brilcalc again for every luminometer.
+# 5) --save option to write the plot to a file instead of showing it, so that fillWatcher.py can make the plot
+# for a fill before anyone looks at it.
+# 6) --stats option to print the median, MAD, and slopes vs. time and vs. lumi of each ratio (see lumiRatios.py)
+# instead of plotting.
 
 import logging
 import os
-import subprocess
+import json
 import argparse
 import itertools
-import tempfile
 import pandas
 import numpy
 from matplotlib import transforms, pyplot, ticker
+from brilcalcCache import runBrilcalc, runBrilcalcMany, BrilcalcOutput
+from lumiTable import readByLS, joinOutputs
+from lumiRatios import tableRatios, formatRatioStats
+import fillmeta
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -26,10 +35,11 @@ RATIOS_TOP_YLIMIT = 1.25
 RATIOS_BOTTOM_YLIMIT = 0.75
 LUMI_TOP_YLIMIT = 24000 #going farther up!
 LUMI_BOTTOM_YLIMIT = 0
-AMODETAG_SCRIPT = "./get_fill_amodetag.py"
 
 # default figure size in inches (NOTE: tuple)
 FIGURE_SIZE = (14, 11)
+# resolution for --save; at 72 dpi the figure still fits on the screen
+SAVE_DPI = 72
 
 # (Jonas): tight_layout would be way better, but it does not handle
 # legends outside plots, so we have to do the following hacks -- adjusts:
@@ -69,11 +79,18 @@ def main():
     # can only handle a fill as input. In principle we could get this to work if a run is given as well, but
     # since this script is unlikely to be called for that usage it should be sufficient to do per fill.
     global units
-    if (args.fill):
-        #amodetag = os.popen(AMODETAG_SCRIPT+" -f "+str(args.fill)).read().rstrip()
-
-        # popen is is considered outdated and discouraged in favor of the more powerful and secure subprocess module, April  2025
-        amodetag = subprocess.run(["python", AMODETAG_SCRIPT, "-p db.ini -f "+str(args.fill)], capture_output=True, text=True).stdout.rstrip()
+    shared_data = None
+    if args.shared_data:
+        # doFillValidation.py has already got the data (and the units), so we don't need brilcalc.
+        shared_data = read_shared_data(args.shared_data)
+        units = shared_data["units"]
+        args.fill = shared_data["fill"]
+    elif (args.fill):
+        try:
+            amodetag = fillmeta.amodetag(args.fill)
+        except Exception as ex:
+            log.warning("couldn't get the accelerator mode of fill %s, using %s: %s", args.fill, units, ex)
+            amodetag = None
 
         if amodetag == "IONPHYS" or amodetag == "PAPHYS":
             units = "hz/mb"
@@ -83,6 +100,9 @@ def main():
         FIGURE_ADJUSTS_TWO_FAT_ROWS["right"] = 0.80
         FIGURE_ADJUSTS_TWO_FAT_ONE_SLIM_ROWS["right"] = 0.80
 
+    if args.save is not None:
+        # no window is opened, so this also works without a display
+        pyplot.switch_backend("agg")
     fig = pyplot.figure(figsize=FIGURE_SIZE)
     data = None
     if args.xing:
@@ -92,7 +112,8 @@ def main():
         fig.tight_layout()
     else:
         data, cols, fill = get_data(args.types, args.normtags,
-                                    args.run, args.fill, args.beams)
+                                    args.run, args.fill, args.beams,
+                                    shared_data)
 
         # Apply shift to dt data (if it's present). Thanks Peter for adding this code!
         # The try is in case the dt data doesn't exist for whatever reason.
@@ -101,6 +122,11 @@ def main():
         except:
             pass
 
+        if args.stats:
+            ratios, stats = calculate_ratios(data, cols, args.primary)
+            print(formatRatioStats(ratios, stats))
+            return
+
         fig.subplots_adjust(**FIGURE_ADJUSTS_TWO_FAT_ROWS)
         rows = 2
         if args.correlate is not None:
@@ -123,6 +149,11 @@ def main():
         log.info("printing data to file %s", args.outfile)
         data.to_csv(args.outfile)
 
+    if args.save is not None:
+        log.info("saving the plots to %s", args.save)
+        fig.savefig(args.save, dpi=SAVE_DPI)
+        return
+
     log.info("asking pyplot to show the plots")
     pyplot.show()
 
@@ -158,6 +189,18 @@ def predefined_arg_parser():
         "--primary", dest="primary", metavar="type/normtag", type=str, nargs="+",
         default=[], help="list of space-delimited primary luminometers. If specified,"
         " only ratios to at least one primary luminometer will be shown")
+    parser.add_argument(
+        "--shared-data", dest="shared_data", type=str,
+        help="file with the brilcalc output for the types and normtags, as"
+        " written by doFillValidation.py, to use instead of calling brilcalc"
+        " (the file is removed after reading)")
+    parser.add_argument(
+        "--stats", dest="stats", action="store_true",
+        help="print the median, MAD, and slopes vs. time and lumi of each"
+        " ratio instead of plotting (types and normtags only)")
+    parser.add_argument(
+        "--save", dest="save", type=str,
+        help="file (e.g. fill.png) to save the plots to instead of showing them")
     return parser
 
 
@@ -169,24 +212,29 @@ def prepare_brilcalc_call_tpl(run, fill, beams):
         time_selection += ["-f", str(fill)]
     if not time_selection:
         raise ValueError("Either run or fill must by specified")
-    f = tempfile.NamedTemporaryFile()
-    log.debug("temp file name: %s", f.name)
-    cmd = ["brilcalc", "lumi", "--byls", "-u", units, "-o", f.name]
+    cmd = ["lumi", "--byls", "-u", units]
     cmd += time_selection
     if beams is not None:
         cmd += ["-b", beams]
-    return cmd, f
+    return cmd
 
 
-int_before_colon = lambda value: int(value.split(":")[0])
+# Read the file written by doFillValidation.py (displayPlot), which has the
+# fill, the units, and the brilcalc CSV output for each type or normtag.
+def read_shared_data(file_name):
+    log.info("reading data from %s", file_name)
+    with open(file_name) as f:
+        shared_data = json.load(f)
+    os.unlink(file_name)
+    return shared_data
 
 
 # (Jonas) FIXME: get_data and get_bunch_data has too much of same code
-def get_data(types, normtags, run=None, fill=None, beams=None):
+def get_data(types, normtags, run=None, fill=None, beams=None,
+             shared_data=None):
     log.debug("getting data")
-    cmd_tpl, f = prepare_brilcalc_call_tpl(run, fill, beams)
-    got_cols = []
-    merged = None
+    cmd_tpl = prepare_brilcalc_call_tpl(run, fill, beams)
+    queries = []
     for request in types + normtags:
         cmd = list(cmd_tpl)
         if request in types:
@@ -208,78 +256,69 @@ def get_data(types, normtags, run=None, fill=None, beams=None):
             if os.path.isfile(fields[0]):
                 log.info("normtag is file: %s", fields[0])
                 request = os.path.basename(request)
+        queries.append((request, cmd))
 
+    # run the brilcalc calls which are needed in parallel (see brilcalcCache.py)
+    to_fetch = [cmd for request, cmd in queries
+                if shared_data is None or request not in shared_data["data"]]
+    for cmd in to_fetch:
         log.info("invoking brilcalc: %s", " ".join(cmd))
-        # (Jonas) TODO: check return code
-        ret_code = subprocess.call(cmd)
-        if ret_code != 0:
+    outputs = iter(runBrilcalcMany(to_fetch))
+
+    # run and ls are parsed to integers as each output is read, and the
+    # luminometers are lined up on them in one go (see lumiTable.py)
+    got_cols = []
+    got_outputs = {}
+    for request, cmd in queries:
+        if shared_data is not None and request in shared_data["data"]:
+            output = BrilcalcOutput.fromText(shared_data["data"][request])
+        else:
+            output = next(outputs)
+        if output is None:
             log.warning("subprocess returned with errors. skipping")
             continue
-        data = pandas.read_csv(f.name, skiprows=1)
-        data = data[:-3]
-        if data.empty:
+        if len(output) == 0:
             log.warning("No data parsed for %s", request)
             continue
         got_cols.append(request)
+        got_outputs[request] = output
 
         if fill is None:
-            fill = data["#run:fill"].iloc[0].split(":")[1]
+            fill = str(output.runsAndFills()[1][0])
             log.info("fill number determined: %s", fill)
 
-        data["delivered("+units+")"] = data["delivered("+units+")"].map(float)
-        data.rename(columns={"delivered("+units+")": request}, inplace=True)
-        data = data.loc[:, ("#run:fill", "ls", request)]
-
-        if merged is None:
-            merged = data
-        else:
-            merged = pandas.merge(merged, data, how="outer",
-                                  on=["#run:fill", "ls"])
-
-    # remove rows where "#run:fill" is corrupted
-    merged = merged[merged["#run:fill"].str.contains(':')].copy()
-    merged["ls"] = merged["ls"].map(int_before_colon)
-    merged["#run:fill"] = merged["#run:fill"].map(int_before_colon)
-    merged.rename(columns={"#run:fill": "run"}, inplace=True)
+    merged = joinOutputs(got_outputs, "delivered("+units+")")
     log.debug("sucessfully got data")
     return merged, got_cols, fill
 
 
 def get_bunch_data(run=None, fill=None, beams=None):
     log.info("getting bunch (--xing) data")
-    cmd, f = prepare_brilcalc_call_tpl(run, fill, beams)
+    cmd = prepare_brilcalc_call_tpl(run, fill, beams)
     cmd += ["--xing"]
     log.info("invoking brilcalc: %s", " ".join(cmd))
-    # (Jonas) TODO: check return code
-    subprocess.call(cmd)
-    data = pandas.read_csv(f.name, skiprows=1)
-    data = data[:-3]
-    if data.empty:
+    output = runBrilcalc(cmd)
+    if output is None or len(output) == 0:
         log.error("No data parsed")
         return None, None, None
 
+    # rows where "#run:fill" is corrupted are left out
+    rows = readByLS(output)
     if fill is None:
-        fill = data["#run:fill"].iloc[0].split(":")[1]
+        fill = str(rows["fill"][0])
         log.info("fill number determined: %s", fill)
 
-    # renaming ahead of time to make code lines shoreter :)
-    data.rename(inplace=True, columns={
-        "#run:fill": "run",
-        "[bxidx bxdelivered("+units+") bxrecorded("+units+")]": "bunches"})
-    data = data.loc[:, ("run", "ls", "bunches")]
-    # remove rows where "#run:fill" is corrupted
-    data = data[data["run"].str.contains(':')].copy()
-    data["ls"] = data["ls"].map(int_before_colon)
-    data["run"] = data["run"].map(int_before_colon)
-
-    def bunches_to_columns(row):
-        bunch_data = row["bunches"][1:-1].split(" ")
-        cols = ["bxd:" + id for id in bunch_data[0::3]]
-        delivereds = [float(delivered) for delivered in bunch_data[1::3]]
-        return pandas.Series(data=delivereds, index=cols)
-
-    split_bunches = data.apply(bunches_to_columns, axis=1)
-    data.drop("bunches", axis=1, inplace=True)
+    # the per-bunch data comes straight from the cached arrays (see bunchData.py)
+    bunches = output.bunches(
+        "[bxidx bxdelivered("+units+") bxrecorded("+units+")]")
+    data = pandas.DataFrame({"run": rows["run"], "ls": rows["ls"]},
+                            index=rows["row"])
+
+    # one column per BX which has data in any lumisection
+    filled_bx = bunches.filledBX()
+    split_bunches = pandas.DataFrame(
+        bunches.toDense(columns=filled_bx, missing=numpy.nan)[data.index],
+        index=data.index, columns=["bxd:%d" % bx for bx in filled_bx])
     data = pandas.concat([data, split_bunches], axis=1)
     bxd_cols = data.columns.values.tolist()[2:]
     log.info("sucessfully got data")
@@ -355,24 +394,13 @@ def separate_runs_on_plot(subplot, data):
 def calculate_ratios(data, cols, primary_luminometers):
     """Update DataFrame 'data' with ratios"""
     log.debug("calculating ratios")
-    # back up numpy settings and set to ignore all errors (to handle
-    # "None"s and division by zero)
-    old_numpy_settings = numpy.seterr(all="ignore")
+    # all ratios at once (see lumiRatios.py); if primary luminometers are
+    # set, only the ratios involving one of them
     comparables = [x for x in cols if x != "online"]
-    calculated_ratios = []
-    for above_idx, above in enumerate(comparables):
-        for below in comparables[above_idx + 1:]:
-            # if primary luminometers set, skip all ratios not involving one of them
-            if (len(primary_luminometers) != 0 and
-                not above in primary_luminometers and
-                not below in primary_luminometers):
-                continue
-            name = above + "/" + below
-            data[name] = data[above]/data[below]
-            calculated_ratios.append(name)
-
-    numpy.seterr(**old_numpy_settings)
-    return calculated_ratios
+    names, ratios, stats = tableRatios(data, comparables, primary_luminometers)
+    for k, name in enumerate(names):
+        data[name] = ratios[:, k]
+    return names, stats
 
 
 def make_correlation_plot(plot, data, x, y):
@@ -413,7 +441,7 @@ def make_avglumi_plot(plot, data, cols, run, fill):
 
 
 def make_ratio_plot(plot, data, cols, run, fill, primary_luminometers):
-    ratios = calculate_ratios(data, cols, primary_luminometers)
+    ratios, stats = calculate_ratios(data, cols, primary_luminometers)
     log.debug("creating ratios plot")
     plot_by_columns(plot, data, ratios)
     plot.set_title("Lumi ratios")
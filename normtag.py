@@ -0,0 +1,771 @@
+#!/usr/bin/env python
+
+# normtag.py
+#
+# Library for working with normtag files (and certification JSON files) directly in terms of lumisection
+# ranges. Most of the scripts in this repository used to expand every [first, last] range into one entry per
+# lumisection, which costs millions of Python objects for a year-scale file like normtag_BRIL.json. Here a
+# normtag is instead stored as a sorted list of non-overlapping (first, last, iovtag) segments for each run,
+# and coverage queries (binary search) and union/intersection/difference all work on those segments
+# directly.
+#
+# To use this from one of the scripts in the Scripts/ directory:
+#
+#   sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+#   from normtag import Normtag
+#
+#   bril = Normtag.fromFile("normtag_BRIL.json")
+#   golden = Normtag.fromFile("Cert_XXX_JSON.txt")
+#   both = golden & bril
+#
+# Since every tool re-parses the same (large) JSON files, a compact binary sidecar can also be created next to
+# a JSON file with Scripts/makeNormtagSidecar.py. It consists of a NumPy structured array with one row per
+# range (FILE.npy) and a string table with the iovtags (FILE.tags.npy), both loadable with
+# numpy.load(mmap_mode='r'). If the sidecar is present, fromFile() uses it instead of the JSON, and it is
+# rebuilt automatically whenever the JSON file changes (or, if it can't be written, the JSON is read instead).
+# The JSON file is still the format that brilcalc reads and that is stored in git.
+#
+# Finally, for queries which only need a few runs (one fill, one year), readRecordRange() uses a small index
+# of byte offsets (FILE.idx, built automatically on first use) to decode only the lines for those runs. This
+# relies on the file being written one record per line, as writeFormattedJSON in doFillValidation.py does.
+
+import os
+import re
+import json
+import bisect
+import hashlib
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    # Without NumPy the sidecar files are simply not used.
+    numpy = None
+
+# iovtag used for ranges which come from a certification JSON file (which has no iovtags). Note that this is
+# distinct from None, which is used to mean "not covered at all".
+CERT_IOVTAG = ""
+
+# Sort a list of [first, last] ranges and merge the ones that overlap or are contiguous.
+def mergeRanges(ranges):
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1][1] = last
+        else:
+            merged.append([first, last])
+    return merged
+
+# Intersection of two sorted, merged lists of [first, last] ranges.
+def intersectRanges(a, b):
+    result = []
+    i = 0
+    j = 0
+    while i < len(a) and j < len(b):
+        first = max(a[i][0], b[j][0])
+        last = min(a[i][1], b[j][1])
+        if first <= last:
+            result.append([first, last])
+        # advance whichever range ends first
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+# The ranges in a which are not in b (both sorted and merged).
+def subtractRanges(a, b):
+    return [[first, last] for first, last, tag in _clip([(r[0], r[1], None) for r in a], b, False)]
+
+# Union of two sorted, merged lists of ranges.
+def unionRanges(a, b):
+    return mergeRanges(a + b)
+
+# Total number of lumisections in a list of ranges.
+def countLumiSections(ranges):
+    return sum(r[1] - r[0] + 1 for r in ranges)
+
+# Format a list of ranges in a compact human-readable form, e.g. "1-15 18 20-25".
+def formatRanges(ranges):
+    return " ".join(str(first) if first == last else "%d-%d" % (first, last) for first, last in ranges)
+
+# Merge contiguous segments which have the same iovtag. The input must be sorted and non-overlapping.
+def _coalesce(segments):
+    result = []
+    for seg in segments:
+        if result and result[-1][2] == seg[2] and result[-1][1] + 1 == seg[0]:
+            result[-1] = (result[-1][0], seg[1], seg[2])
+        else:
+            result.append(tuple(seg))
+    return result
+
+# Return the pieces of the (sorted, non-overlapping) segments which are inside (inside=True) or outside
+# (inside=False) of the sorted, merged list of ranges. This is a single sweep over both lists.
+def _clip(segments, ranges, inside):
+    result = []
+    j = 0
+    n = len(ranges)
+    for first, last, tag in segments:
+        # skip any ranges that are entirely before this segment
+        while j < n and ranges[j][1] < first:
+            j += 1
+        pos = first
+        k = j
+        while k < n and ranges[k][0] <= last:
+            rangeFirst, rangeLast = ranges[k]
+            if inside:
+                result.append((max(first, rangeFirst), min(last, rangeLast), tag))
+            elif rangeFirst > pos:
+                result.append((pos, rangeFirst - 1, tag))
+            pos = max(pos, rangeLast + 1)
+            if rangeLast > last:
+                break
+            k += 1
+        if not inside and pos <= last:
+            result.append((pos, last, tag))
+    return result
+
+# Turn a list of (first, last, iovtag) segments for a single run, given in file order, into the sorted,
+# non-overlapping form. Reversed ranges (last < first) don't cover anything and are dropped. If two
+# segments overlap, the one which appears first in the file wins, which is how the scripts in this
+# repository have always resolved it.
+def _resolveSegments(segments):
+    segments = [s for s in segments if s[0] <= s[1]]
+    ordered = sorted(segments, key=lambda s: (s[0], s[1]))
+    overlap = False
+    for a, b in zip(ordered, ordered[1:]):
+        if b[0] <= a[1]:
+            overlap = True
+            break
+    if not overlap:
+        return _coalesce(ordered)
+
+    # Slow path: add the segments one at a time, keeping only the parts not already covered.
+    result = []
+    covered = []
+    for seg in segments:
+        pieces = _clip([seg], covered, False)
+        if pieces:
+            result += pieces
+            covered = mergeRanges(covered + [[p[0], p[1]] for p in pieces])
+    return _coalesce(sorted(result))
+
+# Sweep over the merged range boundaries of several normtags at once. For every elementary interval
+# (run, first, last) which is covered by at least one of the normtags, yield (run, first, last, tags), where
+# tags[i] is the iovtag that normtags[i] has for that interval, or None if it does not cover it. Intervals
+# are yielded in order and the cost is linear in the total number of segments.
+def sweep(normtags, runs=None):
+    if runs is None:
+        allRuns = set()
+        for nt in normtags:
+            allRuns.update(nt.segments)
+        runs = sorted(allRuns)
+    for run in runs:
+        segLists = [nt.segments.get(run, []) for nt in normtags]
+        boundaries = set()
+        for segs in segLists:
+            for first, last, tag in segs:
+                boundaries.add(first)
+                boundaries.add(last + 1)
+        boundaries = sorted(boundaries)
+        pointers = [0] * len(segLists)
+        for start, end in zip(boundaries, boundaries[1:]):
+            tags = []
+            for i, segs in enumerate(segLists):
+                p = pointers[i]
+                while p < len(segs) and segs[p][1] < start:
+                    p += 1
+                pointers[i] = p
+                if p < len(segs) and segs[p][0] <= start:
+                    tags.append(segs[p][2])
+                else:
+                    tags.append(None)
+            if any(t is not None for t in tags):
+                yield run, start, end - 1, tuple(tags)
+
+# Resolve a list of normtags in priority order into the 1st..nRanks-th best normtags: for each lumisection,
+# the k-th output normtag gets the iovtag from the k-th input normtag (in priority order) which covers it.
+# This is a single sweep over the range boundaries of all of the inputs. Returns a list of nRanks Normtags
+# and a dictionary {run: [[first, last], ...]} of the lumisections where fewer than nRanks normtags are
+# available.
+def resolvePriority(normtags, nRanks):
+    ranked = [{} for i in range(nRanks)]
+    shortfall = {}
+    for run, first, last, tags in sweep(normtags):
+        available = [tag for tag in tags if tag is not None]
+        for rank, tag in enumerate(available[:nRanks]):
+            ranked[rank].setdefault(run, []).append((first, last, tag))
+        if len(available) < nRanks:
+            runShortfall = shortfall.setdefault(run, [])
+            if runShortfall and runShortfall[-1][1] + 1 == first:
+                runShortfall[-1][1] = last
+            else:
+                runShortfall.append([first, last])
+    return [Normtag(segments) for segments in ranked], shortfall
+
+# Build a composite normtag from a list of normtags in priority order: each lumisection gets the iovtag from
+# the first normtag which covers it.
+def composite(normtags):
+    return resolvePriority(normtags, 1)[0][0]
+
+# Evaluate an arbitrary set expression over several normtags (or certification JSON files) in a single sweep.
+# evaluate(covered) gets a list of booleans saying which of the normtags cover an interval, and returns whether
+# the result should cover it. Where it does, the result gets the iovtag from the first normtag in tagSources (by
+# default all of them, in order) which covers it with a real iovtag, or CERT_IOVTAG if there isn't one.
+def combine(normtags, evaluate, tagSources=None):
+    if tagSources is None:
+        tagSources = range(len(normtags))
+    result = {}
+    for run, first, last, tags in sweep(normtags):
+        if evaluate([t is not None for t in tags]):
+            tag = CERT_IOVTAG
+            for i in tagSources:
+                if tags[i] is not None and tags[i] != CERT_IOVTAG:
+                    tag = tags[i]
+                    break
+            result.setdefault(run, []).append((first, last, tag))
+    return Normtag(result)
+
+# Write a certification JSON dictionary ({"run": [[first, last], ...]}) with one run per line, sorted by run.
+def writeCertJSON(certJSON, fp):
+    fp.write("{\n")
+    fp.write(",\n".join(json.dumps(run)+": "+json.dumps(certJSON[run]) for run in sorted(certJSON, key=int)))
+    fp.write("\n}\n")
+
+# Compare two normtags. Returns a dictionary {run: [(first, last, oldTag, newTag), ...]} of the ranges where
+# they differ: oldTag is None for lumisections which are only in new (added), newTag is None for lumisections
+# which are only in old (removed), and otherwise the iovtag has changed (retagged). Runs which are identical in
+# both are skipped without sweeping over them, so comparing two versions of the same file is cheap.
+def diffNormtags(old, new):
+    changedRuns = [run for run in set(old.segments) | set(new.segments)
+                   if old.segments.get(run) != new.segments.get(run)]
+    diff = {}
+    for run, first, last, (oldTag, newTag) in sweep([old, new], sorted(changedRuns)):
+        if oldTag == newTag:
+            continue
+        runDiff = diff.setdefault(run, [])
+        if runDiff and runDiff[-1][1] + 1 == first and runDiff[-1][2:] == (oldTag, newTag):
+            runDiff[-1] = (runDiff[-1][0], last, oldTag, newTag)
+        else:
+            runDiff.append((first, last, oldTag, newTag))
+    return diff
+
+class Normtag(object):
+    # segments is a dictionary of run number (int) -> list of (first, last, iovtag). It is assumed to be
+    # sorted and non-overlapping already; use the from* methods to build a Normtag from arbitrary input.
+    def __init__(self, segments=None):
+        self.segments = {}
+        if segments:
+            for run in segments:
+                if segments[run]:
+                    self.segments[int(run)] = _coalesce(segments[run])
+
+    # Build a Normtag from parsed normtag records ([iovtag, {run: [[first, last], ...]}]), optionally only
+    # keeping runs in [minRun, maxRun].
+    @classmethod
+    def fromRecords(cls, records, minRun=None, maxRun=None):
+        perRun = {}
+        for record in records:
+            iovtag = record[0]
+            for runStr, lsRanges in record[1].items():
+                run = int(runStr)
+                if (minRun is not None and run < minRun) or (maxRun is not None and run > maxRun):
+                    continue
+                if run not in perRun:
+                    perRun[run] = []
+                for lsRange in lsRanges:
+                    perRun[run].append((lsRange[0], lsRange[1], iovtag))
+        return cls._fromPerRun(perRun)
+
+    # Build a Normtag from a parsed certification JSON ({run: [[first, last], ...]}). Since these have no
+    # iovtag, the ranges get the given iovtag (by default CERT_IOVTAG).
+    @classmethod
+    def fromCertJSON(cls, certJSON, minRun=None, maxRun=None, iovtag=CERT_IOVTAG):
+        return cls.fromRecords([[iovtag, certJSON]], minRun, maxRun)
+
+    # Read a normtag or certification JSON file; the type is determined from the content. If an up-to-date
+    # sidecar is present, that is used instead of parsing the JSON. Otherwise, if a run range is given, only
+    # the lines for those runs are decoded (see readRecordRange).
+    @classmethod
+    def fromFile(cls, fileName, minRun=None, maxRun=None):
+        sidecar = readSidecar(fileName)
+        if sidecar is not None:
+            return cls.fromArrays(sidecar[0], sidecar[1], minRun, maxRun)
+        if minRun is not None or maxRun is not None:
+            parsed = readRecordRange(fileName, minRun, maxRun)
+        else:
+            with open(fileName) as jsonFile:
+                parsed = json.load(jsonFile)
+        if isinstance(parsed, dict):
+            return cls.fromCertJSON(parsed, minRun, maxRun)
+        return cls.fromRecords(parsed, minRun, maxRun)
+
+    # Build a Normtag from the sidecar arrays (see readSidecar).
+    @classmethod
+    def fromArrays(cls, rows, iovtags, minRun=None, maxRun=None):
+        if minRun is not None or maxRun is not None:
+            mask = numpy.ones(len(rows), dtype=bool)
+            if minRun is not None:
+                mask &= rows['run'] >= minRun
+            if maxRun is not None:
+                mask &= rows['run'] <= maxRun
+            rows = rows[mask]
+        perRun = {}
+        for run, first, last, tagId in zip(rows['run'].tolist(), rows['first_ls'].tolist(),
+                                           rows['last_ls'].tolist(), rows['tag_id'].tolist()):
+            if run not in perRun:
+                perRun[run] = []
+            perRun[run].append((first, last, iovtags[tagId]))
+        return cls._fromPerRun(perRun)
+
+    @classmethod
+    def _fromPerRun(cls, perRun):
+        nt = cls()
+        for run in perRun:
+            segs = _resolveSegments(perRun[run])
+            if segs:
+                nt.segments[run] = segs
+        return nt
+
+    # Sorted list of runs covered.
+    def runs(self):
+        return sorted(self.segments)
+
+    # Set of all iovtags used.
+    def iovtags(self):
+        return set(seg[2] for segs in self.segments.values() for seg in segs)
+
+    # The merged list of [first, last] ranges covered in this run, regardless of iovtag.
+    def ranges(self, run):
+        result = []
+        for first, last, tag in self.segments.get(run, []):
+            if result and result[-1][1] + 1 == first:
+                result[-1][1] = last
+            else:
+                result.append([first, last])
+        return result
+
+    # Return the iovtag for a given run and LS, or None if it isn't covered.
+    def iovtag(self, run, ls):
+        segs = self.segments.get(run)
+        if not segs:
+            return None
+        i = bisect.bisect_right(segs, (ls, float('inf'))) - 1
+        if i >= 0 and segs[i][0] <= ls <= segs[i][1]:
+            return segs[i][2]
+        return None
+
+    def contains(self, run, ls):
+        return self.iovtag(run, ls) is not None
+
+    # Total number of lumisections covered, either in one run or overall.
+    def nLumiSections(self, run=None):
+        if run is not None:
+            return sum(s[1] - s[0] + 1 for s in self.segments.get(run, []))
+        return sum(s[1] - s[0] + 1 for segs in self.segments.values() for s in segs)
+
+    # Number of lumisections covered by each iovtag.
+    def iovtagCounts(self):
+        counts = {}
+        for segs in self.segments.values():
+            for first, last, tag in segs:
+                counts[tag] = counts.get(tag, 0) + last - first + 1
+        return counts
+
+    # Only keep runs in [minRun, maxRun].
+    def restrict(self, minRun=None, maxRun=None):
+        return Normtag(dict((run, segs) for run, segs in self.segments.items()
+                            if (minRun is None or run >= minRun) and (maxRun is None or run <= maxRun)))
+
+    # Set operations. The result always keeps the iovtags of self where self covers a lumisection; for a
+    # union, the lumisections only covered by other get the iovtags from other.
+    def intersection(self, other):
+        result = {}
+        for run in self.segments:
+            if run in other.segments:
+                result[run] = _clip(self.segments[run], other.ranges(run), True)
+        return Normtag(result)
+
+    def difference(self, other):
+        result = {}
+        for run in self.segments:
+            if run in other.segments:
+                result[run] = _clip(self.segments[run], other.ranges(run), False)
+            else:
+                result[run] = self.segments[run]
+        return Normtag(result)
+
+    def union(self, other):
+        result = dict(self.segments)
+        for run in other.segments:
+            if run in self.segments:
+                extra = _clip(other.segments[run], self.ranges(run), False)
+                result[run] = sorted(self.segments[run] + extra)
+            else:
+                result[run] = other.segments[run]
+        return Normtag(result)
+
+    __and__ = intersection
+    __or__ = union
+    __sub__ = difference
+
+    def __eq__(self, other):
+        return isinstance(other, Normtag) and self.segments == other.segments
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __contains__(self, run):
+        return run in self.segments
+
+    # Convert to a list of normtag records, one range per record, in the format used by
+    # writeFormattedJSON in doFillValidation.py.
+    def toRecords(self):
+        return [[tag, {str(run): [[first, last]]}]
+                for run in self.runs() for first, last, tag in self.segments[run]]
+
+    # Convert to a certification JSON dictionary ({"run": [[first, last], ...]}), dropping the iovtags.
+    def toCertJSON(self):
+        return dict((str(run), self.ranges(run)) for run in self.runs())
+
+# Write normtag records (or a Normtag) to a file with one record per line, identically to
+# writeFormattedJSON in doFillValidation.py.
+def writeNormtag(normtag, fp):
+    records = normtag.toRecords() if isinstance(normtag, Normtag) else normtag
+    fp.write("[\n")
+    fp.write(",\n".join(json.dumps(r) for r in records))
+    fp.write("\n]\n")
+
+# Compact a list of normtag records without changing which iovtag is used for any lumisection: contiguous (or
+# duplicated) ranges with the same iovtag are merged, all of the ranges with the same iovtag in a run go into one
+# record, and the records are sorted by (run, first LS). This is one pass over the records, plus sorting each
+# run's ranges (which are normally in order already). Where ranges with different iovtags overlap, the result
+# would depend on the order of the input, so these raise a ValueError that lists all of them. Reversed ranges
+# (last < first) don't cover anything, for brilcalc as in Normtag, so they are just dropped; if a list is given
+# as warnings, a description of each one is appended to it.
+def compactNormtag(records, warnings=None):
+    if isinstance(records, dict):
+        raise ValueError("this is a certification JSON file, not a normtag")
+    perRun = {}
+    for record in records:
+        if not isinstance(record, list) or len(record) != 2 or not isinstance(record[1], dict):
+            raise ValueError("malformed normtag record: "+json.dumps(record))
+        for runStr, lsRanges in record[1].items():
+            perRun.setdefault(int(runStr), []).extend((r[0], r[1], record[0]) for r in lsRanges)
+    problems = []
+    compacted = []
+    for run in sorted(perRun):
+        merged = []
+        for first, last, tag in sorted(perRun[run], key=lambda s: (s[0], s[1])):
+            if last < first:
+                if warnings is not None:
+                    warnings.append("run %d: dropped reversed range [%d, %d] (%s)" % (run, first, last, tag))
+            elif merged and first <= merged[-1][1] + 1 and tag == merged[-1][2]:
+                merged[-1][1] = max(merged[-1][1], last)
+            elif merged and first <= merged[-1][1]:
+                problems.append("run %d: range [%d, %d] (%s) overlaps [%d, %d] (%s)" %
+                                (run, first, last, tag, merged[-1][0], merged[-1][1], merged[-1][2]))
+            else:
+                merged.append([first, last, tag])
+        # Since the ranges are sorted, the records for a run come out in order of their first LS.
+        byTag = {}
+        for first, last, tag in merged:
+            if tag not in byTag:
+                byTag[tag] = [tag, {str(run): []}]
+                compacted.append(byTag[tag])
+            byTag[tag][1][str(run)].append([first, last])
+    if problems:
+        raise ValueError("\n".join(problems))
+    return compacted
+
+# Prefixes of the iovtags for the luminometers we have (or have had). If no list of valid iovtags is given,
+# validateNormtag uses these to catch mistyped iovtags.
+IOVTAG_PREFIXES = ('avg', 'bcm1f', 'castor', 'dt', 'hfet', 'hfoc', 'pcc', 'plt', 'pxl', 'ramses')
+
+# Check that a single normtag record has the right structure: [iovtag, {"run": [[first, last], ...]}] with
+# exactly one run. Returns a description of the problem, or None if it is OK.
+def checkRecord(record):
+    if not isinstance(record, list) or len(record) != 2:
+        return "not an [iovtag, {run: ranges}] pair"
+    if not isinstance(record[0], str):
+        return "the iovtag is not a string"
+    if not isinstance(record[1], dict) or len(record[1]) != 1:
+        return "there should be exactly one run"
+    run, lsRanges = list(record[1].items())[0]
+    if not run.isdigit():
+        return "the run number %s is not an integer" % json.dumps(run)
+    if not isinstance(lsRanges, list):
+        return "the lumisection ranges are not a list"
+    for lsRange in lsRanges:
+        if (not isinstance(lsRange, list) or len(lsRange) != 2 or
+            not all(isinstance(ls, int) and not isinstance(ls, bool) for ls in lsRange)):
+            return "the lumisection range %s is not a pair of integers" % json.dumps(lsRange)
+    return None
+
+# Check a list of normtag records for problems, without brilcalc: malformed records (see checkRecord), reversed
+# ranges, unknown iovtags (not in iovtags if that is given, otherwise not starting with one of IOVTAG_PREFIXES),
+# overlapping ranges, and records out of order. If a certification JSON dictionary is given, lumisections in it
+# which are not covered by the normtag are also reported (only for runs between the first and last run of the
+# normtag). locate(i) should describe where record i is in the file. Returns a list of (level, message), where
+# level is "error" for things which make the normtag wrong or ambiguous and "warning" for the rest.
+def validateNormtag(records, iovtags=None, certJSON=None, locate=None):
+    if locate is None:
+        locate = lambda i: "record %d" % (i+1)
+    if isinstance(records, dict):
+        return [("error", "this is a certification JSON file, not a normtag")]
+    problems = []
+    perRun = {}
+    lastKey = None
+    for i, record in enumerate(records):
+        error = checkRecord(record)
+        if error:
+            problems.append(("error", "%s: malformed record: %s" % (locate(i), error)))
+            continue
+        tag = record[0]
+        runStr, lsRanges = list(record[1].items())[0]
+        run = int(runStr)
+        if (tag not in iovtags) if iovtags is not None else (not tag.startswith(IOVTAG_PREFIXES)):
+            problems.append(("error", "%s: unknown iovtag %s" % (locate(i), json.dumps(tag))))
+        if not lsRanges:
+            problems.append(("warning", "%s: no lumisection ranges for run %d" % (locate(i), run)))
+            continue
+        for first, last in lsRanges:
+            if last < first:
+                problems.append(("error", "%s: reversed range [%d, %d] in run %d" % (locate(i), first, last, run)))
+            else:
+                perRun.setdefault(run, []).append((first, last, tag, i))
+        # Records should be sorted by run and the first LS of their first range (see recordSortKey), and the
+        # ranges in a record by LS. A record can have ranges after the start of the next one (e.g. the output
+        # of compactNormtag, where the ranges of one iovtag are in one record), so only the first ones count.
+        key = (run, lsRanges[0][0])
+        if lastKey is not None and key < lastKey:
+            problems.append(("warning", "%s: out of order (run %d LS %d comes after run %d LS %d)" %
+                             (locate(i), key[0], key[1], lastKey[0], lastKey[1])))
+        lastKey = key
+        for previous, lsRange in zip(lsRanges, lsRanges[1:]):
+            if lsRange[0] < previous[0]:
+                problems.append(("warning", "%s: out of order (LS %d comes after LS %d in run %d)" %
+                                 (locate(i), lsRange[0], previous[0], run)))
+
+    for run in sorted(perRun):
+        segments = sorted(perRun[run])
+        # the segment reaching furthest so far, which any overlapping segment must overlap with
+        cover = None
+        for seg in segments:
+            if cover is not None and seg[0] <= cover[1]:
+                level = "error" if seg[2] != cover[2] else "warning"
+                problems.append((level, "%s: range [%d, %d] (%s) in run %d overlaps [%d, %d] (%s) at %s" %
+                                 (locate(seg[3]), seg[0], seg[1], seg[2], run, cover[0], cover[1], cover[2], locate(cover[3]))))
+            if cover is None or seg[1] > cover[1]:
+                cover = seg
+
+    if certJSON is not None and perRun:
+        firstRun = min(perRun)
+        lastRun = max(perRun)
+        for run in sorted(int(r) for r in certJSON):
+            if run < firstRun or run > lastRun:
+                continue
+            covered = mergeRanges([[s[0], s[1]] for s in perRun.get(run, [])])
+            missing = subtractRanges(mergeRanges(certJSON[str(run)]), covered)
+            if missing:
+                problems.append(("warning", "run %d: lumisections %s are in the JSON file but not in the normtag" %
+                                 (run, formatRanges(missing))))
+    return problems
+
+# Binary sidecar files. The row array has one row per [first, last] range in file order; 'record' is the index
+# of the record (line) it came from so that the original JSON structure can be reconstructed exactly. The tag
+# table has the SHA-1 of the JSON file it was built from, the type of the file ("normtag" or "cert"), and then
+# the iovtags, indexed by tag_id.
+SIDECAR_DTYPE = [('run', '<u4'), ('first_ls', '<i4'), ('last_ls', '<i4'), ('tag_id', '<u4'), ('record', '<u4')]
+
+def sidecarFileNames(fileName):
+    return fileName+".npy", fileName+".tags.npy"
+
+def _fileHash(contents):
+    return hashlib.sha1(contents).hexdigest()
+
+def _saveArray(fileName, array):
+    # write to a temporary file first so that nobody ever reads a half-written sidecar
+    fd, tempName = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), suffix=".npy")
+    with os.fdopen(fd, 'wb') as tempFile:
+        numpy.save(tempFile, array)
+    os.replace(tempName, fileName)
+
+# Create (or recreate) the sidecar for a normtag or certification JSON file. Returns (rows, iovtags).
+def writeSidecar(fileName):
+    if numpy is None:
+        raise ImportError("NumPy is required to write normtag sidecar files")
+    with open(fileName, 'rb') as jsonFile:
+        contents = jsonFile.read()
+    parsed = json.loads(contents.decode('utf-8'))
+    if isinstance(parsed, dict):
+        kind = "cert"
+        records = [[CERT_IOVTAG, parsed]]
+    else:
+        kind = "normtag"
+        records = parsed
+
+    tagIds = {}
+    iovtags = []
+    rows = []
+    for i, record in enumerate(records):
+        iovtag = record[0]
+        if iovtag not in tagIds:
+            tagIds[iovtag] = len(iovtags)
+            iovtags.append(iovtag)
+        # anything which couldn't be reconstructed exactly from the rows is refused
+        if len(record) != 2 or not record[1]:
+            raise ValueError("malformed entry "+json.dumps(record))
+        for run, lsRanges in record[1].items():
+            if not lsRanges:
+                raise ValueError("malformed entry "+json.dumps(record))
+            for lsRange in lsRanges:
+                if len(lsRange) != 2 or type(lsRange[0]) is not int or type(lsRange[1]) is not int:
+                    raise ValueError("malformed entry "+json.dumps(record))
+                rows.append((int(run), lsRange[0], lsRange[1], tagIds[iovtag], i))
+    rowArray = numpy.array(rows, dtype=SIDECAR_DTYPE)
+    rowFileName, tagFileName = sidecarFileNames(fileName)
+    _saveArray(rowFileName, rowArray)
+    _saveArray(tagFileName, numpy.array([_fileHash(contents), kind] + iovtags, dtype=str))
+    return rowArray, iovtags
+
+# Load the sidecar for a JSON file, if there is one. If the JSON file has changed since the sidecar was
+# written, the sidecar is rebuilt first. Returns (rows, iovtags, kind), or None if there is no sidecar (or
+# NumPy is not available, or the JSON file can't be converted, or the sidecar is out of date and can't be
+# rewritten), in which case the caller should just read the JSON file.
+def readSidecar(fileName):
+    if numpy is None:
+        return None
+    rowFileName, tagFileName = sidecarFileNames(fileName)
+    if not (os.path.exists(rowFileName) and os.path.exists(tagFileName)):
+        return None
+    tagTable = numpy.load(tagFileName, mmap_mode='r').tolist()
+    with open(fileName, 'rb') as jsonFile:
+        currentHash = _fileHash(jsonFile.read())
+    if tagTable[0] == currentHash:
+        return numpy.load(rowFileName, mmap_mode='r'), tagTable[2:], tagTable[1]
+    try:
+        rows, iovtags = writeSidecar(fileName)
+    except (ValueError, TypeError, IndexError, AttributeError):
+        # let the caller deal with the problem when it parses the JSON
+        return None
+    except OSError:
+        # the sidecar is out of date, but we can't write a new one here (e.g. on cvmfs)
+        return None
+    return rows, iovtags, numpy.load(tagFileName, mmap_mode='r').tolist()[1]
+
+# Run index for seeking directly to the lines for a given run range. The index (stored as JSON in FILE.idx)
+# splits the record lines into blocks of INDEX_BLOCK_SIZE lines, and for each block stores the first and last
+# run and the byte offsets. The index is rebuilt whenever the size or modification time of the file changes.
+# Files which aren't in the one-record-per-line format (including certification JSON files) don't get an index
+# and are just read in full.
+INDEX_BLOCK_SIZE = 200
+_recordLineRegex = re.compile(rb'^\["[^"]*",\s*\{\s*"\d+"\s*:\s*\[')
+_runKeyRegex = re.compile(rb'"(\d+)"\s*:')
+
+def indexFileName(fileName):
+    return fileName+".idx"
+
+# Build the index from the contents of a file.
+def _scanRunIndex(contents):
+    blocks = []
+    header = None
+    trailer = None
+    offset = 0
+    for lineNumber, line in enumerate(contents.splitlines(True)):
+        stripped = line.strip()
+        if lineNumber == 0:
+            if stripped != b"[":
+                return None
+            header = offset + len(line)
+        elif stripped == b"]":
+            trailer = offset
+        elif trailer is not None or not stripped:
+            return None
+        else:
+            if not _recordLineRegex.match(stripped):
+                return None
+            runs = [int(r) for r in _runKeyRegex.findall(stripped)]
+            if not blocks or blocks[-1][4] >= INDEX_BLOCK_SIZE:
+                blocks.append([min(runs), max(runs), offset, offset + len(line), 0])
+            block = blocks[-1]
+            block[0] = min([block[0]] + runs)
+            block[1] = max([block[1]] + runs)
+            block[3] = offset + len(line)
+            block[4] += 1
+        offset += len(line)
+    if header is None or trailer is None:
+        return None
+    return {'blocks': blocks}
+
+def _saveRunIndex(fileName, index):
+    stat = os.stat(fileName)
+    index['size'] = stat.st_size
+    index['mtime'] = stat.st_mtime_ns
+    try:
+        with open(indexFileName(fileName), 'w') as indexFile:
+            json.dump(index, indexFile)
+    except IOError:
+        # can't write here, so just use it this time
+        pass
+
+def buildRunIndex(fileName):
+    with open(fileName, 'rb') as jsonFile:
+        index = _scanRunIndex(jsonFile.read())
+    if index is not None:
+        _saveRunIndex(fileName, index)
+    return index
+
+# Load the run index for a file, (re)building it if necessary. Returns None if the file can't be indexed.
+def loadRunIndex(fileName):
+    stat = os.stat(fileName)
+    try:
+        with open(indexFileName(fileName)) as indexFile:
+            index = json.load(indexFile)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime_ns:
+            return index
+    except (IOError, ValueError, KeyError):
+        pass
+    return buildRunIndex(fileName)
+
+def _decodeLines(data):
+    return [json.loads(line.strip().rstrip(b",").decode('utf-8')) for line in data.splitlines() if line.strip()]
+
+# Sort key used for normtag records (by run, then by first LS).
+def recordSortKey(record):
+    return (int(list(record[1].keys())[0]), list(record[1].values())[0][0][0])
+
+# Read only the records of a normtag file for runs in [minRun, maxRun]. Gives the same result as reading the
+# whole file and keeping only those records, but only the blocks of lines containing these runs are decoded.
+def readRecordRange(fileName, minRun=None, maxRun=None):
+    lowRun = minRun if minRun is not None else -1
+    highRun = maxRun if maxRun is not None else float('inf')
+    index = loadRunIndex(fileName)
+    if index is None:
+        with open(fileName) as jsonFile:
+            records = json.load(jsonFile)
+        if isinstance(records, dict):
+            return dict((run, ranges) for run, ranges in records.items() if lowRun <= int(run) <= highRun)
+    else:
+        selected = [b for b in index['blocks'] if b[1] >= lowRun and b[0] <= highRun]
+        if len(selected) == len(index['blocks']):
+            # we need everything anyway, so this is faster
+            with open(fileName) as jsonFile:
+                records = json.load(jsonFile)
+        else:
+            records = []
+            with open(fileName, 'rb') as jsonFile:
+                for block in selected:
+                    jsonFile.seek(block[2])
+                    records += _decodeLines(jsonFile.read(block[3] - block[2]))
+    # A record can list several runs, so keep the ones in the range rather than dropping the whole record.
+    selectedRecords = []
+    for record in records:
+        runs = dict((run, ranges) for run, ranges in record[1].items() if lowRun <= int(run) <= highRun)
+        if runs:
+            selectedRecords.append([record[0], runs])
+    return selectedRecords
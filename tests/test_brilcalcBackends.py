@@ -0,0 +1,132 @@
+# test_brilcalcBackends.py
+#
+# The two ways brilcalcCache.py runs brilcalc (the brilcalc command, and brilws in-process) must give the same
+# output. Both are run here against the stand-in lumi DB (see Standin/fakeLumiDB.py): the command is the stand-in
+# brilcalc, and the in-process backend uses the stand-in brilws package in Standin/brilws.
+#
+#   python3 -m pytest tests
+
+import os
+import sys
+
+import numpy
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STANDIN_DIR = os.path.join(BASE_DIR, "Standin")
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, STANDIN_DIR)
+import brilcalcCache
+import fakeLumiDB
+
+# A few fills which are long over, so that the data doesn't change between the queries.
+CONFIG = {
+    "start": "2024-05-01 00:00:00",
+    "firstRun": 380000,
+    "datatag": "online",
+    "online": ["HFOC", "PLTZERO"],
+    "luminometers": {
+        "HFOC": {"scale": 1.02, "calibrated": 1.0, "noise": 0.004},
+        "PLTZERO": {"scale": 1.01, "calibrated": 1.0, "noise": 0.003, "slope": -0.002},
+        "BCM1F": {"scale": 0.97, "calibrated": 1.0, "noise": 0.005}
+    },
+    "fills": [
+        {"fill": 9000, "count": 2, "nls": 60, "nadjust": 5, "nbx": 12, "runs": 2},
+        {"fill": 9002, "nls": 40, "nbx": 6, "amodetag": "IONPHYS"}
+    ],
+    "anomalies": [
+        {"fill": 9000, "luminometer": "HFOC", "kind": "gap", "first": 10, "last": 20}
+    ]
+}
+
+QUERIES = [
+    ["lumi", "-f", "9000", "--byls", "-b", "STABLE BEAMS", "-u", "hz/ub", "--type", "hfoc"],
+    ["lumi", "-f", "9001", "--byls", "--type", "pltzero"],
+    ["lumi", "--begin", "9000", "--end", "9002", "--normtag", "bcm1f24v00"],
+    ["lumi", "-f", "9000", "--xing", "--type", "bcm1f", "--xingTr", "0.1"],
+    ["lumi", "-r", "380001", "--byls"],
+    ["lumi", "-f", "9002", "-u", "hz/mb"],
+    ["beam", "-f", "9002", "-b", "STABLE BEAMS"],
+    ["beam", "-f", "9001", "--xing"],
+]
+
+@pytest.fixture(scope="module")
+def standin(tmp_path_factory):
+    fileName = str(tmp_path_factory.mktemp("standin") / "lumidb.sqlite")
+    fakeLumiDB.create(fileName, CONFIG)
+    saved = dict((name, os.environ.get(name)) for name in ["PATH", "FAKE_LUMIDB"])
+    os.environ["PATH"] = STANDIN_DIR + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_LUMIDB"] = fileName
+    yield fileName
+    for name, value in saved.items():
+        if value is None:
+            del os.environ[name]
+        else:
+            os.environ[name] = value
+
+@pytest.fixture(scope="module")
+def backends(standin):
+    return brilcalcCache.SubprocessBackend(), brilcalcCache.InProcessBackend()
+
+def checkSame(subprocessOutput, inProcessOutput):
+    assert subprocessOutput is not None and inProcessOutput is not None
+    assert len(subprocessOutput) > 0
+    assert inProcessOutput.csvText() == subprocessOutput.csvText()
+    assert inProcessOutput.names == subprocessOutput.names
+    for i in range(len(subprocessOutput.names)):
+        a = subprocessOutput.column(i)
+        b = inProcessOutput.column(i)
+        if isinstance(a, numpy.ndarray):
+            assert a.dtype == b.dtype
+            numpy.testing.assert_array_equal(a, b)
+        elif isinstance(a, list):
+            assert a == b
+        else:
+            # the per-bunch data of --xing (a BunchData)
+            for name in brilcalcCache.BUNCH_ARRAYS:
+                numpy.testing.assert_array_equal(getattr(a, name), getattr(b, name))
+
+@pytest.mark.parametrize("args", QUERIES, ids=[" ".join(q[:3]) for q in QUERIES])
+def test_sameOutput(backends, args):
+    subprocessBackend, inProcessBackend = backends
+    checkSame(brilcalcCache.runBrilcalc(args, useCache=False, backend=subprocessBackend),
+              brilcalcCache.runBrilcalc(args, useCache=False, backend=inProcessBackend))
+
+def test_failure(backends):
+    # an unknown unit makes brilcalc fail
+    for backend in backends:
+        assert brilcalcCache.runBrilcalc(["lumi", "-f", "9000", "-u", "hz/xb"], useCache=False, backend=backend) is None
+
+def test_engineReused(backends):
+    subprocessBackend, inProcessBackend = backends
+    brilcalcCache.runBrilcalc(QUERIES[0], useCache=False, backend=inProcessBackend)
+    brilcalcCache.runBrilcalc(QUERIES[1], useCache=False, backend=inProcessBackend)
+    assert len(inProcessBackend.engines) == 1
+
+def test_parallel(backends, monkeypatch):
+    subprocessBackend, inProcessBackend = backends
+    monkeypatch.setattr(brilcalcCache, "_defaultBackend", inProcessBackend)
+    nInProcess = [0]
+    run = inProcessBackend.run
+    def countingRun(args):
+        nInProcess[0] += 1
+        return run(args)
+    monkeypatch.setattr(inProcessBackend, "run", countingRun)
+    outputs = brilcalcCache.runBrilcalcMany(QUERIES, maxJobs=3, useCache=False)
+    for args, output in zip(QUERIES, outputs):
+        checkSame(brilcalcCache.runBrilcalc(args, useCache=False, backend=subprocessBackend), output)
+    assert nInProcess[0] >= 1
+
+def test_fallback(standin, monkeypatch):
+    # a brilws which can be imported, but which doesn't work with the in-process backend
+    from brilws.cli import brilcalc_main
+    monkeypatch.delattr(brilcalc_main, "create_engine")
+    monkeypatch.setattr(brilcalcCache, "_defaultBackend", None)
+    monkeypatch.setattr(brilcalcCache, "BACKEND", "auto")
+    assert brilcalcCache.getBackend() is brilcalcCache._subprocessBackend
+    assert brilcalcCache.runBrilcalc(QUERIES[0], useCache=False) is not None
+
+    monkeypatch.setattr(brilcalcCache, "_defaultBackend", None)
+    monkeypatch.setattr(brilcalcCache, "BACKEND", "inprocess")
+    with pytest.raises(AttributeError):
+        brilcalcCache.getBackend()
@@ -0,0 +1,205 @@
+# test_normtag.py
+#
+# Checks of normtag.py against real normtag files from this repository. The files are copied to a temporary
+# directory first, so the sidecars and run indexes made here don't end up next to the real files.
+#
+#   python3 -m pytest tests
+
+import os
+import sys
+import json
+import shutil
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import normtag
+from normtag import Normtag
+
+# Two luminometers which cover mostly, but not entirely, the same lumisections.
+FILES = ["normtag_pltzero.json", "normtag_hfoc.json"]
+
+@pytest.fixture(scope="module")
+def files(tmp_path_factory):
+    tempDir = tmp_path_factory.mktemp("normtags")
+    fileNames = []
+    for f in FILES:
+        shutil.copy(os.path.join(BASE_DIR, f), str(tempDir / f))
+        fileNames.append(str(tempDir / f))
+    return fileNames
+
+@pytest.fixture(scope="module")
+def records(files):
+    result = []
+    for fileName in files:
+        with open(fileName) as jsonFile:
+            result.append(json.load(jsonFile))
+    return result
+
+@pytest.fixture(scope="module")
+def normtags(records):
+    return [Normtag.fromRecords(r) for r in records]
+
+# The iovtag of every lumisection in the given runs, expanded, for comparing against.
+def expand(nt, runs):
+    return dict(((run, ls), tag) for run in runs for first, last, tag in nt.segments.get(run, [])
+                for ls in range(first, last+1))
+
+def recordRun(record):
+    return int(list(record[1])[0])
+
+# A few runs from each of the years in the files, including ones which are only in one of them.
+def sampleRuns(normtags):
+    runs = sorted(set(normtags[0].runs()) | set(normtags[1].runs()))
+    return sorted(set(runs[::max(1, len(runs)//40)] +
+                      [run for run in runs if (run in normtags[0]) != (run in normtags[1])][:20]))
+
+def test_records(records, normtags):
+    for recs, nt in zip(records, normtags):
+        assert Normtag.fromRecords(nt.toRecords()) == nt
+        # the first record in the file wins where two overlap, but these files only have harmless duplicates
+        expected = {}
+        for tag, runs in recs:
+            for run, lsRanges in runs.items():
+                for first, last in lsRanges:
+                    for ls in range(first, last+1):
+                        expected.setdefault((int(run), ls), tag)
+        assert expand(nt, nt.runs()) == expected
+        assert nt.nLumiSections() == len(expected)
+
+def test_writeNormtag(files, normtags, tmp_path):
+    fileName = str(tmp_path / "written.json")
+    with open(fileName, 'w') as jsonFile:
+        normtag.writeNormtag(normtags[0], jsonFile)
+    assert Normtag.fromFile(fileName) == normtags[0]
+
+def test_sweep(normtags):
+    runs = sampleRuns(normtags)
+    a = expand(normtags[0], runs)
+    b = expand(normtags[1], runs)
+    swept = {}
+    lastEnd = None
+    for run, first, last, tags in normtag.sweep(normtags, runs):
+        assert first <= last and tags != (None, None)
+        # the intervals come in order and don't overlap
+        assert lastEnd is None or (run, first) > lastEnd
+        lastEnd = (run, last)
+        for ls in range(first, last+1):
+            swept[(run, ls)] = tags
+    assert swept == dict((key, (a.get(key), b.get(key))) for key in set(a) | set(b))
+
+def test_composite(normtags):
+    runs = sampleRuns(normtags)
+    a = expand(normtags[0], runs)
+    b = expand(normtags[1], runs)
+    expected = dict(b)
+    expected.update(a)
+    assert expand(normtag.composite(normtags), runs) == expected
+
+    (best, second), shortfall = normtag.resolvePriority(normtags, 2)
+    assert best == normtag.composite(normtags)
+    assert expand(second, runs) == dict((key, b[key]) for key in a if key in b)
+    assert Normtag.fromCertJSON(shortfall) == Normtag.fromCertJSON((best - second).toCertJSON())
+
+def test_setOperations(normtags):
+    a, b = normtags
+    both = a & b
+    assert both.nLumiSections() + (a - b).nLumiSections() == a.nLumiSections()
+    assert ((a - b) & b).nLumiSections() == 0
+    assert (a | b).nLumiSections() == a.nLumiSections() + (b - a).nLumiSections()
+    # the iovtags come from the left-hand side where it covers a lumisection
+    assert both.iovtags() <= a.iovtags()
+    assert (a | b) & a == a
+    assert normtag.combine([a, b], lambda covered: covered[0] and covered[1]) == both
+    assert normtag.combine([a, b], lambda covered: covered[0] and not covered[1]) == a - b
+
+    # set operations with a certification JSON file only look at the lumisections
+    cert = Normtag.fromCertJSON(b.toCertJSON())
+    assert a & cert == both
+    assert normtag.mergeRanges([[5, 7], [1, 3], [4, 4], [10, 12]]) == [[1, 7], [10, 12]]
+    assert normtag.subtractRanges([[1, 10]], [[3, 4], [8, 20]]) == [[1, 2], [5, 7]]
+
+def test_sidecar(files, records, normtags, tmp_path, monkeypatch):
+    fileName = str(tmp_path / "sidecar.json")
+    shutil.copy(files[0], fileName)
+    rows, iovtags = normtag.writeSidecar(fileName)
+    assert len(rows) == sum(len(ranges) for tag, runs in records[0] for ranges in runs.values())
+    sidecar = normtag.readSidecar(fileName)
+    assert sidecar is not None and sidecar[2] == "normtag"
+    assert Normtag.fromArrays(sidecar[0], sidecar[1]) == normtags[0]
+    assert Normtag.fromFile(fileName) == normtags[0]
+    middle = normtags[0].runs()[len(normtags[0])//2]
+    assert Normtag.fromFile(fileName, middle, middle+1000) == normtags[0].restrict(middle, middle+1000)
+
+    # after the JSON file changes, the sidecar is rebuilt
+    with open(fileName, 'w') as jsonFile:
+        normtag.writeNormtag(normtags[1], jsonFile)
+    assert Normtag.fromFile(fileName) == normtags[1]
+
+    # if it can't be rebuilt (e.g. in a read-only directory), the JSON is read instead
+    with open(fileName, 'w') as jsonFile:
+        normtag.writeNormtag(normtags[0], jsonFile)
+    def readOnly(fileName, array):
+        raise PermissionError(13, "Permission denied", fileName)
+    monkeypatch.setattr(normtag, "_saveArray", readOnly)
+    assert normtag.readSidecar(fileName) is None
+    assert Normtag.fromFile(fileName) == normtags[0]
+
+def test_readRecordRange(files, records):
+    runs = sorted(set(recordRun(r) for r in records[0]))
+    for minRun, maxRun in [(runs[100], runs[150]), (runs[-3], None), (None, runs[2]), (runs[10], runs[10])]:
+        expected = [r for r in records[0] if (minRun is None or recordRun(r) >= minRun) and
+                    (maxRun is None or recordRun(r) <= maxRun)]
+        assert normtag.readRecordRange(files[0], minRun, maxRun) == expected
+    assert os.path.exists(normtag.indexFileName(files[0]))
+
+def test_compact(records, normtags):
+    compacted = normtag.compactNormtag(records[0])
+    assert len(compacted) < len(records[0])
+    assert Normtag.fromRecords(compacted) == normtags[0]
+    assert compacted == sorted(compacted, key=normtag.recordSortKey)
+    # compacting again doesn't change anything
+    assert normtag.compactNormtag(compacted) == compacted
+
+    with pytest.raises(ValueError):
+        normtag.compactNormtag(records[0] + [["hfoc24v02", {"387973": [[40, 50]]}]])
+
+    # reversed ranges don't cover anything, so they're dropped
+    with open(os.path.join(BASE_DIR, "normtag_dt.json")) as jsonFile:
+        dtRecords = json.load(jsonFile)
+    warnings = []
+    compacted = normtag.compactNormtag(dtRecords, warnings)
+    assert Normtag.fromRecords(compacted) == Normtag.fromRecords(dtRecords)
+    assert warnings and all("reversed range" in w for w in warnings)
+
+def test_validate(records):
+    problems = normtag.validateNormtag(records[1])
+    assert not [p for p in problems if p[0] == "error"]
+    broken = records[1] + [["hfoc24v03", {"387973": [[50, 60]]}], ["hf0c24v02", {"387974": [[1, 2]]}],
+                           ["hfoc24v02", {"387975": [[9, 8]]}], ["hfoc24v02", {"x": []}]]
+    errors = [p[1] for p in normtag.validateNormtag(broken) if p[0] == "error"]
+    assert len(errors) == 4
+    for expected in ["overlaps", "unknown iovtag", "reversed range", "malformed record"]:
+        assert any(expected in e for e in errors)
+
+def test_compactThenValidate(records):
+    # the output of compactNormtag is always valid and in order
+    for recs in records:
+        assert normtag.validateNormtag(normtag.compactNormtag(recs)) == []
+    outOfOrder = [["hfoc24v02", {"387973": [[46, 50], [10, 20]]}], ["hfoc24v02", {"387972": [[1, 2]]}]]
+    assert len(normtag.validateNormtag(outOfOrder)) == 2
+
+def test_diff(records, normtags):
+    a = normtags[0]
+    assert normtag.diffNormtags(a, a) == {}
+    run = a.runs()[len(a)//2]
+    first, last, tag = a.segments[run][0]
+    changed = [r for r in a.toRecords() if recordRun(r) != run]
+    changed.append(["pltzero99v00", {str(run): [[first, last]]}])
+    changed.append(["pltzero99v00", {"1": [[1, 10]]}])
+    diff = normtag.diffNormtags(a, Normtag.fromRecords(changed))
+    expected = {run: [(first, last, tag, "pltzero99v00")], 1: [(1, 10, None, "pltzero99v00")]}
+    # the other ranges of the run were removed
+    expected[run] += [(s[0], s[1], s[2], None) for s in a.segments[run][1:]]
+    assert diff == expected